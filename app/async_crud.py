@@ -0,0 +1,139 @@
+import asyncio
+from typing import Callable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, models, schemas
+from .database import SessionLocal
+from .message_writer import MessageWrite, WriteResult, message_writer
+
+# Async counterparts of app.crud for handlers running on the event loop. Reads
+# use an AsyncSession with the same statements as the sync functions; writes
+# still go through the single writer (the message writer thread, or the writer
+# connection in a worker thread) and are awaited, so the loop never blocks on a
+# commit.
+
+
+async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.get(models.User, user_id)
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[models.User]:
+    return (await db.execute(select(models.User).offset(skip).limit(limit))).scalars().all()
+
+
+async def get_or_create_user_id(db: AsyncSession, whatsapp_id: str) -> int:
+    """See ``crud.get_or_create_user_id``; shares its cache."""
+    user_id = crud.user_id_cache.get(whatsapp_id)
+    if user_id is not None:
+        return user_id
+    user_id = (await db.execute(crud.user_id_statement(whatsapp_id))).scalar()
+    if user_id is None:
+        user_id = await asyncio.to_thread(crud.create_user_id, whatsapp_id)
+    crud.user_id_cache.set(whatsapp_id, user_id)
+    return user_id
+
+
+async def get_or_create_user(db: AsyncSession, whatsapp_id: str) -> models.User:
+    return await get_user_by_id(db, await get_or_create_user_id(db, whatsapp_id))
+
+
+async def get_message_by_id(db: AsyncSession, message_id: int) -> Optional[models.Message]:
+    return await db.get(models.Message, message_id)
+
+
+async def get_messages_by_user(
+    db: AsyncSession,
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[models.Message]:
+    statement, newest_first = crud.messages_by_user_statement(user_id, before_id, after_id, limit)
+    messages = (await db.execute(statement)).scalars().all()
+    return list(reversed(messages)) if newest_first else messages
+
+
+async def get_message_rows(
+    db: AsyncSession,
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> list:
+    """``get_messages_by_user`` as plain row tuples (see ``crud.message_rows_statement``)."""
+    statement, newest_first = crud.message_rows_statement(user_id, before_id, after_id, limit)
+    rows = (await db.execute(statement)).all()
+    return list(reversed(rows)) if newest_first else rows
+
+
+async def get_conversations(
+    db: AsyncSession, before_id: Optional[int] = None, limit: int = 50
+) -> List[schemas.ConversationSummary]:
+    rows = (await db.execute(crud.conversations_statement(before_id, limit))).all()
+    return crud.conversation_summaries(rows)
+
+
+async def get_latest_message_id(db: AsyncSession) -> int:
+    return (await db.execute(crud.latest_message_id_statement())).scalar() or 0
+
+
+async def get_changes_since(db: AsyncSession, since_id: int, limit: int) -> schemas.ChangeFeed:
+    rows = (await db.execute(crud.changes_since_statement(since_id, limit))).all()
+    return crud.change_feed(rows, since_id, limit)
+
+
+async def search_messages(
+    db: AsyncSession,
+    query: str,
+    user_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    order: str = "relevance",
+) -> schemas.SearchResults:
+    match = crud.search_query(query)
+    if match is None:
+        return schemas.SearchResults()
+    rows = (await db.execute(crud.search_messages_statement(match, user_id, cursor, limit, order))).all()
+    return crud.search_results(rows, limit, order)
+
+
+async def submit_write(write: MessageWrite) -> WriteResult:
+    """Group-commit ``write`` through the message writer without blocking the loop."""
+    return await asyncio.wrap_future(message_writer.submit(write))
+
+
+async def create_message(
+    db: AsyncSession,
+    message: schemas.MessageCreate,
+    user_id: int,
+    recipient: Optional[str] = None,
+    payload: Optional[dict] = None,
+) -> models.Message:
+    """Store one message (queued for delivery when ``payload`` is given) and return it."""
+    write = MessageWrite(user_id=user_id)
+    write.add(message, recipient=recipient, payload=payload)
+    result = await submit_write(write)
+    return await get_message_by_id(db, result.message_ids[0])
+
+
+async def mark_conversation_read(user_id: int) -> bool:
+    return await asyncio.to_thread(_in_write_session, crud.mark_conversation_read, user_id)
+
+
+async def get_media_blob_by_sha256(db: AsyncSession, sha256: str) -> Optional[models.MediaBlob]:
+    result = await db.execute(select(models.MediaBlob).where(models.MediaBlob.sha256 == sha256))
+    return result.scalars().first()
+
+
+async def add_media_blob(sha256: str, path: str, size: int, mime_type: Optional[str]) -> int:
+    return await asyncio.to_thread(_in_write_session, crud.add_media_blob, sha256, path, size, mime_type)
+
+
+def _in_write_session(operation: Callable, *args):
+    db = SessionLocal()
+    try:
+        return operation(db, *args)
+    finally:
+        db.close()
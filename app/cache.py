@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe bounded LRU map with an optional time-to-live per entry."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get(key)
+        return default if value is self._MISSING else value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._set(key, value)
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        """Insert ``key`` only if absent (or expired). Returns True if it was inserted."""
+        with self._lock:
+            if self._get(key) is not self._MISSING:
+                return False
+            self._set(key, value)
+            return True
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._MISSING
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            return self._MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
@@ -0,0 +1,128 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Graph while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fail fast while an upstream is degraded.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``reset_timeout`` seconds. It then lets a single trial
+    call through (half-open): success closes it again, failure re-opens it,
+    and a trial abandoned without a verdict (cancelled, or failed before
+    reaching the upstream) lets the next call try instead.
+    Meant to be driven from a single event loop; ``snapshot`` is safe to read
+    from any thread.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.total_failures = 0
+        self.total_rejections = 0
+        self._trial_in_flight = False
+
+    def before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError. Returns True for the half-open trial."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.total_rejections += 1
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                self.total_rejections += 1
+                raise CircuitOpenError(f"{self.name} circuit is half-open; trial call in flight")
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        if self.state != self.CLOSED:
+            self._transition(self.CLOSED)
+
+    def record_abandoned(self, trial: bool):
+        """A call admitted by ``before_call`` ended without a success or failure."""
+        if trial:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self._transition(self.OPEN)
+
+    def snapshot(self) -> Dict:
+        retry_in = None
+        if self.state == self.OPEN and self.opened_at is not None:
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "total_failures": self.total_failures,
+            "total_rejections": self.total_rejections,
+            "retry_in_seconds": retry_in,
+        }
+
+    def _transition(self, state: str):
+        logger.warning("%s circuit breaker: %s -> %s", self.name, self.state, state)
+        self.state = state
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, capped and Retry-After aware."""
+
+    def __init__(self, max_retries: int, base_delay: float, max_delay: float):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def is_retryable_status(status_code: int) -> bool:
+        return status_code in RETRYABLE_STATUS_CODES
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        server_delay = self._parse_retry_after(retry_after)
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.max_delay))
+        return delay
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
@@ -22,6 +22,119 @@ class Settings(BaseSettings):
     PROMO_IMAGE_CAPTION: str = "Check out our latest offer!"
     VEO3_INFO_URL: str = "https://www.example.com/veo3"
 
+    # Webhook processing: when enabled, POST /webhook acks immediately and the
+    # payload is processed by background workers.
+    WEBHOOK_ASYNC_PROCESSING: bool = False
+    WEBHOOK_QUEUE_MAXSIZE: int = 1000
+    WEBHOOK_WORKERS: int = 16
+    # Messages are sharded by sender onto this many lanes: ordered per user,
+    # parallel across users.
+    MESSAGE_LANES: int = 8
+    # Message rows from all lanes are group-committed by one writer thread.
+    MESSAGE_WRITER_MAX_BATCH: int = 256
+    MESSAGE_WRITER_MAX_DELAY_MS: float = 2.0
+    # Recently processed inbound WhatsApp message ids, to drop redeliveries early.
+    SEEN_MESSAGE_CACHE_SIZE: int = 10000
+    SEEN_MESSAGE_CACHE_TTL: float = 3600.0
+    # In-process whatsapp_id -> user id map for resolving senders without a query.
+    USER_ID_CACHE_SIZE: int = 50000
+
+    # Bot replies at least this long are stored once (message_bodies) and
+    # referenced by id; the writer caches the ids of recently used texts.
+    MESSAGE_BODY_INTERN_MIN_LENGTH: int = 64
+    MESSAGE_BODY_CACHE_SIZE: int = 4096
+
+    # Dashboard push events: per-connection backlog before a slow client is
+    # dropped, and the idle keepalive interval.
+    EVENT_SUBSCRIBER_QUEUE_SIZE: int = 256
+    EVENT_KEEPALIVE_SECONDS: float = 15.0
+
+    # SQLite storage profile (ignored for other databases). Writes share one
+    # connection; reads use a pool of query-only connections.
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_CACHE_SIZE_KB: int = 65536
+    SQLITE_MMAP_SIZE: int = 268435456
+    SQLITE_READ_POOL_SIZE: int = 16
+    # Async driver URL for event-loop reads; derived (sqlite+aiosqlite) from
+    # DATABASE_URL when empty.
+    ASYNC_DATABASE_URL: str = ""
+    # Dashboard message search: relevance ranking across all conversations
+    # only scores the newest matches, so common terms stay fast.
+    SEARCH_RANK_WINDOW: int = 2000
+
+    # Outbound Graph API connection pool (shared by the sync and async clients).
+    WHATSAPP_HTTP_POOL_SIZE: int = 20
+    WHATSAPP_HTTP_KEEPALIVE_CONNECTIONS: int = 10
+    WHATSAPP_HTTP_KEEPALIVE_EXPIRY: float = 30.0
+    WHATSAPP_HTTP2: bool = False
+    # Outbound send budgets (token buckets); sends over budget are delayed, not
+    # dropped. A rate of 0 disables that limit.
+    WHATSAPP_SEND_RATE_PER_SECOND: float = 80.0
+    WHATSAPP_SEND_BURST: int = 80
+    WHATSAPP_RECIPIENT_RATE_PER_MINUTE: float = 10.0
+    WHATSAPP_RECIPIENT_BURST: int = 20
+    # Recipient buckets kept in memory; only refilled ones are dropped for new
+    # recipients, so the limit can be exceeded while many chats are throttled.
+    RATE_LIMIT_MAX_TRACKED_RECIPIENTS: int = 10000
+    # Retries for timeouts, 429 and 5xx responses, and the circuit breaker that
+    # fails sends fast while Graph is degraded.
+    WHATSAPP_MAX_RETRIES: int = 3
+    WHATSAPP_RETRY_BASE_DELAY: float = 0.5
+    WHATSAPP_RETRY_MAX_DELAY: float = 30.0
+    WHATSAPP_BREAKER_FAILURE_THRESHOLD: int = 5
+    WHATSAPP_BREAKER_RESET_TIMEOUT: float = 30.0
+
+    # Outbox: replies are queued in the database and delivered in the background.
+    OUTBOX_WORKERS: int = 8
+    OUTBOX_BATCH_SIZE: int = 200
+    OUTBOX_POLL_INTERVAL: float = 2.0
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_RETRY_BASE_DELAY: float = 5.0
+    OUTBOX_RETRY_MAX_DELAY: float = 600.0
+    # Inbound media: downloaded by a background worker, streamed to disk in
+    # chunks. Files over MEDIA_MAX_BYTES are refused.
+    MEDIA_WORKERS: int = 4
+    MEDIA_MAX_BYTES: int = 104857600
+    MEDIA_CHUNK_SIZE: int = 65536
+    MEDIA_DOWNLOAD_TIMEOUT: float = 60.0
+    MEDIA_BATCH_SIZE: int = 100
+    MEDIA_POLL_INTERVAL: float = 5.0
+    MEDIA_MAX_ATTEMPTS: int = 5
+    MEDIA_RETRY_BASE_DELAY: float = 5.0
+    MEDIA_RETRY_MAX_DELAY: float = 600.0
+    # Dashboard previews of stored images, rendered in a process pool:
+    # longest side in pixels, format ("WEBP" or "JPEG") and quality.
+    THUMBNAIL_WORKERS: int = 2
+    THUMBNAIL_MAX_SIZE: int = 320
+    THUMBNAIL_FORMAT: str = "WEBP"
+    THUMBNAIL_QUALITY: int = 80
+    THUMBNAIL_BATCH_SIZE: int = 50
+    THUMBNAIL_POLL_INTERVAL: float = 30.0
+    # Dashboard file uploads are streamed into the media store and capped at
+    # UPLOAD_MAX_BYTES. A single multipart request carries at most
+    # UPLOAD_FORM_MAX_BYTES; larger files go through a resumable session in
+    # UPLOAD_CHUNK_SIZE pieces; idle sessions expire after UPLOAD_SESSION_TTL.
+    UPLOAD_MAX_BYTES: int = 104857600
+    UPLOAD_FORM_MAX_BYTES: int = 8388608
+    UPLOAD_CHUNK_SIZE: int = 8388608
+    UPLOAD_SESSION_TTL: float = 86400.0
+    # Outbound media is uploaded to Graph once per distinct file and then sent
+    # by media id until GRAPH_MEDIA_TTL seconds (Graph keeps uploads 30 days).
+    GRAPH_MEDIA_UPLOAD: bool = True
+    GRAPH_MEDIA_TTL: float = 2505600.0
+    GRAPH_MEDIA_CACHE_SIZE: int = 1024
+    # Files on other hosts are fetched with this timeout; a link that failed
+    # is sent by link for GRAPH_MEDIA_RETRY_AFTER seconds before trying again.
+    GRAPH_MEDIA_FETCH_TIMEOUT: float = 10.0
+    GRAPH_MEDIA_RETRY_AFTER: float = 300.0
+    # Durable inbox: raw webhook bodies are committed before the ack and
+    # unfinished entries are replayed on startup.
+    WEBHOOK_INBOX_ENABLED: bool = True
+    WEBHOOK_INBOX_MAX_ATTEMPTS: int = 5
+    WEBHOOK_INBOX_RETENTION_DAYS: int = 7
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
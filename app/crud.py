@@ -1,6 +1,29 @@
-from sqlalchemy.orm import Session
+import json
+import re
+from datetime import datetime
+from typing import Collection, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import DateTime, case, or_, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import func
 
 from . import models, schemas
+from .cache import LRUCache
+from .config import settings
+from .database import SessionLocal, read_engine
+from .media_store import media_store
+
+# whatsapp_id -> users.id. Users are never deleted or renumbered, so entries
+# never go stale, whichever worker created the row.
+user_id_cache = LRUCache(maxsize=settings.USER_ID_CACHE_SIZE)
+
+
+class UserRef(NamedTuple):
+    """The two user fields message processing needs, without loading the row."""
+
+    id: int
+    whatsapp_id: str
 
 
 def get_user_by_whatsapp_id(db: Session, whatsapp_id: str):
@@ -26,12 +49,62 @@ def create_user(db: Session, user: schemas.UserCreate):
     return db_user
 
 
+def get_or_create_user_id(db: Session, whatsapp_id: str) -> int:
+    """Resolve a WhatsApp ID to a user id, creating the user atomically if needed.
+
+    Cached ids cost no query. Otherwise an existing row is looked up through
+    ``db`` (which may be read-only), and a new one is inserted in a short write
+    session with ON CONFLICT DO NOTHING, so concurrent first messages from the
+    same number cannot fail on the unique constraint.
+    """
+    user_id = user_id_cache.get(whatsapp_id)
+    if user_id is not None:
+        return user_id
+
+    user_id = db.execute(user_id_statement(whatsapp_id)).scalar()
+    if user_id is None:
+        # The writer has a single connection: reuse it if ``db`` already holds it.
+        user_id = create_user_id(whatsapp_id, None if db.get_bind() is read_engine else db)
+    user_id_cache.set(whatsapp_id, user_id)
+    return user_id
+
+
+def user_id_statement(whatsapp_id: str):
+    return select(models.User.id).where(models.User.whatsapp_id == whatsapp_id)
+
+
+def create_user_id(whatsapp_id: str, write_db: Optional[Session] = None) -> int:
+    """Insert a user unless one exists and return its id, on ``write_db`` or a new write session."""
+    db = write_db or SessionLocal()
+    try:
+        user_id = db.execute(
+            sqlite_insert(models.User)
+            .values(whatsapp_id=whatsapp_id)
+            .on_conflict_do_nothing(index_elements=[models.User.whatsapp_id])
+            .returning(models.User.id)
+        ).scalar()
+        if user_id is None:  # another worker inserted it first
+            user_id = db.execute(user_id_statement(whatsapp_id)).scalar_one()
+        db.commit()
+        return user_id
+    finally:
+        if write_db is None:
+            db.close()
+
+
+def get_or_create_user_ref(db: Session, whatsapp_id: str) -> UserRef:
+    """Like ``get_or_create_user_id``, returning the id with its WhatsApp ID."""
+    return UserRef(id=get_or_create_user_id(db, whatsapp_id), whatsapp_id=whatsapp_id)
+
+
 def get_or_create_user(db: Session, whatsapp_id: str):
     """Get a user by WhatsApp ID, or create them if they do not exist."""
-    db_user = get_user_by_whatsapp_id(db, whatsapp_id=whatsapp_id)
-    if not db_user:
-        db_user = create_user(db, user=schemas.UserCreate(whatsapp_id=whatsapp_id))
-    return db_user
+    return get_user_by_id(db, get_or_create_user_id(db, whatsapp_id))
+
+
+def get_message_by_id(db: Session, message_id: int):
+    """Retrieve a message by its primary key."""
+    return db.query(models.Message).filter(models.Message.id == message_id).first()
 
 
 def get_message_by_whatsapp_message_id(db: Session, message_id: str):
@@ -59,11 +132,644 @@ def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.User).offset(skip).limit(limit).all()
 
 
-def get_messages_by_user(db: Session, user_id: int):
-    """Retrieve all messages for a specific user, ordered by timestamp."""
+def get_conversations(db: Session, before_id: Optional[int] = None, limit: int = 50):
+    """List conversations by recency, keyset-paginated on ``last_message_id``."""
+    return conversation_summaries(db.execute(conversations_statement(before_id, limit)).all())
+
+
+def conversations_statement(before_id: Optional[int], limit: int):
+    statement = (
+        select(models.Conversation, models.User.whatsapp_id)
+        .join(models.User, models.User.id == models.Conversation.user_id)
+    )
+    if before_id is not None:
+        statement = statement.where(models.Conversation.last_message_id < before_id)
+    return statement.order_by(models.Conversation.last_message_id.desc()).limit(limit)
+
+
+def conversation_summaries(rows) -> List[schemas.ConversationSummary]:
+    return [
+        schemas.ConversationSummary(
+            user_id=conversation.user_id,
+            whatsapp_id=whatsapp_id,
+            last_message_id=conversation.last_message_id,
+            last_message_at=conversation.last_message_at,
+            last_preview=conversation.last_preview,
+            last_direction=conversation.last_direction,
+            unread_count=conversation.unread_count,
+            last_inbound_at=conversation.last_inbound_at,
+        )
+        for conversation, whatsapp_id in rows
+    ]
+
+
+def mark_conversation_read(db: Session, user_id: int) -> bool:
+    """Reset a conversation's unread counter. Returns False if it does not exist."""
+    updated = (
+        db.query(models.Conversation)
+        .filter(models.Conversation.user_id == user_id)
+        .update({models.Conversation.unread_count: 0}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(updated)
+
+
+def conversation_preview(content: str, message_type: Optional[str]) -> str:
+    """Short inbox preview for a message."""
+    if message_type in ("image", "document", "audio", "video", "sticker"):
+        return f"[{message_type}]"
+    content = " ".join((content or "").split())
+    return content if len(content) <= 120 else content[:119] + "…"
+
+
+def get_latest_message_id(db: Session) -> int:
+    return db.execute(latest_message_id_statement()).scalar() or 0
+
+
+def latest_message_id_statement():
+    return select(func.max(models.Message.id))
+
+
+def get_changes_since(db: Session, since_id: int, limit: int) -> schemas.ChangeFeed:
+    """Summarize messages with ``id > since_id`` per conversation.
+
+    Scans at most ``limit`` messages as a primary-key range, so the cost is
+    bounded however stale the cursor is.
+    """
+    return change_feed(db.execute(changes_since_statement(since_id, limit)).all(), since_id, limit)
+
+
+def changes_since_statement(since_id: int, limit: int):
+    window = (
+        select(models.Message.id, models.Message.user_id, models.Message.direction)
+        .where(models.Message.id > since_id)
+        .order_by(models.Message.id.asc())
+        .limit(limit)
+        .subquery()
+    )
+    incoming = case((window.c.direction == "incoming", 1), else_=0)
     return (
-        db.query(models.Message)
-        .filter(models.Message.user_id == user_id)
-        .order_by(models.Message.timestamp.asc())
+        select(
+            window.c.user_id,
+            func.count().label("new_messages"),
+            func.sum(incoming).label("new_incoming"),
+            func.max(window.c.id).label("last_message_id"),
+        )
+        .group_by(window.c.user_id)
+        .order_by(func.max(window.c.id).desc())
+    )
+
+
+def change_feed(rows, since_id: int, limit: int) -> schemas.ChangeFeed:
+    scanned = sum(row.new_messages for row in rows)
+    return schemas.ChangeFeed(
+        cursor=max((row.last_message_id for row in rows), default=since_id),
+        has_more=scanned >= limit,
+        conversations=[
+            schemas.ConversationChange(
+                user_id=row.user_id,
+                new_messages=row.new_messages,
+                new_incoming=row.new_incoming,
+                last_message_id=row.last_message_id,
+            )
+            for row in rows
+        ],
+    )
+
+
+_SEARCH_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def search_query(query: str) -> Optional[str]:
+    """Turn free text into an FTS5 query matching every word, the last as a prefix.
+
+    Each word is quoted, so FTS5 operators and punctuation typed by the user are
+    matched literally instead of raising syntax errors.
+    """
+    terms = _SEARCH_TERM.findall(query)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms) + "*"
+
+
+def search_cursor(hit, order: str) -> str:
+    if order == "recent":
+        return str(hit.message_id)
+    return f"{hit.rank!r}:{hit.message_id}:{hit.rank_floor}"
+
+
+def search_messages_statement(
+    query: str, user_id: Optional[int], cursor: Optional[str], limit: int, order: str = "relevance"
+):
+    """Ranked (bm25) or newest-first search over ``messages_fts``, keyset paged by ``cursor``.
+
+    Across all conversations, relevance only ranks the newest
+    ``SEARCH_RANK_WINDOW`` matches: scoring every hit of a common word would
+    cost hundreds of milliseconds at millions of rows. The window's lowest id
+    is carried in the cursor so later pages rank the same set. Raises
+    ValueError for a malformed cursor.
+    """
+    params = {"query": query, "limit": limit}
+    conditions = ["messages_fts MATCH :query"]
+    rank_floor = "0"
+    if user_id is not None:
+        conditions.append("m.user_id = :user_id")
+        params["user_id"] = user_id
+    if order == "recent":
+        ordering = "messages_fts.rowid DESC"
+        if cursor:
+            conditions.append("messages_fts.rowid < :after_id")
+            params["after_id"] = int(cursor)
+    else:
+        ordering = "bm25(messages_fts), messages_fts.rowid DESC"
+        if cursor:
+            rank, message_id, floor = cursor.split(":")
+            conditions.append(
+                "(bm25(messages_fts) > :after_rank"
+                " OR (bm25(messages_fts) = :after_rank AND messages_fts.rowid < :after_id))"
+            )
+            params.update(after_rank=float(rank), after_id=int(message_id), rank_floor=int(floor))
+            rank_floor = ":rank_floor"
+        elif user_id is None:
+            rank_floor = (
+                "COALESCE((SELECT rowid FROM messages_fts WHERE messages_fts MATCH :query"
+                " ORDER BY rowid DESC LIMIT 1 OFFSET :window), 0)"
+            )
+            params["window"] = max(settings.SEARCH_RANK_WINDOW, 1) - 1
+        conditions.append(f"messages_fts.rowid >= {rank_floor}")
+    return (
+        text(
+            "SELECT m.id AS message_id, m.user_id, u.whatsapp_id, m.direction, m.message_type, m.timestamp, "
+            "snippet(messages_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet, "
+            f"bm25(messages_fts) AS rank, {rank_floor} AS rank_floor "
+            "FROM messages_fts "
+            "JOIN messages AS m ON m.id = messages_fts.rowid "
+            "JOIN users AS u ON u.id = m.user_id "
+            f"WHERE {' AND '.join(conditions)} "
+            f"ORDER BY {ordering} "
+            "LIMIT :limit"
+        )
+        .bindparams(**params)
+        .columns(timestamp=DateTime)
+    )
+
+
+def search_results(rows, limit: int, order: str) -> schemas.SearchResults:
+    hits = [schemas.SearchHit.model_validate(row._mapping) for row in rows]
+    next_cursor = search_cursor(rows[-1], order) if len(rows) >= limit else None
+    return schemas.SearchResults(hits=hits, next_cursor=next_cursor)
+
+
+def search_messages(
+    db: Session,
+    query: str,
+    user_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    order: str = "relevance",
+) -> schemas.SearchResults:
+    match = search_query(query)
+    if match is None:
+        return schemas.SearchResults()
+    rows = db.execute(search_messages_statement(match, user_id, cursor, limit, order)).all()
+    return search_results(rows, limit, order)
+
+
+def get_messages_by_user(
+    db: Session,
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+):
+    """Retrieve a user's messages in chronological (id) order.
+
+    Keyset pagination over the ``(user_id, id)`` index: ``after_id`` returns the
+    oldest ``limit`` messages newer than that id (incremental polling), otherwise
+    the newest ``limit`` messages, optionally older than ``before_id``.
+    """
+    statement, newest_first = messages_by_user_statement(user_id, before_id, after_id, limit)
+    messages = db.execute(statement).scalars().all()
+    return list(reversed(messages)) if newest_first else messages
+
+
+def messages_by_user_statement(
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+):
+    """Statement for ``get_messages_by_user`` and whether its rows come newest first."""
+    return _page_messages(select(models.Message), user_id, before_id, after_id, limit)
+
+
+# Column order of message_rows_statement rows, also the JSON key order of
+# schemas.Message (with the thumbnail path standing in for its URL).
+MESSAGE_ROW_FIELDS = (
+    "content",
+    "direction",
+    "message_type",
+    "whatsapp_message_id",
+    "id",
+    "user_id",
+    "timestamp",
+    "thumbnail_url",
+    "width",
+    "height",
+)
+
+
+def message_rows_statement(
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = None,
+):
+    """Like ``messages_by_user_statement`` but selecting plain column tuples.
+
+    Interned bodies and media blobs are resolved in SQL, so no ORM objects are built.
+    """
+    message = models.Message
+    statement = (
+        select(
+            func.coalesce(models.MessageBody.content, message.stored_content).label("content"),
+            message.direction,
+            message.message_type,
+            message.whatsapp_message_id,
+            message.id,
+            message.user_id,
+            message.timestamp,
+            models.MediaBlob.thumbnail_path,
+            models.MediaBlob.width,
+            models.MediaBlob.height,
+        )
+        .outerjoin(models.MessageBody, models.MessageBody.id == message.body_id)
+        .outerjoin(models.MediaBlob, models.MediaBlob.id == message.blob_id)
+    )
+    return _page_messages(statement, user_id, before_id, after_id, limit)
+
+
+def encode_message_rows(rows) -> bytes:
+    """Serialize ``message_rows_statement`` rows to the JSON of ``List[schemas.Message]``."""
+    return json.dumps(
+        [
+            dict(
+                zip(MESSAGE_ROW_FIELDS, row),
+                timestamp=row[6].isoformat() if row[6] else None,
+                thumbnail_url=media_store.url(row[7]) if row[7] else None,
+            )
+            for row in rows
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _page_messages(statement, user_id: int, before_id: Optional[int], after_id: Optional[int], limit: Optional[int]):
+    statement = statement.where(models.Message.user_id == user_id)
+    if after_id is not None:
+        statement = statement.where(models.Message.id > after_id)
+    if before_id is not None:
+        statement = statement.where(models.Message.id < before_id)
+
+    if after_id is not None or not limit:
+        statement = statement.order_by(models.Message.id.asc())
+        return (statement.limit(limit) if limit else statement), False
+    return statement.order_by(models.Message.id.desc()).limit(limit), True
+
+
+def write_inbox_batch(
+    db: Session, payloads: List[bytes], finished: List[Tuple[int, Optional[str]]]
+) -> List[int]:
+    """Store raw webhook bodies and finish earlier entries in a single transaction.
+
+    ``finished`` holds ``(entry_id, error)`` pairs: entries without an error are
+    marked processed, the rest count a failed attempt so they can be replayed.
+    Returns the ids of the new entries in ``payloads`` order.
+    """
+    entries = [models.InboxEntry(payload=payload, attempts=0) for payload in payloads]
+    db.add_all(entries)
+    db.flush()
+    processed_ids = [entry_id for entry_id, error in finished if error is None]
+    if processed_ids:
+        db.query(models.InboxEntry).filter(models.InboxEntry.id.in_(processed_ids)).update(
+            {
+                models.InboxEntry.processed_at: func.now(),
+                models.InboxEntry.attempts: models.InboxEntry.attempts + 1,
+                models.InboxEntry.last_error: None,
+            },
+            synchronize_session=False,
+        )
+    for entry_id, error in finished:
+        if error is not None:
+            db.query(models.InboxEntry).filter(models.InboxEntry.id == entry_id).update(
+                {
+                    models.InboxEntry.attempts: models.InboxEntry.attempts + 1,
+                    models.InboxEntry.last_error: error,
+                },
+                synchronize_session=False,
+            )
+    entry_ids = [entry.id for entry in entries]
+    db.commit()
+    return entry_ids
+
+
+def get_unprocessed_inbox_entries(db: Session, max_attempts: int):
+    """Return unfinished inbox entries that still have attempts left, oldest first."""
+    return (
+        db.query(models.InboxEntry.id, models.InboxEntry.payload)
+        .filter(
+            models.InboxEntry.processed_at.is_(None),
+            models.InboxEntry.attempts < max_attempts,
+        )
+        .order_by(models.InboxEntry.id.asc())
+        .all()
+    )
+
+
+def delete_processed_inbox_entries(db: Session, older_than: datetime) -> int:
+    """Prune processed inbox entries received before ``older_than``."""
+    deleted = (
+        db.query(models.InboxEntry)
+        .filter(
+            models.InboxEntry.processed_at.isnot(None),
+            models.InboxEntry.received_at < older_than,
+        )
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
+
+
+def get_pending_outbox_messages(db: Session, limit: int, now: datetime, skip_recipients: Collection[str] = ()):
+    """Return the oldest pending outbox rows that can be sent ``now``, in queue order.
+
+    A recipient whose queue has a row backing off contributes nothing from
+    that row on (its order must hold), and ``skip_recipients`` (those being
+    delivered to) are left out, so neither can crowd due rows out of ``limit``.
+    """
+    outbox = models.OutboxMessage
+    waiting = aliased(models.OutboxMessage)
+    query = db.query(outbox).filter(
+        outbox.status == "pending",
+        ~select(waiting.id)
+        .where(
+            waiting.recipient == outbox.recipient,
+            waiting.status == "pending",
+            waiting.id <= outbox.id,
+            waiting.next_attempt_at > now,
+        )
+        .exists(),
+    )
+    if skip_recipients:
+        query = query.filter(outbox.recipient.notin_(list(skip_recipients)))
+    return query.order_by(outbox.id.asc()).limit(limit).all()
+
+
+def claim_outbox_message(db: Session, outbox_id: int, attempts: int) -> bool:
+    """Mark a pending row as being sent. False if it changed since it was loaded."""
+    claimed = (
+        db.query(models.OutboxMessage)
+        .filter(
+            models.OutboxMessage.id == outbox_id,
+            models.OutboxMessage.status == "pending",
+            models.OutboxMessage.attempts == attempts,
+        )
+        .update({models.OutboxMessage.status: "sending"}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(claimed)
+
+
+def release_outbox_claims(db: Session, outbox_id: Optional[int] = None) -> int:
+    """Return rows left mid-send (all of them, or just ``outbox_id``) to the queue."""
+    query = db.query(models.OutboxMessage).filter(models.OutboxMessage.status == "sending")
+    if outbox_id is not None:
+        query = query.filter(models.OutboxMessage.id == outbox_id)
+    released = query.update({models.OutboxMessage.status: "pending"}, synchronize_session=False)
+    db.commit()
+    return released
+
+
+def get_pending_media_downloads(db: Session, limit: int, now: datetime):
+    """Return the oldest media downloads due ``now`` with the user of their message."""
+    return (
+        db.query(models.MediaDownload, models.Message.user_id)
+        .join(models.Message, models.Message.id == models.MediaDownload.message_id)
+        .filter(
+            models.MediaDownload.status == "pending",
+            or_(models.MediaDownload.next_attempt_at.is_(None), models.MediaDownload.next_attempt_at <= now),
+        )
+        .order_by(models.MediaDownload.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def claim_media_download(db: Session, download_id: int, attempts: int) -> bool:
+    """Mark a pending download as in progress. False if it changed since it was loaded."""
+    claimed = (
+        db.query(models.MediaDownload)
+        .filter(
+            models.MediaDownload.id == download_id,
+            models.MediaDownload.status == "pending",
+            models.MediaDownload.attempts == attempts,
+        )
+        .update({models.MediaDownload.status: "downloading"}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(claimed)
+
+
+def release_media_downloads(db: Session, download_id: Optional[int] = None) -> int:
+    """Return downloads left in progress (all of them, or just ``download_id``) to the queue."""
+    query = db.query(models.MediaDownload).filter(models.MediaDownload.status == "downloading")
+    if download_id is not None:
+        query = query.filter(models.MediaDownload.id == download_id)
+    released = query.update({models.MediaDownload.status: "pending"}, synchronize_session=False)
+    db.commit()
+    return released
+
+
+def finish_media_download(
+    db: Session,
+    download_id: int,
+    content: str,
+    error: Optional[str] = None,
+    blob_id: Optional[int] = None,
+):
+    """Close a media download: point its message at ``content`` (and ``blob_id``) and mark it done or failed."""
+    download = db.get(models.MediaDownload, download_id)
+    download.status = "failed" if error else "done"
+    download.attempts += 1
+    download.completed_at = func.now()
+    download.last_error = error
+    download.message.content = content
+    download.message.blob_id = blob_id
+    db.commit()
+
+
+def get_media_blob_by_sha256(db: Session, sha256: str) -> Optional[models.MediaBlob]:
+    return db.query(models.MediaBlob).filter(models.MediaBlob.sha256 == sha256).first()
+
+
+def add_media_blob(db: Session, sha256: str, path: str, size: int, mime_type: Optional[str]) -> int:
+    """Record a stored blob unless it is already known and return its id."""
+    blob_id = db.execute(
+        sqlite_insert(models.MediaBlob)
+        .values(
+            sha256=sha256,
+            path=path,
+            size=size,
+            mime_type=mime_type,
+            refcount=0,
+            thumbnail_status="pending" if (mime_type or "").startswith("image/") else None,
+        )
+        .on_conflict_do_nothing(index_elements=[models.MediaBlob.sha256])
+        .returning(models.MediaBlob.id)
+    ).scalar()
+    if blob_id is None:  # stored before, possibly under another extension
+        blob_id = db.execute(select(models.MediaBlob.id).where(models.MediaBlob.sha256 == sha256)).scalar_one()
+    db.commit()
+    return blob_id
+
+
+def schedule_media_download_retry(db: Session, download_id: int, next_attempt_at: datetime, error: str):
+    """Count a failed download attempt and push the next one back."""
+    db.query(models.MediaDownload).filter(models.MediaDownload.id == download_id).update(
+        {
+            models.MediaDownload.status: "pending",
+            models.MediaDownload.attempts: models.MediaDownload.attempts + 1,
+            models.MediaDownload.next_attempt_at: next_attempt_at,
+            models.MediaDownload.last_error: error,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def get_pending_thumbnails(db: Session, limit: int) -> List[models.MediaBlob]:
+    return (
+        db.query(models.MediaBlob)
+        .filter(models.MediaBlob.thumbnail_status == "pending")
+        .order_by(models.MediaBlob.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+def finish_thumbnail(
+    db: Session,
+    blob_id: int,
+    thumbnail_path: Optional[str],
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+):
+    """Record a blob's thumbnail and size, or (without ``thumbnail_path``) that none can be made."""
+    db.query(models.MediaBlob).filter(models.MediaBlob.id == blob_id).update(
+        {
+            models.MediaBlob.thumbnail_status: "done" if thumbnail_path else "failed",
+            models.MediaBlob.thumbnail_path: thumbnail_path,
+            models.MediaBlob.width: width,
+            models.MediaBlob.height: height,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def get_blob_messages(db: Session, blob_id: int, limit: int):
+    """Return (id, user_id, message_type) of the newest messages carrying a blob."""
+    return (
+        db.query(models.Message.id, models.Message.user_id, models.Message.message_type)
+        .filter(models.Message.blob_id == blob_id)
+        .order_by(models.Message.id.desc())
+        .limit(limit)
         .all()
     )
+
+
+def get_graph_media(db: Session, phone_number_id: str, sha256: str, valid_at: datetime):
+    """Return the Graph upload of a file that is still usable at ``valid_at``, if any."""
+    return (
+        db.query(models.GraphMedia)
+        .filter(
+            models.GraphMedia.phone_number_id == phone_number_id,
+            models.GraphMedia.sha256 == sha256,
+            models.GraphMedia.expires_at > valid_at,
+        )
+        .first()
+    )
+
+
+def save_graph_media(db: Session, phone_number_id: str, sha256: str, media_id: str, expires_at: datetime):
+    """Record (or replace) the Graph media id of a file."""
+    statement = sqlite_insert(models.GraphMedia).values(
+        phone_number_id=phone_number_id, sha256=sha256, media_id=media_id, expires_at=expires_at
+    )
+    db.execute(
+        statement.on_conflict_do_update(
+            index_elements=[models.GraphMedia.phone_number_id, models.GraphMedia.sha256],
+            set_={
+                "media_id": statement.excluded.media_id,
+                "expires_at": statement.excluded.expires_at,
+                "uploaded_at": func.now(),
+            },
+        )
+    )
+    db.commit()
+
+
+def delete_graph_media(db: Session, media_id: str):
+    db.query(models.GraphMedia).filter(models.GraphMedia.media_id == media_id).delete(synchronize_session=False)
+    db.commit()
+
+
+def mark_outbox_message_sent(
+    db: Session,
+    outbox_id: int,
+    whatsapp_message_id: Optional[str],
+    content: Optional[str] = None,
+    message_type: Optional[str] = None,
+) -> models.Message:
+    """Record a delivered send, write the WhatsApp id back to its message row and return that row."""
+    outbox_message = db.get(models.OutboxMessage, outbox_id)
+    outbox_message.status = "sent"
+    outbox_message.attempts += 1
+    outbox_message.sent_at = func.now()
+    outbox_message.last_error = None
+    message = outbox_message.message
+    message.whatsapp_message_id = whatsapp_message_id
+    if content is not None:
+        message.content = content
+    if message_type is not None:
+        message.message_type = message_type
+    db.commit()
+    return message
+
+
+def schedule_outbox_retry(db: Session, outbox_id: int, next_attempt_at: datetime, error: str):
+    """Count a failed delivery attempt and push the next one back."""
+    db.query(models.OutboxMessage).filter(models.OutboxMessage.id == outbox_id).update(
+        {
+            models.OutboxMessage.status: "pending",
+            models.OutboxMessage.attempts: models.OutboxMessage.attempts + 1,
+            models.OutboxMessage.next_attempt_at: next_attempt_at,
+            models.OutboxMessage.last_error: error,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
+
+
+def mark_outbox_message_failed(db: Session, outbox_id: int, error: str):
+    """Give up on an outbox row."""
+    db.query(models.OutboxMessage).filter(models.OutboxMessage.id == outbox_id).update(
+        {
+            models.OutboxMessage.status: "failed",
+            models.OutboxMessage.attempts: models.OutboxMessage.attempts + 1,
+            models.OutboxMessage.last_error: error,
+        },
+        synchronize_session=False,
+    )
+    db.commit()
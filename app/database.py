@@ -1,23 +1,110 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    # connect_args is needed only for SQLite
-    connect_args={"check_same_thread": False}
-)
+
+def _require_sqlite(url: str):
+    # Writes rely on SQLite's insert ... on conflict and search on FTS5.
+    if not url.startswith("sqlite"):
+        raise ValueError(f"Only SQLite databases are supported, got {url.split(':', 1)[0]!r}")
+
+
+def configure_sqlite_connection(dbapi_connection, read_only: bool = False):
+    """Apply the storage profile pragmas to a new SQLite connection.
+
+    WAL lets readers run alongside the writer, synchronous=NORMAL is durable
+    across application crashes in WAL mode (only an OS crash can lose the last
+    commits), and busy_timeout makes lock contention wait instead of failing.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        if settings.SQLITE_WAL and not read_only:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cursor.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def build_engine(url: str, read_only: bool = False) -> Engine:
+    """Create the writer engine, or with ``read_only`` the reader pool.
+
+    The writer holds a single connection, so all write transactions are
+    serialized in the pool instead of contending for the database lock;
+    readers get their own pool of query-only connections. Raises ValueError
+    for a database other than SQLite.
+    """
+    _require_sqlite(url)
+    if read_only:
+        pool_options = {"pool_size": settings.SQLITE_READ_POOL_SIZE, "max_overflow": settings.SQLITE_READ_POOL_SIZE}
+    else:
+        pool_options = {"pool_size": 1, "max_overflow": 0}
+    bind = create_engine(
+        url,
+        # connect_args is needed only for SQLite
+        connect_args={"check_same_thread": False},
+        **pool_options,
+    )
+    event.listen(bind, "connect", lambda dbapi_connection, _: configure_sqlite_connection(dbapi_connection, read_only))
+    return bind
+
+
+def build_async_read_engine(url: str) -> AsyncEngine:
+    """Async engine for reads on the event loop (aiosqlite for SQLite).
+
+    Writes are not made through it: they keep going through the single writer.
+    """
+    if settings.ASYNC_DATABASE_URL:
+        url = settings.ASYNC_DATABASE_URL
+    elif url.startswith("sqlite:"):
+        url = "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    _require_sqlite(url)
+    bind = create_async_engine(
+        url,
+        pool_size=settings.SQLITE_READ_POOL_SIZE,
+        max_overflow=settings.SQLITE_READ_POOL_SIZE,
+    )
+    event.listen(
+        bind.sync_engine,
+        "connect",
+        lambda dbapi_connection, _: configure_sqlite_connection(dbapi_connection, read_only=True),
+    )
+    return bind
+
+
+engine = build_engine(settings.DATABASE_URL)
+read_engine = build_engine(settings.DATABASE_URL, read_only=True)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sessions that only read: they never wait for (or hold) the writer connection.
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+async_read_engine = build_async_read_engine(settings.DATABASE_URL)
+AsyncReadSessionLocal = async_sessionmaker(bind=async_read_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 def get_db():
-    db = SessionLocal()
+    """Read-only session for request handlers."""
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+async def get_async_db():
+    """Async read-only session for request handlers running on the event loop."""
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
 def create_db_and_tables():
+    # Creates missing tables only; changes to existing tables are made by
+    # app.migrations.
     Base.metadata.create_all(bind=engine)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDispatcher:
+    """Run per-message work on N lanes sharded by a key (the sender's WhatsApp id).
+
+    Each lane processes its items one at a time, in submission order, so all
+    messages from one user are handled strictly in order while different
+    users are served in parallel on other lanes.
+    """
+
+    def __init__(self, handler: Callable[[Any], Any], lanes: int):
+        self._handler = handler
+        self._lane_count = max(1, lanes)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def lane_for(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self._lane_count
+
+    def submit(self, key: str, item: Any) -> asyncio.Future:
+        """Queue ``item`` on the lane owning ``key``; the future resolves with the handler result.
+
+        Submission is synchronous, so items submitted in order by one coroutine
+        keep that order within their lane.
+        """
+        if not self.running:
+            raise RuntimeError("MessageDispatcher has not been started")
+        future = asyncio.get_running_loop().create_future()
+        self._queues[self.lane_for(key)].put_nowait((item, future))
+        return future
+
+    async def start(self):
+        if self.running:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self._lane_count, thread_name_prefix="message-lane")
+        self._queues = [asyncio.Queue() for _ in range(self._lane_count)]
+        self._tasks = [
+            asyncio.create_task(self._lane(index), name=f"message-lane-{index}")
+            for index in range(self._lane_count)
+        ]
+        logger.info("Started %d message lanes", self._lane_count)
+
+    async def stop(self):
+        if not self.running:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for queue in self._queues:
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("MessageDispatcher stopped"))
+        self._tasks = []
+        self._queues = []
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    async def _lane(self, index: int):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[index]
+        while True:
+            item, future = await queue.get()
+            try:
+                result = await loop.run_in_executor(self._executor, self._handler, item)
+            except Exception as exc:  # pylint: disable=broad-except
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
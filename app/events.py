@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, Optional, Set, Tuple
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+Event = Tuple[str, Dict]
+
+
+class EventHub:
+    """In-process pub/sub fan-out of dashboard events.
+
+    ``publish`` may be called from any thread; events are handed to the event
+    loop and copied into one bounded queue per subscriber. A subscriber that
+    falls ``queue_size`` events behind is dropped rather than buffering without
+    limit or slowing everyone else down: its stream ends with a ``resync``
+    event, after which the client reconnects and reloads what it missed.
+    """
+
+    _CLOSED = object()
+    _OVERFLOW = object()
+
+    def __init__(self, queue_size: int):
+        self._queue_size = max(1, queue_size)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        for queue in list(self._subscribers):
+            self._replace_backlog(queue, self._CLOSED)
+        self._subscribers.clear()
+        self._loop = None
+
+    def publish(self, event: str, data: Dict):
+        """Queue ``event`` for every subscriber. Thread-safe; a no-op before start."""
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._fan_out(event, data)
+        else:
+            loop.call_soon_threadsafe(self._fan_out, event, data)
+
+    @contextmanager
+    def subscription(self) -> Iterator[asyncio.Queue]:
+        """Register a raw subscriber queue for the duration of the block.
+
+        Anything arriving on the queue means "something was published"; it may
+        also be a marker telling the subscriber it was dropped or the hub closed.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(queue)
+
+    async def subscribe(self, keepalive: float) -> AsyncIterator[Optional[Event]]:
+        """Yield events as they are published, or None after ``keepalive`` idle seconds."""
+        with self.subscription() as queue:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if item is self._CLOSED:
+                    return
+                if item is self._OVERFLOW:
+                    yield ("resync", {})
+                    return
+                yield item
+
+    def _fan_out(self, event: str, data: Dict):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                logger.warning("Dropping slow event subscriber (%d events behind)", queue.qsize())
+                self._subscribers.discard(queue)
+                self._replace_backlog(queue, self._OVERFLOW)
+
+    @staticmethod
+    def _replace_backlog(queue: asyncio.Queue, marker: object):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(marker)
+
+
+def format_sse(event: Optional[Event]) -> str:
+    """Encode an event (or a keepalive for None) in the text/event-stream format."""
+    if event is None:
+        return ": keepalive\n\n"
+    name, data = event
+    return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+dashboard_events = EventHub(queue_size=settings.EVENT_SUBSCRIBER_QUEUE_SIZE)
@@ -98,9 +98,12 @@ EMAIL_REGEX = re.compile(r"[A-Za-z0-9_.+-]+@[A-Za-z0-9-]+\.[A-Za-z0-9-.]+")
 
 @dataclass
 class BotMessage:
+    """A bot reply: what to log in the conversation and what to send to Graph."""
+
     content: str
     message_type: str = "text"
-    whatsapp_message_id: Optional[str] = None
+    payload: Optional[Dict] = None
+    fallback_payload: Optional[Dict] = None
 
 
 class FaqService:
@@ -245,59 +248,46 @@ class FaqService:
         return self._send_image(to, image_url, caption)
 
     def _send_text(self, to: str, text: str) -> BotMessage:
-        response = whatsapp_client.send_text_message(to, text)
         return BotMessage(
             content=text,
             message_type="text",
-            whatsapp_message_id=whatsapp_client.extract_message_id(response),
+            payload=whatsapp_client.text_message_payload(to, text),
         )
 
     def _send_reply_buttons(self, to: str, body_text: str, buttons: List[Dict[str, str]]) -> List[BotMessage]:
-        response = whatsapp_client.send_interactive_reply_buttons(to, body_text, buttons)
         formatted = self._format_buttons_message(body_text, buttons)
-
-        if response:
-            return [
-                BotMessage(
-                    content="[Interactive buttons]\n" + formatted,
-                    message_type="interactive",
-                    whatsapp_message_id=whatsapp_client.extract_message_id(response),
-                )
-            ]
-
-        logger.warning("Interactive buttons failed for %s; falling back to text", to)
-        return [self._send_text(to, formatted)]
-
-    def _send_url_button(self, to: str, body_text: str, button_title: str, url: str) -> Optional[BotMessage]:
-        response = whatsapp_client.send_url_button(to, body_text, button_title, url)
-        if response:
-            summary = f"[URL button] {button_title} -> {url}"
-            return BotMessage(
-                content=summary,
+        # If Graph rejects the interactive message, the outbox sends the plain
+        # text version instead.
+        return [
+            BotMessage(
+                content="[Interactive buttons]\n" + formatted,
                 message_type="interactive",
-                whatsapp_message_id=whatsapp_client.extract_message_id(response),
+                payload=whatsapp_client.reply_buttons_payload(to, body_text, buttons),
+                fallback_payload=whatsapp_client.text_message_payload(to, formatted),
             )
-        logger.warning("Failed to send URL button to %s", to)
-        return None
+        ]
+
+    def _send_url_button(self, to: str, body_text: str, button_title: str, url: str) -> Optional[BotMessage]:
+        summary = f"[URL button] {button_title} -> {url}"
+        return BotMessage(
+            content=summary,
+            message_type="interactive",
+            payload=whatsapp_client.url_button_payload(to, body_text, button_title, url),
+        )
 
     def _send_image(self, to: str, image_url: str, caption: Optional[str] = None) -> Optional[BotMessage]:
         if not image_url:
             return None
-        response = whatsapp_client.send_media_message(
-            to=to,
-            media_type="image",
-            media_url=image_url,
-            caption=caption,
+        return BotMessage(
+            content=caption or image_url,
+            message_type="image",
+            payload=whatsapp_client.media_message_payload(
+                to=to,
+                media_type="image",
+                media_url=image_url,
+                caption=caption,
+            ),
         )
-        if response:
-            content = caption or image_url
-            return BotMessage(
-                content=content,
-                message_type="image",
-                whatsapp_message_id=whatsapp_client.extract_message_id(response),
-            )
-        logger.warning("Failed to send image to %s", to)
-        return None
 
     @staticmethod
     def _format_buttons_message(body_text: str, buttons: List[Dict[str, str]]) -> str:
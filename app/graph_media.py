@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import mimetypes
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from . import crud
+from .cache import LRUCache
+from .config import settings
+from .database import ReadSessionLocal, SessionLocal
+from .media import MediaRejected, media_extension
+from .media_store import MediaStore, media_store
+from .whatsapp_client import AsyncWhatsAppClient, async_whatsapp_client
+
+logger = logging.getLogger(__name__)
+
+
+class MediaUnavailable(Exception):
+    """No media id for a link whose fetch or upload failed recently."""
+
+
+class LocalFile(NamedTuple):
+    sha256: str
+    path: str  # blob path in the media store
+    mime_type: str
+
+
+class CachedMediaId(NamedTuple):
+    media_id: str
+    expires_at: datetime
+
+
+class GraphMediaCache:
+    """Graph media ids for outbound files, keyed by the file's SHA-256.
+
+    A media message sent by ``link`` makes Graph fetch the file again for
+    every recipient. Instead each distinct file is uploaded to the /media
+    endpoint once and sent by the returned id until ``ttl`` runs out (Graph
+    keeps uploads for 30 days). Store URLs are uploaded straight from disk;
+    other links are first fetched into the media store, which gives them a
+    hash. Ids are kept in graph_media, with a link -> id LRU in front. A link
+    that could not be fetched or uploaded is not tried again for
+    ``retry_after`` seconds, so its sends go out by link without waiting.
+    """
+
+    def __init__(
+        self,
+        client: AsyncWhatsAppClient,
+        store: MediaStore,
+        ttl: float,
+        cache_size: int,
+        max_bytes: int,
+        chunk_size: int,
+        timeout: float,
+        retry_after: float,
+    ):
+        self._client = client
+        self._store = store
+        self._ttl = timedelta(seconds=ttl)
+        self._links = LRUCache(maxsize=cache_size)
+        self._failures = LRUCache(maxsize=cache_size, ttl=retry_after)
+        self._max_bytes = max_bytes
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._http: Optional[httpx.AsyncClient] = None
+        self._resolving: Dict[str, asyncio.Future] = {}
+
+    async def start(self):
+        if self._http is None:
+            self._http = await self._create_client()
+
+    async def stop(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        self._resolving.clear()
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(timeout=httpx.Timeout(self._timeout), follow_redirects=True)
+
+    async def media_id(self, link: str) -> str:
+        """The Graph media id to send the file at ``link`` by, uploading it if needed.
+
+        Concurrent calls for one link share a single upload. Errors propagate;
+        for a link that failed recently this raises ``MediaUnavailable``.
+        """
+        cached: Optional[CachedMediaId] = self._links.get(link)
+        if cached is not None and cached.expires_at > datetime.utcnow():
+            return cached.media_id
+        failure = self._failures.get(link)
+        if failure is not None:
+            raise MediaUnavailable(f"{link} failed recently: {failure!r}")
+        future = self._resolving.get(link)
+        if future is None:
+            future = asyncio.ensure_future(self._resolve(link))
+            self._resolving[link] = future
+            future.add_done_callback(lambda _: self._resolving.pop(link, None))
+        return await asyncio.shield(future)
+
+    async def forget(self, link: str, media_id: str):
+        """Drop an id Graph refused, so the next send uploads the file again."""
+        self._links.discard(link)
+        await asyncio.to_thread(self._delete, media_id)
+
+    async def _resolve(self, link: str) -> str:
+        try:
+            return await self._upload(link)
+        except Exception as exc:
+            self._failures.set(link, exc)
+            raise
+
+    async def _upload(self, link: str) -> str:
+        local = await asyncio.to_thread(self._local_file, link) or await self._fetch(link)
+        now = datetime.utcnow()
+        known = await asyncio.to_thread(self._find, local.sha256, now)
+        if known is not None:
+            cached = CachedMediaId(known.media_id, known.expires_at)
+        else:
+            media_id = await self._client.upload_media(self._store.file(local.path), local.mime_type)
+            cached = CachedMediaId(media_id, now + self._ttl)
+            await asyncio.to_thread(self._save, local.sha256, cached)
+            logger.info("Uploaded %s to Graph as media %s", local.path, media_id)
+        self._links.set(link, cached)
+        return cached.media_id
+
+    def _local_file(self, link: str) -> Optional[LocalFile]:
+        if not link.startswith(settings.PUBLIC_BASE_URL.rstrip("/") + "/"):
+            return None
+        path = self._store.path_for_url(link)
+        if path is None or not self._store.file(path).exists():
+            return None
+        sha256 = path.rsplit("/", 1)[1].split(".", 1)[0]
+        db = ReadSessionLocal()
+        try:
+            blob = crud.get_media_blob_by_sha256(db, sha256)
+        finally:
+            db.close()
+        mime_type = (blob.mime_type if blob else None) or mimetypes.guess_type(path)[0]
+        return LocalFile(sha256, path, mime_type or "application/octet-stream")
+
+    async def _fetch(self, link: str) -> LocalFile:
+        """Download a file from elsewhere into the media store."""
+        async with self._store.writer() as blob:
+            async with self._http.stream("GET", link) as response:
+                response.raise_for_status()
+                mime_type = response.headers.get("content-type", "").split(";")[0].strip()
+                async for chunk in response.aiter_bytes(self._chunk_size):
+                    if blob.size + len(chunk) > self._max_bytes:
+                        raise MediaRejected(f"{link} exceeds the {self._max_bytes} byte limit")
+                    await blob.write(chunk)
+            known = await asyncio.to_thread(self._find_blob, blob.sha256)
+            if known is not None:
+                return LocalFile(known.sha256, known.path, known.mime_type or mime_type)
+            stored = await self._store.commit(blob, media_extension(mime_type, urlsplit(link).path))
+        await asyncio.to_thread(self._add_blob, stored.sha256, stored.path, stored.size, mime_type or None)
+        return LocalFile(stored.sha256, stored.path, mime_type or "application/octet-stream")
+
+    def _find(self, sha256: str, now: datetime):
+        db = ReadSessionLocal()
+        try:
+            return crud.get_graph_media(db, self._client.phone_number_id, sha256, now)
+        finally:
+            db.close()
+
+    def _save(self, sha256: str, cached: CachedMediaId):
+        db = SessionLocal()
+        try:
+            crud.save_graph_media(db, self._client.phone_number_id, sha256, cached.media_id, cached.expires_at)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _delete(media_id: str):
+        db = SessionLocal()
+        try:
+            crud.delete_graph_media(db, media_id)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _find_blob(sha256: str):
+        db = ReadSessionLocal()
+        try:
+            return crud.get_media_blob_by_sha256(db, sha256)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _add_blob(sha256: str, path: str, size: int, mime_type: Optional[str]) -> int:
+        db = SessionLocal()
+        try:
+            return crud.add_media_blob(db, sha256, path, size, mime_type)
+        finally:
+            db.close()
+
+
+graph_media_cache = GraphMediaCache(
+    client=async_whatsapp_client,
+    store=media_store,
+    ttl=settings.GRAPH_MEDIA_TTL,
+    cache_size=settings.GRAPH_MEDIA_CACHE_SIZE,
+    max_bytes=settings.MEDIA_MAX_BYTES,
+    chunk_size=settings.MEDIA_CHUNK_SIZE,
+    timeout=settings.GRAPH_MEDIA_FETCH_TIMEOUT,
+    retry_after=settings.GRAPH_MEDIA_RETRY_AFTER,
+)
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from . import crud
+from .database import ReadSessionLocal, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookInbox:
+    """Durable, append-only log of raw webhook bodies.
+
+    ``append`` resolves once the body is committed, so the webhook can ack
+    only after the payload is safe on disk. ``finish`` records that an entry
+    was processed (or failed). Appends and finish marks arriving while a commit
+    is in flight are written together in the next transaction (group commit),
+    so a burst costs one fsync per batch rather than two per request.
+    """
+
+    def __init__(self, max_batch: int = 256):
+        self._max_batch = max_batch
+        self._pending: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._flusher is not None
+
+    async def start(self):
+        if self.running:
+            return
+        self._pending = asyncio.Queue()
+        self._flusher = asyncio.create_task(self._flush_loop(), name="webhook-inbox-flusher")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        self._flusher = None
+        # Write what was already queued so finish marks are not lost to a replay.
+        batch = []
+        while not self._pending.empty():
+            batch.append(self._pending.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    async def append(self, payload: bytes) -> int:
+        """Persist a raw webhook body and return its inbox entry id."""
+        if not self.running:
+            raise RuntimeError("WebhookInbox has not been started")
+        return await self._submit(payload, None)
+
+    async def finish(self, entry_id: int, error: Optional[BaseException] = None):
+        """Mark an entry processed, or count a failed attempt when ``error`` is set."""
+        mark = (entry_id, None if error is None else repr(error))
+        if not self.running:
+            await asyncio.to_thread(self._write_batch, [], [mark])
+            return
+        await self._submit(None, mark)
+
+    async def _submit(self, payload: Optional[bytes], mark: Optional[Tuple[int, Optional[str]]]):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((payload, mark, future))
+        return await future
+
+    async def _flush_loop(self):
+        while True:
+            batch = [await self._pending.get()]
+            while len(batch) < self._max_batch and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[tuple]):
+        payloads = [payload for payload, mark, _ in batch if mark is None]
+        marks = [mark for _, mark, _ in batch if mark is not None]
+        try:
+            entry_ids = iter(await asyncio.to_thread(self._write_batch, payloads, marks))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Failed to persist %d webhook inbox writes: %s", len(batch), exc)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for _, mark, future in batch:
+            result = next(entry_ids) if mark is None else None
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _write_batch(payloads: List[bytes], marks: List[Tuple[int, Optional[str]]]) -> List[int]:
+        db = SessionLocal()
+        try:
+            return crud.write_inbox_batch(db, payloads, marks)
+        finally:
+            db.close()
+
+
+def load_unprocessed(max_attempts: int) -> List[Tuple[int, bytes]]:
+    db = ReadSessionLocal()
+    try:
+        return [(row.id, row.payload) for row in crud.get_unprocessed_inbox_entries(db, max_attempts)]
+    finally:
+        db.close()
+
+
+def prune_processed(retention_days: int) -> int:
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        return crud.delete_processed_inbox_entries(db, older_than=cutoff)
+    finally:
+        db.close()
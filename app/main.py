@@ -1,9 +1,17 @@
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from app.database import create_db_and_tables
+from app.database import async_read_engine, create_db_and_tables, engine
 
 from . import models
+from .events import dashboard_events
+from .graph_media import graph_media_cache
+from .media import media_ingestion
+from .message_writer import message_writer
+from .migrations import run_migrations
+from .outbox import outbox_delivery
 from .routers import webhook, dashboard
+from .thumbnails import thumbnail_pipeline
+from .whatsapp_client import graph_pool
 
 app = FastAPI()
 
@@ -15,6 +23,35 @@ app.include_router(dashboard.router)
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    run_migrations(engine)
+
+@app.on_event("startup")
+async def start_background_workers():
+    await dashboard_events.start()
+    message_writer.start()
+    await graph_media_cache.start()
+    await outbox_delivery.start()
+    await media_ingestion.start()
+    await thumbnail_pipeline.start()
+    await webhook.start_background_processing()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await webhook.stop_background_processing()
+    await thumbnail_pipeline.stop()
+    await media_ingestion.stop()
+    await outbox_delivery.stop()
+    await graph_media_cache.stop()
+    message_writer.stop()
+    await dashboard_events.stop()
+
+@app.on_event("shutdown")
+def close_graph_pool():
+    graph_pool.close()
+
+@app.on_event("shutdown")
+async def close_database():
+    await async_read_engine.dispose()
 
 @app.get("/", include_in_schema=False)
 async def root():
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import mimetypes
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional, Set
+
+import httpx
+
+from . import crud, models
+from .circuit_breaker import RetryPolicy
+from .config import settings
+from .database import ReadSessionLocal, SessionLocal
+from .events import EventHub, dashboard_events
+from .media_store import MediaStore, StoredBlob, media_store
+from .thumbnails import thumbnail_pipeline
+from .whatsapp_client import whatsapp_client
+
+logger = logging.getLogger(__name__)
+
+MEDIA_TYPES = ("image", "document", "audio", "video", "sticker")
+
+# Preferred extensions where mimetypes' first guess is unusual (e.g. .jpe).
+_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "audio/ogg": ".ogg",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+    "audio/aac": ".aac",
+    "audio/amr": ".amr",
+    "video/mp4": ".mp4",
+    "video/3gpp": ".3gp",
+    "text/plain": ".txt",
+}
+_SAFE_EXTENSION = re.compile(r"^\.[a-z0-9]{1,8}$")
+
+
+class MediaRejected(Exception):
+    """A download that cannot succeed on retry (too large, no URL)."""
+
+
+class PendingDownload(NamedTuple):
+    id: int
+    message_id: int
+    user_id: int
+    media_id: str
+    media_type: str
+    filename: Optional[str]
+    attempts: int
+    next_attempt_at: Optional[datetime]
+
+
+def media_extension(mime_type: Optional[str], filename: Optional[str] = None) -> str:
+    """File extension for a Graph ``mime_type``, else the sender's file name, else ``.bin``."""
+    mime = (mime_type or "").split(";")[0].strip().lower()
+    extension = _EXTENSIONS.get(mime) or (mimetypes.guess_extension(mime) if mime else None)
+    if not extension and filename:
+        extension = os.path.splitext(filename)[1].lower()
+    return extension if extension and _SAFE_EXTENSION.match(extension) else ".bin"
+
+
+def media_placeholder(media_type: str, state: str) -> str:
+    return f"[{media_type.capitalize()} {state}]"
+
+
+class StoredMedia(NamedTuple):
+    url: str
+    blob_id: int
+
+
+class MediaIngestion:
+    """Background download of inbound media into the media store.
+
+    The webhook stores a placeholder message and a media_downloads row in the
+    same transaction; this worker resolves the Graph media URL, streams the
+    file into ``store`` in chunks (never holding it in memory) and then points
+    the message at the stored blob. At most ``workers`` downloads run at once and
+    files over ``max_bytes`` are refused. Transient failures are retried with
+    backoff; completions are announced on ``events`` as ``message.updated``.
+    A row is claimed (status "downloading") before its download, so one
+    loaded twice is still fetched once; rows left in progress by a stop or
+    crash are queued again at start.
+    """
+
+    def __init__(
+        self,
+        store: MediaStore,
+        workers: int,
+        max_bytes: int,
+        chunk_size: int,
+        timeout: float,
+        batch_size: int,
+        poll_interval: float,
+        max_attempts: int,
+        retry_policy: RetryPolicy,
+        events: Optional[EventHub] = None,
+    ):
+        self._store = store
+        self._workers = max(1, workers)
+        self._max_bytes = max_bytes
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._retry_policy = retry_policy
+        self._events = events
+        self._headers = {"Authorization": f"Bearer {settings.WHATSAPP_TOKEN}"}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._downloads: Set[asyncio.Task] = set()
+        self._busy: Set[int] = set()
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def notify(self):
+        """Wake the worker after new downloads were committed. Thread-safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        if self.running:
+            return
+        released = await asyncio.to_thread(self._release, None)
+        if released:
+            logger.warning("Returned %d media downloads left in progress to the queue", released)
+        self._client = await self._create_client()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self._workers)
+        self._runner = asyncio.create_task(self._run(), name="media-ingestion")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._runner.cancel()
+        for task in list(self._downloads):
+            task.cancel()
+        await asyncio.gather(self._runner, *self._downloads, return_exceptions=True)
+        await asyncio.to_thread(self._release, None)
+        await self._client.aclose()
+        self._runner = None
+        self._client = None
+        self._downloads.clear()
+        self._busy.clear()
+        self._loop = None
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(self._timeout),
+            limits=httpx.Limits(max_connections=self._workers),
+            follow_redirects=True,
+        )
+
+    async def _run(self):
+        while True:
+            try:
+                await self._dispatch_due()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("Media dispatch failed: %s", exc)
+            # asyncio.wait, unlike wait_for, never drops the cancellation from stop().
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({wakeup}, timeout=self._poll_interval)
+            finally:
+                wakeup.cancel()
+            self._wakeup.clear()
+
+    async def _dispatch_due(self):
+        # Only due rows are loaded, so downloads backing off never fill the batch.
+        pending = await asyncio.to_thread(self._load_pending)
+        for download in pending:
+            if download.id in self._busy:
+                continue
+            self._busy.add(download.id)
+            task = asyncio.create_task(self._ingest(download))
+            self._downloads.add(task)
+            task.add_done_callback(self._downloads.discard)
+
+    async def _ingest(self, download: PendingDownload):
+        try:
+            async with self._semaphore:
+                # The list may predate a download that finished since; only a
+                # row still pending with the same attempt count is ours.
+                if not await asyncio.to_thread(self._claim, download.id, download.attempts):
+                    return
+                try:
+                    media = await self._download(download)
+                except MediaRejected as exc:
+                    await self._fail(download, str(exc))
+                except httpx.HTTPStatusError as exc:
+                    error = f"HTTP {exc.response.status_code} from {exc.request.url.host}"
+                    if self._retry_policy.is_retryable_status(exc.response.status_code):
+                        await self._retry_later(download, error)
+                    else:
+                        await self._fail(download, error)
+                except (httpx.HTTPError, OSError) as exc:
+                    await self._retry_later(download, repr(exc))
+                except Exception:
+                    await asyncio.to_thread(self._release, download.id)
+                    raise
+                else:
+                    await asyncio.to_thread(self._finish, download.id, media.url, None, media.blob_id)
+                    self._announce(download)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Media download %s failed: %s", download.id, exc)
+        finally:
+            self._busy.discard(download.id)
+
+    async def _download(self, download: PendingDownload) -> StoredMedia:
+        """Stream the media into the store (unless it is already there) and return it."""
+        response = await self._client.get(
+            f"https://graph.facebook.com/{whatsapp_client.API_VERSION}/{download.media_id}",
+            headers=self._headers,
+        )
+        response.raise_for_status()
+        info: Dict = response.json()
+        url = info.get("url")
+        if not url:
+            raise MediaRejected("Graph returned no media URL")
+        declared_size = int(info.get("file_size") or 0)
+        if declared_size > self._max_bytes:
+            raise MediaRejected(f"Media is {declared_size} bytes; the limit is {self._max_bytes}")
+
+        # Graph reports the file's SHA-256, so media we already hold (forwarded
+        # files, stickers) is not fetched again.
+        known = await asyncio.to_thread(self._find_blob, (info.get("sha256") or "").lower())
+        if known is not None:
+            logger.info("Reusing stored %s for %s %s", known.path, download.media_type, download.media_id)
+            return StoredMedia(self._store.url(known.path), known.id)
+
+        mime_type = info.get("mime_type")
+        async with self._store.writer() as blob:
+            async with self._client.stream("GET", url, headers=self._headers) as stream:
+                stream.raise_for_status()
+                async for chunk in stream.aiter_bytes(self._chunk_size):
+                    if blob.size + len(chunk) > self._max_bytes:
+                        raise MediaRejected(f"Media exceeds the {self._max_bytes} byte limit")
+                    await blob.write(chunk)
+            known = await asyncio.to_thread(self._find_blob, blob.sha256)
+            if known is not None:
+                logger.info("Downloaded %s %s is already stored as %s", download.media_type, download.media_id, known.path)
+                return StoredMedia(self._store.url(known.path), known.id)
+            stored = await self._store.commit(blob, media_extension(mime_type, download.filename))
+        blob_id = await asyncio.to_thread(self._add_blob, stored, mime_type)
+        thumbnail_pipeline.notify()
+        logger.info("Stored %s %s (%d bytes) as %s", download.media_type, download.media_id, stored.size, stored.path)
+        return StoredMedia(self._store.url(stored.path), blob_id)
+
+    async def _retry_later(self, download: PendingDownload, error: str):
+        attempts = download.attempts + 1
+        if attempts >= self._max_attempts:
+            await self._fail(download, error)
+            return
+        delay = self._retry_policy.backoff(download.attempts)
+        logger.warning("Media download %s failed (%s); retrying in %.1fs", download.id, error, delay)
+        next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        await asyncio.to_thread(self._schedule_retry, download.id, next_attempt_at, error)
+
+    async def _fail(self, download: PendingDownload, error: str):
+        logger.error("Giving up on media download %s: %s", download.id, error)
+        await asyncio.to_thread(
+            self._finish, download.id, media_placeholder(download.media_type, "download failed"), error, None
+        )
+        self._announce(download)
+
+    def _announce(self, download: PendingDownload):
+        if self._events is not None:
+            self._events.publish(
+                "message.updated",
+                {"id": download.message_id, "user_id": download.user_id, "message_type": download.media_type},
+            )
+
+    def _load_pending(self):
+        db = ReadSessionLocal()
+        try:
+            return [
+                PendingDownload(
+                    id=download.id,
+                    message_id=download.message_id,
+                    user_id=user_id,
+                    media_id=download.media_id,
+                    media_type=download.media_type,
+                    filename=download.filename,
+                    attempts=download.attempts,
+                    next_attempt_at=download.next_attempt_at,
+                )
+                for download, user_id in crud.get_pending_media_downloads(
+                    db, limit=self._batch_size, now=datetime.utcnow()
+                )
+            ]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _find_blob(sha256: str) -> Optional[models.MediaBlob]:
+        if not sha256:
+            return None
+        db = ReadSessionLocal()
+        try:
+            return crud.get_media_blob_by_sha256(db, sha256)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _add_blob(stored: StoredBlob, mime_type: Optional[str]) -> int:
+        db = SessionLocal()
+        try:
+            return crud.add_media_blob(db, stored.sha256, stored.path, stored.size, mime_type)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _claim(download_id: int, attempts: int) -> bool:
+        db = SessionLocal()
+        try:
+            return crud.claim_media_download(db, download_id, attempts)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _release(download_id: Optional[int]) -> int:
+        db = SessionLocal()
+        try:
+            return crud.release_media_downloads(db, download_id)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _finish(download_id: int, content: str, error: Optional[str], blob_id: Optional[int]):
+        db = SessionLocal()
+        try:
+            crud.finish_media_download(db, download_id, content, error, blob_id)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _schedule_retry(download_id: int, next_attempt_at: datetime, error: str):
+        db = SessionLocal()
+        try:
+            crud.schedule_media_download_retry(db, download_id, next_attempt_at, error)
+        finally:
+            db.close()
+
+
+media_ingestion = MediaIngestion(
+    store=media_store,
+    workers=settings.MEDIA_WORKERS,
+    max_bytes=settings.MEDIA_MAX_BYTES,
+    chunk_size=settings.MEDIA_CHUNK_SIZE,
+    timeout=settings.MEDIA_DOWNLOAD_TIMEOUT,
+    batch_size=settings.MEDIA_BATCH_SIZE,
+    poll_interval=settings.MEDIA_POLL_INTERVAL,
+    max_attempts=settings.MEDIA_MAX_ATTEMPTS,
+    retry_policy=RetryPolicy(
+        max_retries=settings.MEDIA_MAX_ATTEMPTS,
+        base_delay=settings.MEDIA_RETRY_BASE_DELAY,
+        max_delay=settings.MEDIA_RETRY_MAX_DELAY,
+    ),
+    events=dashboard_events,
+)
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+_BLOB_PATH = re.compile(r"^([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(\.[a-z0-9]{1,8})?$")
+
+
+class StoredBlob(NamedTuple):
+    sha256: str
+    path: str  # relative to the store root, e.g. "ab/cd/abcd....jpg"
+    size: int
+
+
+class BlobWriter:
+    """A blob being written: bytes go to a temporary file and are hashed on the way."""
+
+    def __init__(self, file, temp_path: Path):
+        self._file = file
+        self._hash = hashlib.sha256()
+        self.temp_path = temp_path
+        self.size = 0
+
+    async def write(self, chunk: bytes):
+        await self._file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+
+class MediaStore:
+    """Content-addressed file store: each distinct file is kept once, named by its SHA-256.
+
+    Blobs live at ``<root>/ab/cd/<sha256><extension>`` and are served under
+    ``url_prefix``. Writing a blob that is already stored costs only the
+    temporary copy; the existing file is kept. The media_blobs table records
+    each stored file and how many messages reference it.
+    """
+
+    def __init__(self, root: Path, url_prefix: str):
+        self._root = root
+        self._temp_dir = root / "tmp"
+        self._url_prefix = url_prefix.rstrip("/")
+
+    def url(self, path: str) -> str:
+        return f"{self._url_prefix}/{path}"
+
+    def file(self, path: str) -> Path:
+        return self._root / path
+
+    def path_for_url(self, url: str) -> Optional[str]:
+        """The blob path behind a store URL (relative or absolute), or None for any other URL."""
+        path = urlsplit(url).path
+        if not path.startswith(self._url_prefix + "/"):
+            return None
+        path = path[len(self._url_prefix) + 1 :]
+        return path if _BLOB_PATH.match(path) else None
+
+    @staticmethod
+    def blob_path(sha256: str, extension: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+    @staticmethod
+    def thumbnail_path(sha256: str, extension: str) -> str:
+        return f"thumbs/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+    def temp_file(self) -> Path:
+        """Create an empty temporary file next to the blobs (so committing it is a rename)."""
+        self._temp_dir.mkdir(parents=True, exist_ok=True)
+        descriptor, name = tempfile.mkstemp(dir=self._temp_dir, suffix=".part")
+        os.close(descriptor)
+        return Path(name)
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[BlobWriter]:
+        """Yield a writer to stream a blob into; ``commit`` it before the block ends.
+
+        Whatever was not committed (an error, a rejected file) is discarded.
+        """
+        temp_path = self.temp_file()
+        try:
+            async with aiofiles.open(temp_path, "wb") as output:
+                yield BlobWriter(output, temp_path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    async def commit(self, blob: BlobWriter, extension: str) -> StoredBlob:
+        """Move a fully written blob to its content address (unless already stored)."""
+        path = self.blob_path(blob.sha256, extension)
+        await asyncio.to_thread(self._place, blob.temp_path, self._root / path)
+        return StoredBlob(sha256=blob.sha256, path=path, size=blob.size)
+
+    def store_file(self, source: Path) -> StoredBlob:
+        """Copy an existing file into the store (blocking; for migrations and scripts)."""
+        digest = hashlib.sha256()
+        temp_path = self.temp_file()
+        try:
+            with open(source, "rb") as input_file, open(temp_path, "wb") as output:
+                for chunk in iter(lambda: input_file.read(1 << 16), b""):
+                    digest.update(chunk)
+                    output.write(chunk)
+            path = self.blob_path(digest.hexdigest(), source.suffix.lower())
+            self._place(temp_path, self._root / path)
+            return StoredBlob(sha256=digest.hexdigest(), path=path, size=source.stat().st_size)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _place(temp_path: Path, destination: Path):
+        if destination.exists():
+            logger.debug("Blob %s already stored", destination.name)
+            return
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # The temp file lives on the same filesystem, so this is an atomic rename.
+        os.replace(temp_path, destination)
+
+
+media_store = MediaStore(root=Path("app/static/media"), url_prefix="/static/media")
@@ -0,0 +1,379 @@
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from . import crud, models, schemas
+from .cache import LRUCache
+from .config import settings
+from .database import engine
+from .events import EventHub, dashboard_events
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingMessage:
+    message: schemas.MessageCreate
+    # Set (with ``payload``) when the message must also be delivered via the outbox.
+    recipient: Optional[str] = None
+    payload: Optional[Dict] = None
+    fallback_payload: Optional[Dict] = None
+    # Store the text once in message_bodies and reference it (bot replies).
+    intern: bool = False
+    # Queue a media download for this message: media_id, media_type, filename.
+    media: Optional[Dict] = None
+    # Stored media file the message carries (media_blobs.id).
+    blob_id: Optional[int] = None
+
+
+@dataclass
+class MessageWrite:
+    """Message rows that must be committed together (one inbound turn or one dashboard send).
+
+    If the first message carries a ``whatsapp_message_id`` it acts as the
+    write's idempotency claim: when that id is already stored the whole write
+    is skipped and reported as a duplicate.
+    """
+
+    user_id: int
+    messages: List[PendingMessage] = field(default_factory=list)
+
+    def add(
+        self,
+        message: schemas.MessageCreate,
+        recipient: Optional[str] = None,
+        payload: Optional[Dict] = None,
+        fallback_payload: Optional[Dict] = None,
+        intern: bool = False,
+        media: Optional[Dict] = None,
+        blob_id: Optional[int] = None,
+    ):
+        self.messages.append(PendingMessage(message, recipient, payload, fallback_payload, intern, media, blob_id))
+
+    @property
+    def has_media(self) -> bool:
+        return any(pending.media for pending in self.messages)
+
+    def __bool__(self) -> bool:
+        return bool(self.messages)
+
+
+@dataclass
+class WriteResult:
+    message_ids: List[int]
+    # True when the write's inbound message was already stored; nothing was written.
+    duplicate: bool = False
+
+
+class MessageWriter:
+    """Group-commit writer for message and outbox rows.
+
+    Writes submitted from any thread are gathered for up to ``max_delay``
+    seconds (or ``max_batch`` writes) and flushed by a dedicated thread in one
+    transaction, using one bulk insert for all message rows and one each for
+    the outbox and media download rows, plus one upsert of the affected
+    conversation summaries. Each caller gets a future resolving to its row
+    ids. If the batch violates a constraint, its writes are retried one
+    transaction each so a single bad write cannot fail the others. Committed
+    rows are announced on ``events`` as ``message.created``.
+
+    Messages added with ``intern`` (and at least
+    ``MESSAGE_BODY_INTERN_MIN_LENGTH`` characters) reference a shared
+    message_bodies row instead of storing their text again.
+    """
+
+    _STOP = object()
+
+    def __init__(self, bind: Engine, max_batch: int, max_delay: float, events: Optional[EventHub] = None):
+        self._engine = bind
+        self._events = events
+        self._max_batch = max(1, max_batch)
+        self._max_delay = max_delay
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        # SHA-256 of an interned text -> message_bodies id; only committed ids.
+        self._body_ids = LRUCache(maxsize=settings.MESSAGE_BODY_CACHE_SIZE)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, write: MessageWrite) -> Future:
+        future: Future = Future()
+        if not self.running:
+            # No writer thread (scripts, shutdown): write inline.
+            self._flush([(write, future)])
+        else:
+            self._queue.put((write, future))
+        return future
+
+    def write(self, write: MessageWrite) -> WriteResult:
+        """Submit ``write`` and block until it is committed."""
+        return self.submit(write).result()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[MessageWrite, Future]]):
+        bodies: Dict[str, int] = {}
+        try:
+            bodies = self._intern_bodies([write for write, _ in batch])
+            with self._engine.begin() as connection:
+                results = self._insert(connection, [write for write, _ in batch], bodies)
+        except IntegrityError as exc:
+            if len(batch) == 1:
+                batch[0][1].set_exception(exc)
+                return
+            logger.warning("Message batch of %d hit a constraint; writing individually", len(batch))
+            self._flush_each(batch, bodies)
+            return
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Failed to write message batch: %s", exc)
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+        for (write, future), result in zip(batch, results):
+            future.set_result(result)
+            self._publish(write, result)
+
+    def _flush_each(self, batch: List[Tuple[MessageWrite, Future]], bodies: Dict[str, int]):
+        for write, future in batch:
+            try:
+                with self._engine.begin() as connection:
+                    result = self._insert(connection, [write], bodies)[0]
+            except Exception as exc:  # pylint: disable=broad-except
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+                self._publish(write, result)
+
+    def _intern_bodies(self, writes: List[MessageWrite]) -> Dict[str, int]:
+        """Map each text to intern in ``writes`` to its message_bodies id.
+
+        New texts are inserted in their own transaction ahead of the batch, so
+        the cache never holds an id that a rolled-back batch could free.
+        """
+        bodies: Dict[str, int] = {}
+        missing: Dict[bytes, str] = {}
+        for write in writes:
+            for pending in write.messages:
+                content = pending.message.content
+                if not pending.intern or content in bodies or len(content) < settings.MESSAGE_BODY_INTERN_MIN_LENGTH:
+                    continue
+                content_hash = hashlib.sha256(content.encode("utf-8")).digest()
+                body_id = self._body_ids.get(content_hash)
+                if body_id is None:
+                    missing[content_hash] = content
+                else:
+                    bodies[content] = body_id
+        if not missing:
+            return bodies
+        body = models.MessageBody
+        with self._engine.begin() as connection:
+            connection.execute(
+                sqlite_insert(body).on_conflict_do_nothing(index_elements=[body.content_hash]),
+                [{"content_hash": content_hash, "content": content} for content_hash, content in missing.items()],
+            )
+            rows = connection.execute(
+                select(body.id, body.content_hash).where(body.content_hash.in_(list(missing)))
+            ).all()
+        for row in rows:
+            self._body_ids.set(row.content_hash, row.id)
+            bodies[missing[row.content_hash]] = row.id
+        return bodies
+
+    def _publish(self, write: MessageWrite, result: WriteResult):
+        if self._events is None:
+            return
+        for pending, message_id in zip(write.messages, result.message_ids):
+            self._events.publish(
+                "message.created",
+                {
+                    "id": message_id,
+                    "user_id": write.user_id,
+                    "direction": pending.message.direction,
+                    "message_type": pending.message.message_type,
+                },
+            )
+
+    @staticmethod
+    def _insert(connection: Connection, writes: List[MessageWrite], bodies: Dict[str, int]) -> List[WriteResult]:
+        # Claim inbound WhatsApp ids first. ON CONFLICT DO NOTHING leaves ids
+        # that are already stored (or repeated within this batch) out of the
+        # RETURNING rows, which marks those writes as duplicates.
+        claim_rows = [
+            MessageWriter._message_row(write, write.messages[0], bodies)
+            for write in writes
+            if write.messages and write.messages[0].message.whatsapp_message_id
+        ]
+        claimed: Dict[str, int] = {}
+        if claim_rows:
+            claim_statement = (
+                sqlite_insert(models.Message)
+                .on_conflict_do_nothing(index_elements=[models.Message.whatsapp_message_id])
+                .returning(models.Message.id, models.Message.whatsapp_message_id)
+            )
+            claimed = {row.whatsapp_message_id: row.id for row in connection.execute(claim_statement, claim_rows)}
+
+        claim_ids: List[Optional[int]] = []
+        message_rows = []
+        for write in writes:
+            claim_id = None
+            remaining = write.messages
+            if write.messages and write.messages[0].message.whatsapp_message_id:
+                claim_id = claimed.pop(write.messages[0].message.whatsapp_message_id, None)
+                if claim_id is None:
+                    claim_ids.append(None)
+                    continue
+                remaining = write.messages[1:]
+            claim_ids.append(claim_id)
+            message_rows.extend(MessageWriter._message_row(write, pending, bodies) for pending in remaining)
+
+        message_ids: List[int] = []
+        if message_rows:
+            message_ids = connection.execute(
+                insert(models.Message).returning(models.Message.id, sort_by_parameter_order=True),
+                message_rows,
+            ).scalars().all()
+
+        results: List[WriteResult] = []
+        outbox_rows = []
+        media_rows = []
+        position = 0
+        for write, claim_id in zip(writes, claim_ids):
+            is_claim = bool(write.messages and write.messages[0].message.whatsapp_message_id)
+            if is_claim and claim_id is None:
+                results.append(WriteResult(message_ids=[], duplicate=True))
+                continue
+            count = len(write.messages) - (1 if is_claim else 0)
+            write_ids = ([claim_id] if is_claim else []) + list(message_ids[position:position + count])
+            position += count
+            results.append(WriteResult(message_ids=write_ids))
+            for pending, message_id in zip(write.messages, write_ids):
+                if pending.media:
+                    media_rows.append(dict(pending.media, message_id=message_id, status="pending", attempts=0))
+                if pending.payload is None:
+                    continue
+                outbox_rows.append(
+                    {
+                        "message_id": message_id,
+                        "recipient": pending.recipient,
+                        "payload": json.dumps(pending.payload, ensure_ascii=False),
+                        "fallback_payload": (
+                            json.dumps(pending.fallback_payload, ensure_ascii=False)
+                            if pending.fallback_payload
+                            else None
+                        ),
+                        "status": "pending",
+                        "attempts": 0,
+                    }
+                )
+        if outbox_rows:
+            connection.execute(insert(models.OutboxMessage), outbox_rows)
+        if media_rows:
+            connection.execute(insert(models.MediaDownload), media_rows)
+        MessageWriter._update_conversations(connection, writes, results)
+        return results
+
+    @staticmethod
+    def _message_row(write: MessageWrite, pending: PendingMessage, bodies: Dict[str, int]) -> Dict:
+        message = pending.message
+        row = {
+            "user_id": write.user_id,
+            "content": message.content,
+            "direction": message.direction,
+            "message_type": message.message_type,
+            "whatsapp_message_id": message.whatsapp_message_id,
+            "body_id": None,
+            "blob_id": pending.blob_id,
+        }
+        body_id = bodies.get(row["content"]) if pending.intern else None
+        if body_id is not None:
+            row.update(content="", body_id=body_id)
+        return row
+
+    @staticmethod
+    def _update_conversations(connection: Connection, writes: List[MessageWrite], results: List[WriteResult]):
+        summaries: Dict[int, Dict] = {}
+        for write, result in zip(writes, results):
+            for pending, message_id in zip(write.messages, result.message_ids):
+                message = pending.message
+                summary = summaries.setdefault(
+                    write.user_id,
+                    {"user_id": write.user_id, "unread_count": 0, "last_inbound_at": None},
+                )
+                if message.direction == "incoming":
+                    summary["unread_count"] += 1
+                    summary["last_inbound_at"] = func.now()
+                if message_id > summary.get("last_message_id", 0):
+                    summary.update(
+                        last_message_id=message_id,
+                        last_message_at=func.now(),
+                        last_preview=crud.conversation_preview(message.content, message.message_type),
+                        last_direction=message.direction,
+                    )
+        if not summaries:
+            return
+        conversation = models.Conversation.__table__
+        statement = sqlite_insert(conversation).values(list(summaries.values()))
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[conversation.c.user_id],
+            set_={
+                "last_message_id": excluded.last_message_id,
+                "last_message_at": excluded.last_message_at,
+                "last_preview": excluded.last_preview,
+                "last_direction": excluded.last_direction,
+                "unread_count": conversation.c.unread_count + excluded.unread_count,
+                "last_inbound_at": func.coalesce(excluded.last_inbound_at, conversation.c.last_inbound_at),
+            },
+        )
+        connection.execute(statement)
+
+
+message_writer = MessageWriter(
+    engine,
+    max_batch=settings.MESSAGE_WRITER_MAX_BATCH,
+    max_delay=settings.MESSAGE_WRITER_MAX_DELAY_MS / 1000,
+    events=dashboard_events,
+)
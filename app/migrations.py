@@ -0,0 +1,351 @@
+import logging
+import hashlib
+import mimetypes
+from pathlib import Path
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+from . import crud
+from .config import settings
+from .media_store import media_store
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = Path("app/static")
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    """Register a schema step. Steps run once each, in version order.
+
+    ``create_all`` builds new databases from the models, so a step must be a
+    no-op when its change is already present (e.g. ``IF NOT EXISTS``).
+    """
+
+    def register(apply: Callable[[Connection], None]):
+        MIGRATIONS.append(Migration(version, description, apply))
+        MIGRATIONS.sort(key=lambda step: step.version)
+        return apply
+
+    return register
+
+
+@migration(1, "composite indexes for conversation history and the outbox")
+def _history_indexes(connection: Connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_user_id_id ON messages (user_id, id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_outbox_status_id ON outbox (status, id)"))
+
+
+@migration(2, "recency index and backfill for conversation summaries")
+def _conversations(connection: Connection):
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_conversations_last_message_id ON conversations (last_message_id)")
+    )
+    # Plain SQL over the columns messages had at this version: the models
+    # describe the latest schema, which an older database does not have yet.
+    if connection.execute(text("SELECT 1 FROM conversations LIMIT 1")).first() is not None:
+        return
+    rows = connection.execute(
+        text(
+            "SELECT m.user_id, m.id, m.timestamp, m.content, m.message_type, m.direction, "
+            "(SELECT MAX(i.timestamp) FROM messages AS i WHERE i.user_id = m.user_id AND i.direction = 'incoming') "
+            "FROM messages AS m WHERE m.id IN (SELECT MAX(id) FROM messages GROUP BY user_id)"
+        )
+    ).all()
+    if not rows:
+        return
+    connection.execute(
+        text(
+            "INSERT INTO conversations (user_id, last_message_id, last_message_at, last_preview, "
+            "last_direction, unread_count, last_inbound_at) VALUES (:user_id, :last_message_id, "
+            ":last_message_at, :last_preview, :last_direction, 0, :last_inbound_at)"
+        ),
+        [
+            {
+                "user_id": user_id,
+                "last_message_id": message_id,
+                "last_message_at": timestamp,
+                "last_preview": crud.conversation_preview(content, message_type),
+                "last_direction": direction,
+                "last_inbound_at": received_at,
+            }
+            for user_id, message_id, timestamp, content, message_type, direction, received_at in rows
+        ],
+    )
+    logger.info("Backfilled %d conversation summaries", len(rows))
+
+
+# Media rows store an upload URL as content, so only text-like rows are indexed.
+_SEARCHABLE = "message_type NOT IN ('image', 'document', 'audio', 'video', 'sticker')"
+_SEARCH_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN new.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN old.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update_old AFTER UPDATE OF content, message_type ON messages
+        WHEN old.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update_new AFTER UPDATE OF content, message_type ON messages
+        WHEN new.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END""",
+]
+
+
+@migration(3, "full-text search index over message content")
+def _message_search(connection: Connection):
+    if connection.dialect.name != "sqlite":
+        logger.warning("Message search needs SQLite FTS5; skipping the search index")
+        return
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    )
+    for trigger in _SEARCH_TRIGGERS:
+        connection.execute(text(trigger))
+    connection.execute(
+        text(f"INSERT INTO messages_fts (rowid, content) SELECT id, content FROM messages WHERE {_SEARCHABLE}")
+    )
+
+
+@migration(4, "shared message bodies for repeated outgoing text")
+def _message_bodies(connection: Connection):
+    if "body_id" not in {column["name"] for column in inspect(connection).get_columns("messages")}:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN body_id INTEGER REFERENCES message_bodies (id)"))
+    # Intern outgoing texts already stored more than once (the bot's replies).
+    repeated = connection.execute(
+        text(
+            "SELECT content FROM messages WHERE direction = 'outgoing' AND body_id IS NULL "
+            "AND length(content) >= :min_length GROUP BY content HAVING count(*) > 1"
+        ),
+        {"min_length": settings.MESSAGE_BODY_INTERN_MIN_LENGTH},
+    ).scalars().all()
+    if not repeated:
+        return
+    connection.execute(
+        text("INSERT OR IGNORE INTO message_bodies (content_hash, content) VALUES (:content_hash, :content)"),
+        [{"content_hash": hashlib.sha256(content.encode("utf-8")).digest(), "content": content} for content in repeated],
+    )
+    connection.execute(
+        text(
+            "UPDATE messages SET "
+            "body_id = (SELECT b.id FROM message_bodies AS b WHERE b.content = messages.content), content = '' "
+            "WHERE direction = 'outgoing' AND body_id IS NULL AND content IN (SELECT content FROM message_bodies)"
+        )
+    )
+    logger.info("Interned %d repeated outgoing message texts", len(repeated))
+
+
+@migration(5, "exclude audio, video and sticker rows from the search index")
+def _search_media_types(connection: Connection):
+    # No such rows existed before (they were stored as text), so only the
+    # triggers need replacing.
+    if connection.dialect.name != "sqlite":
+        return
+    for name in ("insert", "delete", "update_old", "update_new"):
+        connection.execute(text(f"DROP TRIGGER IF EXISTS messages_fts_{name}"))
+    for trigger in _SEARCH_TRIGGERS:
+        connection.execute(text(trigger))
+
+
+_BLOB_REFCOUNT_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS messages_blob_ref_insert AFTER INSERT ON messages
+        WHEN new.blob_id IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE id = new.blob_id;
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_blob_ref_delete AFTER DELETE ON messages
+        WHEN old.blob_id IS NOT NULL BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE id = old.blob_id;
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_blob_ref_update AFTER UPDATE OF blob_id ON messages
+        WHEN old.blob_id IS NOT new.blob_id BEGIN
+            UPDATE media_blobs SET refcount = refcount - 1 WHERE id = old.blob_id;
+            UPDATE media_blobs SET refcount = refcount + 1 WHERE id = new.blob_id;
+        END""",
+]
+
+
+@migration(6, "content-addressed media blobs referenced by messages")
+def _media_blobs(connection: Connection):
+    if "blob_id" not in {column["name"] for column in inspect(connection).get_columns("messages")}:
+        connection.execute(text("ALTER TABLE messages ADD COLUMN blob_id INTEGER REFERENCES media_blobs (id)"))
+    if connection.dialect.name != "sqlite":
+        logger.warning("Media blob refcounts need SQLite triggers; skipping them")
+        return
+    for trigger in _BLOB_REFCOUNT_TRIGGERS:
+        connection.execute(text(trigger))
+
+
+@migration(7, "image thumbnails, and legacy uploaded images moved into the media store")
+def _thumbnails(connection: Connection):
+    columns = {column["name"] for column in inspect(connection).get_columns("media_blobs")}
+    for name, definition in (
+        ("width", "INTEGER"),
+        ("height", "INTEGER"),
+        ("thumbnail_path", "VARCHAR"),
+        ("thumbnail_status", "VARCHAR"),
+    ):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE media_blobs ADD COLUMN {name} {definition}"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_media_blobs_thumbnail_status ON media_blobs (thumbnail_status)")
+    )
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_messages_blob_id ON messages (blob_id) WHERE blob_id IS NOT NULL")
+    )
+    connection.execute(
+        text(
+            "UPDATE media_blobs SET thumbnail_status = 'pending' "
+            "WHERE thumbnail_status IS NULL AND mime_type LIKE 'image/%'"
+        )
+    )
+
+    # Images saved under /static/uploads before the media store existed get
+    # a blob (and so a thumbnail); the old files are left in place.
+    legacy = connection.execute(
+        text(
+            "SELECT DISTINCT content FROM messages "
+            "WHERE message_type = 'image' AND blob_id IS NULL AND content LIKE '/static/uploads/%'"
+        )
+    ).scalars().all()
+    adopted = 0
+    for url in legacy:
+        source = STATIC_DIR / url[len("/static/"):]
+        if "/" in url[len("/static/uploads/"):] or not source.is_file():
+            continue
+        stored = media_store.store_file(source)
+        connection.execute(
+            text(
+                "INSERT OR IGNORE INTO media_blobs (sha256, path, size, mime_type, refcount, thumbnail_status) "
+                "VALUES (:sha256, :path, :size, :mime_type, 0, 'pending')"
+            ),
+            {
+                "sha256": stored.sha256,
+                "path": stored.path,
+                "size": stored.size,
+                "mime_type": mimetypes.guess_type(source.name)[0] or "image/jpeg",
+            },
+        )
+        connection.execute(
+            text(
+                "UPDATE messages SET content = :content, "
+                "blob_id = (SELECT id FROM media_blobs WHERE sha256 = :sha256) "
+                "WHERE content = :url AND blob_id IS NULL"
+            ),
+            {"content": media_store.url(stored.path), "sha256": stored.sha256, "url": url},
+        )
+        adopted += 1
+    if adopted:
+        logger.info("Moved %d uploaded images into the media store", adopted)
+
+
+# Interned rows keep their text in message_bodies, so the index reads each
+# row's resolved text through a view.
+_SEARCH_VIEW = f"""CREATE VIEW IF NOT EXISTS messages_search AS
+    SELECT m.id, COALESCE(b.content, m.content) AS content FROM messages AS m
+    LEFT JOIN message_bodies AS b ON b.id = m.body_id WHERE m.{_SEARCHABLE}"""
+_BODY = "COALESCE((SELECT content FROM message_bodies WHERE id = {row}.body_id), {row}.content)"
+_RESOLVED_SEARCH_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN new.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, {_BODY.format(row="new")});
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN old.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, {_BODY.format(row="old")});
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update_old AFTER UPDATE OF content, message_type, body_id ON messages
+        WHEN old.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, {_BODY.format(row="old")});
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update_new AFTER UPDATE OF content, message_type, body_id ON messages
+        WHEN new.{_SEARCHABLE} BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, {_BODY.format(row="new")});
+        END""",
+]
+
+
+@migration(8, "search index over interned message bodies")
+def _search_bodies(connection: Connection):
+    if connection.dialect.name != "sqlite":
+        return
+    for name in ("insert", "delete", "update_old", "update_new"):
+        connection.execute(text(f"DROP TRIGGER IF EXISTS messages_fts_{name}"))
+    connection.execute(text("DROP TABLE IF EXISTS messages_fts"))
+    connection.execute(text(_SEARCH_VIEW))
+    connection.execute(
+        text(
+            "CREATE VIRTUAL TABLE messages_fts USING fts5("
+            "content, content='messages_search', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    )
+    for trigger in _RESOLVED_SEARCH_TRIGGERS:
+        connection.execute(text(trigger))
+    connection.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+@migration(9, "per-recipient outbox index for picking due messages")
+def _outbox_recipient_index(connection: Connection):
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_outbox_recipient_status_id ON outbox (recipient, status, id)")
+    )
+
+
+def _current_version(connection: Connection) -> int:
+    return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+
+def run_migrations(bind: Engine) -> int:
+    """Apply pending migrations and return the resulting schema version.
+
+    A current schema costs one query.
+    """
+    latest = MIGRATIONS[-1].version if MIGRATIONS else 0
+    try:
+        with bind.connect() as connection:
+            version = _current_version(connection)
+    except OperationalError:
+        with bind.begin() as connection:
+            connection.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS schema_version ("
+                    "version INTEGER PRIMARY KEY, "
+                    "description TEXT NOT NULL, "
+                    "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+                )
+            )
+        version = 0
+    if version >= latest:
+        return version
+
+    for step in MIGRATIONS:
+        if step.version <= version:
+            continue
+        logger.info("Applying schema migration %d: %s", step.version, step.description)
+        with bind.begin() as connection:
+            step.apply(connection)
+            connection.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                {"version": step.version, "description": step.description},
+            )
+        version = step.version
+    return version
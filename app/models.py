@@ -1,7 +1,10 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from typing import Optional
+
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, LargeBinary, Text, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
+from .media_store import media_store
 
 class User(Base):
     __tablename__ = "users"
@@ -12,15 +15,165 @@ class User(Base):
 
     messages = relationship("Message", back_populates="user")
 
+class MessageBody(Base):
+    """Text shared by many messages (bot replies), stored once and keyed by its SHA-256."""
+
+    __tablename__ = "message_bodies"
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(LargeBinary, unique=True, nullable=False)
+    content = Column(Text, nullable=False)
+
+class MediaBlob(Base):
+    """A media file in the content-addressed store, shared by every message that carries it."""
+
+    __tablename__ = "media_blobs"
+    __table_args__ = (Index("ix_media_blobs_thumbnail_status", "thumbnail_status"),)
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String, unique=True, nullable=False)  # hex digest of the file
+    path = Column(String, nullable=False)  # relative to the store root: ab/cd/<sha256><ext>
+    size = Column(Integer, nullable=False)
+    mime_type = Column(String, nullable=True)
+    refcount = Column(Integer, nullable=False, default=0)  # messages with this blob_id
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Images only: pixel size and a small preview rendered by the thumbnail pipeline.
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    thumbnail_path = Column(String, nullable=True)  # relative to the store root
+    thumbnail_status = Column(String, nullable=True)  # "pending", "done" or "failed"
+
 class Message(Base):
     __tablename__ = "messages"
+    # Conversation history is read per user in id order (keyset pagination);
+    # media rows are also found by blob (only they are indexed).
+    __table_args__ = (
+        Index("ix_messages_user_id_id", "user_id", "id"),
+        Index("ix_messages_blob_id", "blob_id", sqlite_where=text("blob_id IS NOT NULL")),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    content = Column(Text, nullable=False)
+    # Interned rows keep "" here and reference their text through body_id;
+    # use ``content``, which resolves either way.
+    stored_content = Column("content", Text, nullable=False)
+    body_id = Column(Integer, ForeignKey("message_bodies.id"), nullable=True)
+    # Stored media file (media rows); media_blobs.refcount follows it via triggers.
+    blob_id = Column(Integer, ForeignKey("media_blobs.id"), nullable=True)
     message_type = Column(String, default="text")
     direction = Column(String, nullable=False)  # "incoming" or "outgoing"
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     whatsapp_message_id = Column(String, unique=True, index=True, nullable=True)
 
     user = relationship("User", back_populates="messages")
+    body = relationship("MessageBody", lazy="joined")
+    blob = relationship("MediaBlob", lazy="joined")
+
+    @property
+    def content(self) -> str:
+        if self.body_id is not None and self.body is not None:
+            return self.body.content
+        return self.stored_content
+
+    @content.setter
+    def content(self, value: str):
+        self.stored_content = value
+        self.body_id = None
+        self.body = None
+
+    @property
+    def thumbnail_url(self) -> Optional[str]:
+        if self.blob is None or self.blob.thumbnail_path is None:
+            return None
+        return media_store.url(self.blob.thumbnail_path)
+
+    @property
+    def width(self) -> Optional[int]:
+        return self.blob.width if self.blob is not None else None
+
+    @property
+    def height(self) -> Optional[int]:
+        return self.blob.height if self.blob is not None else None
+
+class Conversation(Base):
+    """Per-user summary of the latest message, maintained by the message writer."""
+
+    __tablename__ = "conversations"
+    # The inbox is listed newest first, paging by last_message_id.
+    __table_args__ = (Index("ix_conversations_last_message_id", "last_message_id"),)
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+    last_message_at = Column(DateTime(timezone=True), nullable=False)
+    last_preview = Column(String, nullable=False, default="")
+    last_direction = Column(String, nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0)
+    last_inbound_at = Column(DateTime(timezone=True), nullable=True)
+
+    user = relationship("User")
+
+class InboxEntry(Base):
+    __tablename__ = "webhook_inbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payload = Column(LargeBinary, nullable=False)  # raw request body as received
+    received_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+    __table_args__ = (
+        Index("ix_outbox_status_id", "status", "id"),
+        # Per-recipient queue order, for the "is this recipient backing off" check.
+        Index("ix_outbox_recipient_status_id", "recipient", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    recipient = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)  # Graph API request body (JSON)
+    fallback_payload = Column(Text, nullable=True)  # sent instead if Graph rejects payload
+    status = Column(String, nullable=False, default="pending")  # "pending", "sending", "sent" or "failed"
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+    message = relationship("Message")
+
+class MediaDownload(Base):
+    """Inbound media queued for download from Graph into the uploads directory."""
+
+    __tablename__ = "media_downloads"
+    __table_args__ = (Index("ix_media_downloads_status_id", "status", "id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    media_id = Column(String, nullable=False)  # Graph media id
+    media_type = Column(String, nullable=False)  # "image", "document", "audio", "video" or "sticker"
+    filename = Column(String, nullable=True)  # sender's file name (documents)
+    status = Column(String, nullable=False, default="pending")  # "pending", "downloading", "done" or "failed"
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+
+    message = relationship("Message")
+
+class GraphMedia(Base):
+    """An outbound file uploaded to Graph's /media endpoint, sent by id until it expires."""
+
+    __tablename__ = "graph_media"
+    # Media ids belong to the sending phone number.
+    __table_args__ = (Index("ix_graph_media_phone_number_id_sha256", "phone_number_id", "sha256", unique=True),)
+
+    id = Column(Integer, primary_key=True)
+    phone_number_id = Column(String, nullable=False)
+    sha256 = Column(String, nullable=False)  # hex digest of the uploaded file
+    media_id = Column(String, nullable=False)
+    uploaded_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -0,0 +1,322 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set, Tuple
+
+import httpx
+
+from . import crud
+from .circuit_breaker import CircuitOpenError, RetryPolicy
+from .config import settings
+from .database import ReadSessionLocal, SessionLocal
+from .events import EventHub, dashboard_events
+from .graph_media import GraphMediaCache, MediaUnavailable, graph_media_cache
+from .media import MEDIA_TYPES
+from .whatsapp_client import AsyncWhatsAppClient, async_whatsapp_client
+
+logger = logging.getLogger(__name__)
+
+
+class PendingSend(NamedTuple):
+    id: int
+    recipient: str
+    payload: Dict
+    fallback_payload: Optional[Dict]
+    attempts: int
+    next_attempt_at: Optional[datetime]
+
+
+class OutboxDelivery:
+    """Background delivery of queued outbound messages.
+
+    Pending rows are grouped per recipient and sent strictly in id order, so a
+    multi-message reply arrives in the order it was generated. Different
+    recipients are delivered concurrently (up to ``workers``), at whatever pace
+    the client's rate limiter allows; a send waits for its recipient's token
+    before taking a worker. Transient failures (timeouts, 429, 5xx,
+    open circuit) are retried later with backoff and hold back the rest of that
+    recipient's queue; rejected payloads fall back to their text alternative
+    when there is one. Each row is claimed (status "sending") right before its
+    send, so a row loaded twice is still sent once; rows left mid-send by a
+    stop or crash are queued again at start. With a ``media`` cache, media
+    payloads are sent by Graph media id instead of by link whenever an id can
+    be had. Sent messages, now carrying their WhatsApp id, are announced on
+    ``events`` as ``message.updated``.
+    """
+
+    def __init__(
+        self,
+        client: AsyncWhatsAppClient,
+        workers: int,
+        batch_size: int,
+        poll_interval: float,
+        max_attempts: int,
+        retry_policy: RetryPolicy,
+        media: Optional[GraphMediaCache] = None,
+        events: Optional[EventHub] = None,
+    ):
+        self._client = client
+        self._media = media
+        self._events = events
+        self._workers = max(1, workers)
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+        self._retry_policy = retry_policy
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._deliveries: Set[asyncio.Task] = set()
+        self._busy_recipients: Set[str] = set()
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def notify(self):
+        """Wake the delivery loop after new rows were committed. Thread-safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        if self.running:
+            return
+        released = await asyncio.to_thread(self._release, None)
+        if released:
+            logger.warning("Returned %d outbox messages left mid-send to the queue", released)
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self._workers)
+        self._runner = asyncio.create_task(self._run(), name="outbox-delivery")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._runner.cancel()
+        for task in list(self._deliveries):
+            task.cancel()
+        await asyncio.gather(self._runner, *self._deliveries, return_exceptions=True)
+        await asyncio.to_thread(self._release, None)
+        self._runner = None
+        self._deliveries.clear()
+        self._busy_recipients.clear()
+        self._loop = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self._dispatch_due()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("Outbox dispatch failed: %s", exc)
+            # Not wait_for: it can swallow a stop()'s cancellation that lands
+            # just as the event is set, and this loop would never end.
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({wakeup}, timeout=self._poll_interval)
+            finally:
+                wakeup.cancel()
+            self._wakeup.clear()
+
+    async def _dispatch_due(self):
+        # Only due rows of idle recipients are loaded, so rows backing off or
+        # queued behind a busy recipient never fill the batch.
+        pending = await asyncio.to_thread(self._load_pending, frozenset(self._busy_recipients))
+        by_recipient: "OrderedDict[str, List[PendingSend]]" = OrderedDict()
+        for send in pending:
+            if send.recipient not in self._busy_recipients:
+                by_recipient.setdefault(send.recipient, []).append(send)
+
+        for recipient, sends in by_recipient.items():
+            self._busy_recipients.add(recipient)
+            task = asyncio.create_task(self._deliver_sequence(recipient, sends))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver_sequence(self, recipient: str, sends: List[PendingSend]):
+        try:
+            for send in sends:
+                # The list may predate a send that finished since; only a row
+                # still pending with the same attempt count is ours.
+                if not await asyncio.to_thread(self._claim, send.id, send.attempts):
+                    break
+                try:
+                    # Wait out the recipient's rate limit before taking a
+                    # worker slot, so throttled chats do not hold them all.
+                    await self._client.reserve_recipient(recipient)
+                    async with self._semaphore:
+                        delivered = await self._deliver(send, recipient_reserved=True)
+                except Exception:
+                    await asyncio.to_thread(self._release, send.id)
+                    raise
+                if not delivered:
+                    break
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Outbox delivery to %s failed: %s", recipient, exc)
+        finally:
+            self._busy_recipients.discard(recipient)
+            self._wakeup.set()
+
+    async def _deliver(self, send: PendingSend, by_media_id: bool = True, recipient_reserved: bool = False) -> bool:
+        """Attempt one send. Returns False when the recipient's queue must wait."""
+        payload = await self._with_media_id(send.payload) if by_media_id else send.payload
+        try:
+            response = await self._client.post_payload(payload, recipient_reserved)
+        except (httpx.HTTPError, CircuitOpenError) as exc:
+            return await self._retry_later(send, repr(exc))
+
+        if self._retry_policy.is_retryable_status(response.status_code):
+            return await self._retry_later(send, f"HTTP {response.status_code}: {response.text[:500]}")
+
+        if response.is_success:
+            await self._record_sent(send.id, self._client.extract_message_id(response.json()))
+            return True
+
+        if payload is not send.payload and self._client.is_media_id_error(response):
+            # The cached media id was refused (e.g. expired early): resend by link.
+            media = payload[payload["type"]]
+            logger.warning("Graph refused media id %s for outbox message %s", media["id"], send.id)
+            await self._media.forget(send.payload[payload["type"]]["link"], media["id"])
+            return await self._deliver(send, by_media_id=False)
+
+        error = f"HTTP {response.status_code}: {response.text[:500]}"
+        if send.fallback_payload:
+            logger.warning("Graph rejected outbox message %s (%s); sending fallback", send.id, error)
+            try:
+                fallback_response = await self._client.post_payload(send.fallback_payload)
+            except (httpx.HTTPError, CircuitOpenError) as exc:
+                return await self._retry_later(send, repr(exc))
+            if fallback_response.is_success:
+                await self._record_sent(
+                    send.id,
+                    self._client.extract_message_id(fallback_response.json()),
+                    send.fallback_payload.get("text", {}).get("body"),
+                    send.fallback_payload.get("type"),
+                )
+                return True
+            error = f"{error}; fallback HTTP {fallback_response.status_code}: {fallback_response.text[:500]}"
+
+        logger.error("Outbox message %s rejected by Graph: %s", send.id, error)
+        await asyncio.to_thread(self._mark_failed, send.id, error)
+        return True
+
+    async def _record_sent(
+        self,
+        outbox_id: int,
+        whatsapp_message_id: Optional[str],
+        content: Optional[str] = None,
+        message_type: Optional[str] = None,
+    ):
+        message_id, user_id, stored_type = await asyncio.to_thread(
+            self._mark_sent, outbox_id, whatsapp_message_id, content, message_type
+        )
+        if self._events is not None:
+            self._events.publish("message.updated", {"id": message_id, "user_id": user_id, "message_type": stored_type})
+
+    async def _with_media_id(self, payload: Dict) -> Dict:
+        """``payload`` with its media link replaced by a Graph media id, when one can be had."""
+        media_type = payload.get("type")
+        media = payload.get(media_type) if media_type in MEDIA_TYPES else None
+        if self._media is None or not media or "link" not in media:
+            return payload
+        try:
+            media_id = await self._media.media_id(media["link"])
+        except MediaUnavailable:
+            return payload
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Sending %s by link; no Graph media id: %r", media["link"], exc)
+            return payload
+        by_id = {key: value for key, value in media.items() if key != "link"}
+        return dict(payload, **{media_type: dict(by_id, id=media_id)})
+
+    async def _retry_later(self, send: PendingSend, error: str) -> bool:
+        attempts = send.attempts + 1
+        if attempts >= self._max_attempts:
+            logger.error("Giving up on outbox message %s after %d attempts: %s", send.id, attempts, error)
+            await asyncio.to_thread(self._mark_failed, send.id, error)
+            return True
+        delay = self._retry_policy.backoff(send.attempts)
+        logger.warning("Outbox message %s failed (%s); retrying in %.1fs", send.id, error, delay)
+        next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        await asyncio.to_thread(self._schedule_retry, send.id, next_attempt_at, error)
+        return False
+
+    def _load_pending(self, busy: FrozenSet[str]) -> List[PendingSend]:
+        db = ReadSessionLocal()
+        try:
+            return [
+                PendingSend(
+                    id=row.id,
+                    recipient=row.recipient,
+                    payload=json.loads(row.payload),
+                    fallback_payload=json.loads(row.fallback_payload) if row.fallback_payload else None,
+                    attempts=row.attempts,
+                    next_attempt_at=row.next_attempt_at,
+                )
+                for row in crud.get_pending_outbox_messages(
+                    db, limit=self._batch_size, now=datetime.utcnow(), skip_recipients=busy
+                )
+            ]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _claim(outbox_id: int, attempts: int) -> bool:
+        db = SessionLocal()
+        try:
+            return crud.claim_outbox_message(db, outbox_id, attempts)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _release(outbox_id: Optional[int]) -> int:
+        db = SessionLocal()
+        try:
+            return crud.release_outbox_claims(db, outbox_id)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _mark_sent(
+        outbox_id: int, whatsapp_message_id: Optional[str], content: Optional[str], message_type: Optional[str]
+    ) -> Tuple[int, int, Optional[str]]:
+        db = SessionLocal()
+        try:
+            message = crud.mark_outbox_message_sent(db, outbox_id, whatsapp_message_id, content, message_type)
+            return message.id, message.user_id, message.message_type
+        finally:
+            db.close()
+
+    @staticmethod
+    def _schedule_retry(outbox_id: int, next_attempt_at: datetime, error: str):
+        db = SessionLocal()
+        try:
+            crud.schedule_outbox_retry(db, outbox_id, next_attempt_at, error)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _mark_failed(outbox_id: int, error: str):
+        db = SessionLocal()
+        try:
+            crud.mark_outbox_message_failed(db, outbox_id, error)
+        finally:
+            db.close()
+
+
+outbox_delivery = OutboxDelivery(
+    client=async_whatsapp_client,
+    workers=settings.OUTBOX_WORKERS,
+    batch_size=settings.OUTBOX_BATCH_SIZE,
+    poll_interval=settings.OUTBOX_POLL_INTERVAL,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    retry_policy=RetryPolicy(
+        max_retries=settings.OUTBOX_MAX_ATTEMPTS,
+        base_delay=settings.OUTBOX_RETRY_BASE_DELAY,
+        max_delay=settings.OUTBOX_RETRY_MAX_DELAY,
+    ),
+    media=graph_media_cache if settings.GRAPH_MEDIA_UPLOAD else None,
+    events=dashboard_events,
+)
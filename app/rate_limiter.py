@@ -0,0 +1,98 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """Token bucket that smooths callers instead of rejecting them.
+
+    ``reserve`` always takes a token, letting the balance go negative, and
+    returns how long the caller must wait for its token to exist. Waiters are
+    therefore served in arrival order at exactly ``rate`` per second once the
+    ``capacity`` burst is spent. Not thread-safe: use from a single event loop.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    def is_full(self) -> bool:
+        """True once refilled to capacity: the bucket is then no different from a new one."""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SendRateLimiter:
+    """Outbound message budget per business phone number and per recipient.
+
+    A rate of 0 disables the corresponding limit. About
+    ``max_tracked_recipients`` recipient buckets are kept: when a new recipient
+    needs one, least recently used buckets that have refilled are dropped. A
+    bucket still in deficit is kept even over the limit, since dropping it
+    would hand that recipient a fresh burst.
+    """
+
+    def __init__(
+        self,
+        sender_rate: float,
+        sender_burst: float,
+        recipient_rate: float,
+        recipient_burst: float,
+        max_tracked_recipients: int = 10000,
+    ):
+        self._sender_rate = sender_rate
+        self._sender_burst = sender_burst
+        self._recipient_rate = recipient_rate
+        self._recipient_burst = recipient_burst
+        self._max_tracked_recipients = max(1, max_tracked_recipients)
+        self._senders: Dict[str, TokenBucket] = {}
+        self._recipients: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    async def acquire(self, sender_id: str, recipient: Optional[str]):
+        # Wait on the recipient first so a throttled conversation does not hold
+        # sender capacity that other recipients could be using meanwhile.
+        if recipient:
+            await self.acquire_recipient(recipient)
+        if self._sender_rate > 0:
+            bucket = self._senders.get(sender_id)
+            if bucket is None:
+                bucket = self._senders[sender_id] = TokenBucket(self._sender_rate, self._sender_burst)
+            await bucket.acquire()
+
+    async def acquire_recipient(self, recipient: str):
+        """Wait for a token of ``recipient`` alone (then call ``acquire`` without a recipient)."""
+        if self._recipient_rate > 0:
+            await self._recipient_bucket(recipient).acquire()
+
+    def _recipient_bucket(self, recipient: str) -> TokenBucket:
+        bucket = self._recipients.get(recipient)
+        if bucket is not None:
+            self._recipients.move_to_end(recipient)
+            return bucket
+        while len(self._recipients) >= self._max_tracked_recipients:
+            oldest = next(iter(self._recipients.values()))
+            if not oldest.is_full():
+                break
+            self._recipients.popitem(last=False)
+        bucket = self._recipients[recipient] = TokenBucket(self._recipient_rate, self._recipient_burst)
+        return bucket
@@ -1,29 +1,37 @@
 from __future__ import annotations
 
+import asyncio
 import re
-import time
 from pathlib import Path
 from typing import List, Optional
 
-import aiofiles
 from fastapi import (
     APIRouter,
     Depends,
-    File,
     Form,
+    Header,
     HTTPException,
+    Query,
     Request,
-    UploadFile,
+    Response,
     status,
 )
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from .. import crud, schemas
+from .. import async_crud, crud, schemas
 from ..config import settings
-from ..database import get_db
+from ..database import AsyncReadSessionLocal, get_async_db
+from ..events import dashboard_events, format_sse
+from ..media import media_extension
+from ..media_store import BlobWriter, media_store
 from ..security import verify_credentials
+from ..message_writer import MessageWrite
+from ..outbox import outbox_delivery
+from ..thumbnails import thumbnail_pipeline
+from ..uploads import ResumableUpload, UploadConflict, UploadTooLarge, resumable_uploads
 from ..whatsapp_client import whatsapp_client
 
 router = APIRouter(
@@ -34,13 +42,24 @@ router = APIRouter(
 
 templates = Jinja2Templates(directory="app/templates")
 
-UPLOAD_DIR = Path("app/static/uploads")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-
-def _build_public_url(filename: str) -> str:
+def _build_public_url(relative_url: str) -> str:
     base = settings.PUBLIC_BASE_URL.rstrip("/")
-    return f"{base}/static/uploads/{filename}"
+    return f"{base}{relative_url}"
+
+
+_FORM_MAX_BYTES = min(settings.UPLOAD_FORM_MAX_BYTES, settings.UPLOAD_MAX_BYTES)
+# Room for the multipart boundaries, part headers and caption around the file.
+_MULTIPART_OVERHEAD = 65536
+_FORM_TOO_LARGE = f"Files over {_FORM_MAX_BYTES} bytes must be sent as a resumable upload (/dashboard/uploads)."
+
+
+def _check_form_length(request: Request):
+    length = request.headers.get("content-length")
+    if length is None or not length.isdigit():
+        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED, detail="Content-Length is required.")
+    if int(length) > _FORM_MAX_BYTES + _MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=_FORM_TOO_LARGE)
 
 
 def _sanitize_filename(filename: str) -> str:
@@ -59,32 +78,142 @@ async def read_dashboard(request: Request):
     )
 
 
+@router.get("/graph-status")
+def get_graph_status():
+    """Expose the Graph API circuit breaker state for monitoring."""
+    return whatsapp_client.circuit_breaker.snapshot()
+
+
+@router.get("/events")
+async def stream_events():
+    """Push dashboard events (``message.created``) to the browser as Server-Sent Events."""
+
+    async def event_stream():
+        yield "retry: 2000\n\n"
+        async for event in dashboard_events.subscribe(keepalive=settings.EVENT_KEEPALIVE_SECONDS):
+            yield format_sse(event)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _load_changes(since_id: Optional[int], limit: int) -> schemas.ChangeFeed:
+    # Own short-lived session: a long-poll must not hold a pooled connection
+    # while it waits.
+    async with AsyncReadSessionLocal() as db:
+        if since_id is None:
+            return schemas.ChangeFeed(cursor=await async_crud.get_latest_message_id(db))
+        return await async_crud.get_changes_since(db, since_id=since_id, limit=limit)
+
+
+@router.get("/changes", response_model=schemas.ChangeFeed)
+async def get_changes(
+    since_id: Optional[int] = None,
+    limit: int = Query(default=1000, ge=1, le=10000),
+    timeout: float = Query(default=0.0, ge=0.0, le=60.0),
+):
+    """Which conversations gained messages since the ``since_id`` cursor.
+
+    Call without ``since_id`` to obtain the current cursor. With ``timeout``,
+    an empty result is held open until a message is written or the timeout
+    passes (long-polling for clients that cannot use ``/dashboard/events``).
+    """
+    # Subscribe before the first check so a message written in between still
+    # wakes the long-poll.
+    with dashboard_events.subscription() as wakeups:
+        changes = await _load_changes(since_id, limit)
+        if changes.conversations or since_id is None or timeout <= 0:
+            return changes
+        try:
+            await asyncio.wait_for(wakeups.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return changes
+    return await _load_changes(since_id, limit)
+
+
 @router.get("/users", response_model=List[schemas.UserSummary])
-def get_all_users(
+async def get_all_users(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    users = crud.get_users(db, skip=skip, limit=limit)
+    users = await async_crud.get_users(db, skip=skip, limit=limit)
     return users
 
 
+@router.get("/inbox", response_model=List[schemas.ConversationSummary])
+async def get_inbox(
+    before_id: Optional[int] = None,
+    limit: int = Query(default=50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Conversations, most recently active first.
+
+    Pass the last ``last_message_id`` seen as ``before_id`` for the next page.
+    """
+    return await async_crud.get_conversations(db, before_id=before_id, limit=limit)
+
+
+@router.get("/search", response_model=schemas.SearchResults)
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    user_id: Optional[int] = None,
+    order: str = Query(default="relevance", pattern="^(relevance|recent)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Full-text search over message text, best matches first (or newest with ``order=recent``).
+
+    Every word must match; the last one also matches as a prefix. Pass
+    ``next_cursor`` back as ``cursor`` for the next page.
+    """
+    try:
+        return await async_crud.search_messages(
+            db, q, user_id=user_id, cursor=cursor, limit=limit, order=order
+        )
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+@router.post("/users/{user_id}/read", status_code=status.HTTP_204_NO_CONTENT)
+async def mark_conversation_read(user_id: int):
+    if not await async_crud.mark_conversation_read(user_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+
+
 @router.get("/users/{user_id}/messages", response_model=List[schemas.Message])
-def get_user_messages(user_id: int, db: Session = Depends(get_db)):
-    user = crud.get_user_by_id(db, user_id=user_id)
-    if not user:
+async def get_user_messages(
+    user_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(default=100, ge=1, le=500),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Page through a conversation, oldest first.
+
+    Without cursors this is the latest ``limit`` messages; pass the first id
+    seen as ``before_id`` to load older ones, or the last id seen as
+    ``after_id`` to fetch only what arrived since.
+    """
+    rows = await async_crud.get_message_rows(db, user_id=user_id, before_id=before_id, after_id=after_id, limit=limit)
+    if not rows and not await async_crud.get_user_by_id(db, user_id=user_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    messages = crud.get_messages_by_user(db, user_id=user_id)
-    return messages
+    # Rows are encoded directly; validating them through schemas.Message
+    # (the response_model, kept for the API docs) would double the cost.
+    return Response(content=crud.encode_message_rows(rows), media_type="application/json")
 
 
 @router.post("/users/{user_id}/messages", response_model=schemas.Message)
-def send_manual_message(
+async def send_manual_message(
     user_id: int,
     payload: schemas.SendMessageRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = crud.get_user_by_id(db, user_id=user_id)
+    user = await async_crud.get_user_by_id(db, user_id=user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
@@ -95,44 +224,154 @@ def send_manual_message(
             detail="Message text cannot be empty.",
         )
 
-    response = whatsapp_client.send_text_message(to=user.whatsapp_id, text=text)
-    message = schemas.MessageCreate(
-        content=text,
-        direction="outgoing",
-        message_type="text",
-        whatsapp_message_id=whatsapp_client.extract_message_id(response),
+    message = await async_crud.create_message(
+        db,
+        schemas.MessageCreate(
+            content=text,
+            direction="outgoing",
+            message_type="text",
+        ),
+        user_id=user.id,
+        recipient=user.whatsapp_id,
+        payload=whatsapp_client.text_message_payload(user.whatsapp_id, text),
     )
-    return crud.create_message(db, message=message, user_id=user.id)
+    outbox_delivery.notify()
+    return message
 
 
 @router.post("/users/{user_id}/files", response_model=schemas.Message)
-async def send_file_message(
+async def send_file_message(user_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Send a file posted as multipart ``file`` (and optional ``caption``).
+
+    Only files up to ``UPLOAD_FORM_MAX_BYTES`` are taken this way; larger
+    ones go through a resumable upload. The form is parsed by hand so that
+    an oversized body is refused on its Content-Length, before any of it is
+    buffered.
+    """
+    _check_form_length(request)
+    user = await async_crud.get_user_by_id(db, user_id=user_id)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    async with request.form(max_files=1, max_fields=1) as form:
+        file, caption = form.get("file"), form.get("caption")
+        if not isinstance(file, StarletteUploadFile):
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail="A file is required.")
+        sanitized_name = _sanitize_filename(file.filename or "upload")
+        async with media_store.writer() as blob:
+            while chunk := await file.read(settings.MEDIA_CHUNK_SIZE):
+                if blob.size + len(chunk) > _FORM_MAX_BYTES:
+                    raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=_FORM_TOO_LARGE)
+                await blob.write(chunk)
+            blob_id, blob_path = await _store_blob(db, blob, file.content_type, sanitized_name)
+    return await _send_file(
+        db, user, blob_id, blob_path, file.content_type, sanitized_name, caption if isinstance(caption, str) else None
+    )
+
+
+@router.post("/uploads", response_model=schemas.UploadStatus, status_code=status.HTTP_201_CREATED)
+async def create_upload(payload: schemas.UploadCreate):
+    """Open a resumable upload; send its bytes with PATCH, then send it to a user."""
+    try:
+        upload = resumable_uploads.create(
+            _sanitize_filename(payload.filename or "upload"), payload.content_type, payload.size
+        )
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(exc)) from exc
+    return _upload_status(upload)
+
+
+@router.get("/uploads/{upload_id}", response_model=schemas.UploadStatus)
+async def get_upload(upload_id: str):
+    """Where to resume: ``offset`` is the number of bytes received so far."""
+    return _upload_status(_get_upload(upload_id))
+
+
+@router.patch("/uploads/{upload_id}", response_model=schemas.UploadStatus)
+async def append_upload(upload_id: str, request: Request, upload_offset: int = Header(...)):
+    """Append the raw request body at ``Upload-Offset`` (which must equal the current offset)."""
+    upload = _get_upload(upload_id)
+    try:
+        await resumable_uploads.append(upload, upload_offset, request.stream())
+    except UploadConflict as exc:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc)) from exc
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=str(exc)) from exc
+    return _upload_status(upload)
+
+
+@router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def cancel_upload(upload_id: str):
+    resumable_uploads.discard(_get_upload(upload_id))
+
+
+@router.post("/users/{user_id}/uploads/{upload_id}", response_model=schemas.Message)
+async def send_upload(
     user_id: int,
-    file: UploadFile = File(...),
+    upload_id: str,
     caption: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    user = crud.get_user_by_id(db, user_id=user_id)
+    """Send a completed resumable upload, like ``send_file_message``."""
+    user = await async_crud.get_user_by_id(db, user_id=user_id)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    upload = _get_upload(upload_id)
+    if not upload.complete or upload.lock.locked():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload has {upload.size} of {upload.length} bytes.",
+        )
+    try:
+        blob_id, blob_path = await _store_blob(db, upload, upload.content_type, upload.filename)
+    finally:
+        resumable_uploads.discard(upload)
+    return await _send_file(db, user, blob_id, blob_path, upload.content_type, upload.filename, caption)
+
+
+def _get_upload(upload_id: str) -> ResumableUpload:
+    upload = resumable_uploads.get(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+    return upload
 
-    sanitized_name = _sanitize_filename(file.filename or "upload")
-    suffix = Path(sanitized_name).suffix
-    timestamp = int(time.time())
-    stored_filename = f"user{user_id}_{timestamp}{suffix}"
-    destination = UPLOAD_DIR / stored_filename
 
-    async with aiofiles.open(destination, "wb") as buffer:
-        contents = await file.read()
-        await buffer.write(contents)
+def _upload_status(upload: ResumableUpload) -> schemas.UploadStatus:
+    return schemas.UploadStatus(
+        upload_id=upload.upload_id,
+        offset=upload.size,
+        size=upload.length,
+        chunk_size=resumable_uploads.chunk_size,
+    )
+
+
+async def _store_blob(db: AsyncSession, blob: BlobWriter, content_type: Optional[str], filename: str):
+    """Move a fully written blob into the media store (unless stored already) and return its id and path."""
+    known = await async_crud.get_media_blob_by_sha256(db, blob.sha256)
+    if known is not None:
+        return known.id, known.path
+    stored = await media_store.commit(blob, media_extension(content_type, filename))
+    blob_id = await async_crud.add_media_blob(stored.sha256, stored.path, stored.size, content_type)
+    thumbnail_pipeline.notify()
+    return blob_id, stored.path
+
 
-    relative_url = f"/static/uploads/{stored_filename}"
-    public_url = _build_public_url(stored_filename)
+async def _send_file(
+    db: AsyncSession,
+    user,
+    blob_id: int,
+    blob_path: str,
+    content_type: Optional[str],
+    filename: str,
+    caption: Optional[str],
+):
+    relative_url = media_store.url(blob_path)
+    public_url = _build_public_url(relative_url)
     trimmed_caption = caption.strip() if caption else None
 
-    if file.content_type and file.content_type.startswith("image/"):
+    if content_type and content_type.startswith("image/"):
         message_type = "image"
-        response = whatsapp_client.send_media_message(
+        payload = whatsapp_client.media_message_payload(
             to=user.whatsapp_id,
             media_type="image",
             media_url=public_url,
@@ -140,33 +379,33 @@ async def send_file_message(
         )
     else:
         message_type = "document"
-        response = whatsapp_client.send_media_message(
+        payload = whatsapp_client.media_message_payload(
             to=user.whatsapp_id,
             media_type="document",
             media_url=public_url,
             caption=trimmed_caption,
-            filename=sanitized_name,
+            filename=filename,
         )
 
-    saved_message = crud.create_message(
-        db,
-        message=schemas.MessageCreate(
+    write = MessageWrite(user_id=user.id)
+    write.add(
+        schemas.MessageCreate(
             content=relative_url,
             direction="outgoing",
             message_type=message_type,
-            whatsapp_message_id=whatsapp_client.extract_message_id(response),
         ),
-        user_id=user.id,
+        recipient=user.whatsapp_id,
+        payload=payload,
+        blob_id=blob_id,
     )
-
     if trimmed_caption:
-        crud.create_message(
-            db,
-            message=schemas.MessageCreate(
+        write.add(
+            schemas.MessageCreate(
                 content=trimmed_caption,
                 direction="outgoing",
-            ),
-            user_id=user.id,
+            )
         )
 
-    return saved_message
+    result = await async_crud.submit_write(write)
+    outbox_delivery.notify()
+    return await async_crud.get_message_by_id(db, result.message_ids[0])
@@ -1,18 +1,24 @@
-﻿from typing import Dict, Iterable, List
+﻿from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+import asyncio
 import json
 import logging
-import os
 import re
 
-import requests
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi import APIRouter, HTTPException, Request, Response
 from sqlalchemy.orm import Session
 
-from .. import crud, schemas
+from .. import crud, inbox, schemas
+from ..cache import LRUCache
 from ..config import settings
-from ..database import get_db
+from ..database import ReadSessionLocal
+from ..dispatcher import MessageDispatcher
 from ..faq_service import BotMessage, faq_service
+from ..inbox import WebhookInbox
+from ..media import MEDIA_TYPES, media_ingestion, media_placeholder
+from ..message_writer import MessageWrite, message_writer
+from ..outbox import outbox_delivery
+from ..webhook_queue import WebhookQueue
 from ..whatsapp_client import whatsapp_client
 
 router = APIRouter()
@@ -23,35 +29,30 @@ logger = logging.getLogger(__name__)
 EMAIL_REGEX = re.compile(r"[A-Za-z0-9_.+-]+@[A-Za-z0-9-]+\.[A-Za-z0-9-.]+")
 
 
-def _log_bot_messages(db: Session, user_id: int, messages: Iterable[BotMessage]):
+def _queue_bot_messages(write: MessageWrite, user, messages: Iterable[BotMessage]):
     for message in messages:
-        crud.create_message(
-            db,
-            message=schemas.MessageCreate(
+        write.add(
+            schemas.MessageCreate(
                 content=message.content,
                 direction="outgoing",
                 message_type=message.message_type,
-                whatsapp_message_id=message.whatsapp_message_id,
             ),
-            user_id=user_id,
+            recipient=user.whatsapp_id,
+            payload=message.payload,
+            fallback_payload=message.fallback_payload,
+            intern=True,
         )
 
 
-def _handle_text_message(db: Session, user, message_data: Dict) -> List[BotMessage]:
+def _handle_text_message(user, message_data: Dict, write: MessageWrite) -> List[BotMessage]:
     message_id = message_data.get("id")
-    if message_id and crud.get_message_by_whatsapp_message_id(db, message_id):
-        logger.info("Ignoring duplicate text message %s from %s", message_id, user.whatsapp_id)
-        return []
-
     content = message_data.get("text", {}).get("body", "")
-    crud.create_message(
-        db,
-        message=schemas.MessageCreate(
+    write.add(
+        schemas.MessageCreate(
             content=content,
             direction="incoming",
             whatsapp_message_id=message_id,
-        ),
-        user_id=user.id,
+        )
     )
 
     email_match = EMAIL_REGEX.search(content)
@@ -69,12 +70,8 @@ def _handle_text_message(db: Session, user, message_data: Dict) -> List[BotMessa
     return faq_service.send_fallback_message(user.whatsapp_id)
 
 
-def _handle_interactive_message(db: Session, user, message_data: Dict) -> List[BotMessage]:
+def _handle_interactive_message(user, message_data: Dict, write: MessageWrite) -> List[BotMessage]:
     message_id = message_data.get("id")
-    if message_id and crud.get_message_by_whatsapp_message_id(db, message_id):
-        logger.info("Ignoring duplicate interactive message %s from %s", message_id, user.whatsapp_id)
-        return []
-
     interactive_data = message_data.get("interactive", {})
     interaction_type = interactive_data.get("type")
 
@@ -88,15 +85,13 @@ def _handle_interactive_message(db: Session, user, message_data: Dict) -> List[B
         selection_id = ""
         content = "Unsupported interactive type"
 
-    crud.create_message(
-        db,
-        message=schemas.MessageCreate(
+    write.add(
+        schemas.MessageCreate(
             content=content,
             direction="incoming",
             message_type="interactive",
             whatsapp_message_id=message_id,
-        ),
-        user_id=user.id,
+        )
     )
 
     if selection_id:
@@ -105,99 +100,51 @@ def _handle_interactive_message(db: Session, user, message_data: Dict) -> List[B
     return faq_service.send_fallback_message(user.whatsapp_id)
 
 
-def _handle_image_message(db: Session, user, message_data: Dict) -> List[BotMessage]:
+def _handle_media_message(user, message_data: Dict, write: MessageWrite) -> List[BotMessage]:
     message_id = message_data.get("id")
-    if message_id and crud.get_message_by_whatsapp_message_id(db, message_id):
-        logger.info("Ignoring duplicate image message %s from %s", message_id, user.whatsapp_id)
-        return []
-
-    image_id = message_data.get("image", {}).get("id")
-    image_caption = message_data.get("image", {}).get("caption", "")
-
-    if not image_id:
-        crud.create_message(
-            db,
-            message=schemas.MessageCreate(
-                content="[Image id missing]",
+    message_type = message_data.get("type")
+    media = message_data.get(message_type, {})
+    media_id = media.get("id")
+    caption = media.get("caption", "")
+
+    if not media_id:
+        write.add(
+            schemas.MessageCreate(
+                content=media_placeholder(message_type, "id missing"),
                 direction="incoming",
-                message_type="image",
+                message_type=message_type,
                 whatsapp_message_id=message_id,
-            ),
-            user_id=user.id,
+            )
         )
         return faq_service.send_fallback_message(user.whatsapp_id)
 
-    file_name = f"user{user.id}_waimg_{image_id}.jpg"
-    upload_dir = "app/static/uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file_name)
-    public_url = f"/static/uploads/{file_name}"
-
-    media_url = f"https://graph.facebook.com/{whatsapp_client.API_VERSION}/{image_id}"
-    headers = {"Authorization": f"Bearer {settings.WHATSAPP_TOKEN}"}
-
-    try:
-        media_resp = requests.get(media_url, headers=headers, timeout=whatsapp_client.REQUEST_TIMEOUT)
-        media_resp.raise_for_status()
-        media_json = media_resp.json()
-        url = media_json.get("url")
-        if url:
-            img_data = requests.get(url, headers=headers, timeout=whatsapp_client.REQUEST_TIMEOUT)
-            img_data.raise_for_status()
-            with open(file_path, "wb") as output:
-                output.write(img_data.content)
-            crud.create_message(
-                db,
-                message=schemas.MessageCreate(
-                    content=public_url,
-                    direction="incoming",
-                    message_type="image",
-                    whatsapp_message_id=message_id,
-                ),
-                user_id=user.id,
-            )
-            if image_caption:
-                crud.create_message(
-                    db,
-                    message=schemas.MessageCreate(
-                        content=image_caption,
-                        direction="incoming",
-                    ),
-                    user_id=user.id,
-                )
-        else:
-            crud.create_message(
-                db,
-                message=schemas.MessageCreate(
-                    content=f"[Image url missing] {image_caption}",
-                    direction="incoming",
-                    message_type="image",
-                    whatsapp_message_id=message_id,
-                ),
-                user_id=user.id,
-            )
-    except requests.RequestException as exc:
-        logger.error("Failed to download image %s: %s", image_id, exc)
-        crud.create_message(
-            db,
-            message=schemas.MessageCreate(
-                content=f"[Image fetch failed] {image_caption}",
+    # The file is fetched by the media worker, which replaces the placeholder
+    # with the stored file's URL once it is on disk.
+    write.add(
+        schemas.MessageCreate(
+            content=media_placeholder(message_type, "downloading"),
+            direction="incoming",
+            message_type=message_type,
+            whatsapp_message_id=message_id,
+        ),
+        media={"media_id": media_id, "media_type": message_type, "filename": media.get("filename")},
+    )
+    if caption:
+        write.add(
+            schemas.MessageCreate(
+                content=caption,
                 direction="incoming",
-                message_type="image",
-                whatsapp_message_id=message_id,
-            ),
-            user_id=user.id,
+            )
         )
+    if message_type != "image":
+        return faq_service.send_fallback_message(user.whatsapp_id)
 
-    wait_response = whatsapp_client.send_text_message(
-        user.whatsapp_id,
-        "⏳ *Please wait...* ⏳\n\n> 🔎 Main aapki *payment verify* kar raha hoon.\n> Yeh process sirf kuch seconds lega ✅\n\n🙏 Kripya thoda sabr karein, verification complete hote hi aapko update mil jayega 🚀",
-    )
+    wait_text = "⏳ *Please wait...* ⏳\n\n> 🔎 Main aapki *payment verify* kar raha hoon.\n> Yeh process sirf kuch seconds lega ✅\n\n🙏 Kripya thoda sabr karein, verification complete hote hi aapko update mil jayega 🚀"
     return [
         BotMessage(
-            content="⏳ *Please wait...* ⏳\n\n> 🔎 Main aapki *payment verify* kar raha hoon.\n> Yeh process sirf kuch seconds lega ✅\n\n🙏 Kripya thoda sabr karein, verification complete hote hi aapko update mil jayega 🚀",
+            content=wait_text,
             message_type="text",
-            whatsapp_message_id=whatsapp_client.extract_message_id(wait_response),
+            payload=whatsapp_client.text_message_payload(user.whatsapp_id, wait_text),
         )
     ]
 
@@ -215,17 +162,14 @@ def handle_command(to: str, command_text: str) -> List[BotMessage]:
     else:
         responses.append("Unknown command. Type /help")
 
-    bot_messages: List[BotMessage] = []
-    for text in responses:
-        response = whatsapp_client.send_text_message(to, text)
-        bot_messages.append(
-            BotMessage(
-                content=text,
-                message_type="text",
-                whatsapp_message_id=whatsapp_client.extract_message_id(response),
-            )
+    return [
+        BotMessage(
+            content=text,
+            message_type="text",
+            payload=whatsapp_client.text_message_payload(to, text),
         )
-    return bot_messages
+        for text in responses
+    ]
 
 
 @router.get("/webhook")
@@ -242,55 +186,203 @@ async def verify_webhook(request: Request):
     raise HTTPException(status_code=403, detail="Forbidden")
 
 
+def iter_payload_messages(payload: Dict) -> Iterator[Dict]:
+    """Yield every message contained in a webhook payload."""
+    entries = payload.get("entry", [])
+    for entry in entries:
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            messages = value.get("messages", [])
+
+            if not messages:
+                continue
+
+            for message_data in messages:
+                yield message_data
+
+
+def process_message(db: Session, message_data: Dict):
+    """Store one inbound message and run the bot flow for it."""
+    whatsapp_id = message_data.get("from")
+    user = crud.get_or_create_user_ref(db, whatsapp_id=whatsapp_id)
+    message_type = message_data.get("type")
+    write = MessageWrite(user_id=user.id)
+    bot_messages: List[BotMessage] = []
+
+    if message_type == "text":
+        bot_messages = _handle_text_message(user, message_data, write)
+    elif message_type == "interactive":
+        bot_messages = _handle_interactive_message(user, message_data, write)
+    elif message_type in MEDIA_TYPES:
+        bot_messages = _handle_media_message(user, message_data, write)
+    else:
+        logger.warning("Unsupported message type received: %s", message_type)
+        write.add(
+            schemas.MessageCreate(
+                content=f"Unsupported message type: {message_type}",
+                direction="incoming",
+                whatsapp_message_id=message_data.get("id"),
+            )
+        )
+        bot_messages = faq_service.send_fallback_message(user.whatsapp_id)
+
+    # The inbound message, the logged replies and their outbox sends commit
+    # together, so a crash can neither lose nor duplicate a reply. A redelivered
+    # message loses the insert on its WhatsApp id and nothing is written.
+    _queue_bot_messages(write, user, bot_messages)
+    if not write:
+        return
+    result = message_writer.write(write)
+    if result.duplicate:
+        logger.info("Ignoring duplicate %s message %s from %s", message_type, message_data.get("id"), whatsapp_id)
+    else:
+        if bot_messages:
+            outbox_delivery.notify()
+        if write.has_media:
+            media_ingestion.notify()
+
+
+def _process_message_in_session(message_data: Dict):
+    db = ReadSessionLocal()
+    try:
+        process_message(db, message_data)
+    finally:
+        db.close()
+
+
+message_dispatcher = MessageDispatcher(handler=_process_message_in_session, lanes=settings.MESSAGE_LANES)
+seen_message_ids = LRUCache(maxsize=settings.SEEN_MESSAGE_CACHE_SIZE, ttl=settings.SEEN_MESSAGE_CACHE_TTL)
+
+
+async def process_webhook_payload(entry_id: Optional[int], payload: Dict):
+    """Fan a payload's messages out to the per-user lanes and wait for all of them.
+
+    Messages are submitted before the first await, so payloads keep their
+    arrival order within each user's lane.
+    """
+    futures = []
+    claimed_ids = []
+    for message_data in iter_payload_messages(payload):
+        whatsapp_id = message_data.get("from")
+        if not whatsapp_id:
+            logger.warning("Skipping message without sender: %s", message_data)
+            continue
+        message_id = message_data.get("id")
+        if message_id:
+            # Cheap in-memory guard for Meta's redeliveries; the unique insert in
+            # the message writer remains the authoritative check.
+            if not seen_message_ids.add(message_id):
+                logger.info("Skipping recently seen message %s from %s", message_id, whatsapp_id)
+                continue
+            claimed_ids.append(message_id)
+        else:
+            claimed_ids.append(None)
+        futures.append(message_dispatcher.submit(whatsapp_id, message_data))
+
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for message_id, result in zip(claimed_ids, results):
+        if message_id and isinstance(result, BaseException):
+            seen_message_ids.discard(message_id)  # let a retry process it
+    error = next((result for result in results if isinstance(result, BaseException)), None)
+    if entry_id is not None:
+        await webhook_inbox.finish(entry_id, error)
+    if error is not None:
+        raise error
+
+
+async def _process_queued_payload(item: Tuple[Optional[int], Dict]):
+    entry_id, payload = item
+    logger.info("Processing queued webhook payload: %s", json.dumps(payload, ensure_ascii=False))
+    await process_webhook_payload(entry_id, payload)
+
+
+webhook_inbox = WebhookInbox()
+webhook_queue = WebhookQueue(
+    handler=_process_queued_payload,
+    maxsize=settings.WEBHOOK_QUEUE_MAXSIZE,
+    workers=settings.WEBHOOK_WORKERS,
+)
+_replay_task: Optional[asyncio.Task] = None
+
+
+async def _replay_inbox():
+    """Re-run inbox entries left unfinished by a crash or a failed attempt."""
+    entries = await asyncio.to_thread(inbox.load_unprocessed, settings.WEBHOOK_INBOX_MAX_ATTEMPTS)
+    if entries:
+        logger.info("Replaying %d unfinished webhook inbox entries", len(entries))
+    for entry_id, body in entries:
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            logger.error("Skipping unreadable inbox entry %s", entry_id)
+            continue
+        if webhook_queue.running:
+            await webhook_queue.put((entry_id, payload))
+            continue
+        try:
+            await process_webhook_payload(entry_id, payload)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Replay of inbox entry %s failed: %s", entry_id, exc)
+
+
+async def start_background_processing():
+    global _replay_task
+    await message_dispatcher.start()
+    if settings.WEBHOOK_INBOX_ENABLED:
+        await webhook_inbox.start()
+        pruned = await asyncio.to_thread(inbox.prune_processed, settings.WEBHOOK_INBOX_RETENTION_DAYS)
+        if pruned:
+            logger.info("Pruned %d processed webhook inbox entries", pruned)
+    if settings.WEBHOOK_ASYNC_PROCESSING:
+        await webhook_queue.start()
+    if settings.WEBHOOK_INBOX_ENABLED:
+        _replay_task = asyncio.create_task(_replay_inbox(), name="webhook-inbox-replay")
+
+
+async def stop_background_processing():
+    global _replay_task
+    if _replay_task is not None:
+        _replay_task.cancel()
+        await asyncio.gather(_replay_task, return_exceptions=True)
+        _replay_task = None
+    await webhook_queue.stop()
+    await webhook_inbox.stop()
+    await message_dispatcher.stop()
+
+
 @router.post("/webhook")
-async def handle_webhook(request: Request, db: Session = Depends(get_db)):
-    payload = await request.json()
+async def handle_webhook(request: Request):
+    body = await request.body()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        logger.error("Rejecting webhook with invalid JSON body")
+        return Response(status_code=400)
+    if not isinstance(payload, dict):
+        logger.error("Rejecting webhook with non-object payload")
+        return Response(status_code=400)
+
+    entry_id: Optional[int] = None
+    if webhook_inbox.running:
+        try:
+            entry_id = await webhook_inbox.append(body)
+        except Exception as exc:  # pylint: disable=broad-except
+            # Without a durable copy, let Meta redeliver rather than risk losing it.
+            logger.exception("Failed to store webhook payload in inbox: %s", exc)
+            return Response(status_code=503)
+
+    if webhook_queue.running:
+        if not webhook_queue.enqueue((entry_id, payload)):
+            # Let Meta redeliver later instead of growing memory without bound.
+            logger.warning("Webhook queue is full; asking Meta to retry")
+            return Response(status_code=503)
+        return Response(status_code=200)
+
     logger.info("Received webhook payload: %s", json.dumps(payload, ensure_ascii=False))
 
     try:
-        entries = payload.get("entry", [])
-        for entry in entries:
-            for change in entry.get("changes", []):
-                value = change.get("value", {})
-                messages = value.get("messages", [])
-
-                if not messages:
-                    continue
-
-                for message_data in messages:
-                    whatsapp_id = message_data.get("from")
-                    if not whatsapp_id:
-                        logger.warning("Skipping message without sender: %s", message_data)
-                        continue
-
-                    user = crud.get_or_create_user(db, whatsapp_id=whatsapp_id)
-                    message_type = message_data.get("type")
-                    bot_messages: List[BotMessage] = []
-
-                    if message_type == "text":
-                        bot_messages = _handle_text_message(db, user, message_data)
-                    elif message_type == "interactive":
-                        bot_messages = _handle_interactive_message(db, user, message_data)
-                    elif message_type == "image":
-                        bot_messages = _handle_image_message(db, user, message_data)
-                    else:
-                        logger.warning("Unsupported message type received: %s", message_type)
-                        crud.create_message(
-                            db,
-                            message=schemas.MessageCreate(
-                                content=f"Unsupported message type: {message_type}",
-                                direction="incoming",
-                            ),
-                            user_id=user.id,
-                        )
-                        bot_messages = faq_service.send_fallback_message(user.whatsapp_id)
-
-                    if bot_messages:
-                        _log_bot_messages(db, user.id, bot_messages)
-
+        await process_webhook_payload(entry_id, payload)
     except Exception as exc:  # pylint: disable=broad-except
         logger.exception("Error handling webhook: %s", exc)
 
     return Response(status_code=200)
-
-
@@ -20,6 +20,10 @@ class Message(MessageBase):
     id: int
     user_id: int
     timestamp: datetime
+    # Stored images: a small preview and the full image's pixel size.
+    thumbnail_url: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -30,6 +34,19 @@ class SendMessageRequest(BaseModel):
     text: Optional[str] = None
 
 
+class UploadCreate(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+    size: int = Field(..., gt=0)
+
+
+class UploadStatus(BaseModel):
+    upload_id: str
+    offset: int
+    size: int
+    chunk_size: int
+
+
 # User Schemas
 class UserBase(BaseModel):
     whatsapp_id: str
@@ -46,6 +63,54 @@ class UserSummary(UserBase):
         from_attributes = True
 
 
+class ConversationSummary(BaseModel):
+    user_id: int
+    whatsapp_id: str
+    last_message_id: int
+    last_message_at: datetime
+    last_preview: str
+    last_direction: str
+    unread_count: int
+    last_inbound_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ConversationChange(BaseModel):
+    user_id: int
+    new_messages: int
+    new_incoming: int
+    last_message_id: int
+
+
+class ChangeFeed(BaseModel):
+    # Pass back as ``since_id`` on the next call.
+    cursor: int
+    # True when the scan limit was hit; call again immediately with ``cursor``.
+    has_more: bool = False
+    conversations: List[ConversationChange] = Field(default_factory=list)
+
+
+class SearchHit(BaseModel):
+    message_id: int
+    user_id: int
+    whatsapp_id: str
+    direction: str
+    message_type: Optional[str] = None
+    timestamp: datetime
+    # Matched excerpt; matches are wrapped in <mark>, the rest is raw message text.
+    snippet: str
+    # bm25 score; lower is a better match.
+    rank: float
+
+
+class SearchResults(BaseModel):
+    hits: List[SearchHit] = Field(default_factory=list)
+    # Pass back as ``cursor`` for the next page; None on the last page.
+    next_cursor: Optional[str] = None
+
+
 class User(UserBase):
     id: int
     created_at: datetime
@@ -1,12 +1,37 @@
 document.addEventListener("DOMContentLoaded", () => {
+    const MESSAGE_PAGE_SIZE = 100;
+    const INBOX_PAGE_SIZE = 50;
+    const MEDIA_TYPES = ["image", "document", "audio", "video", "sticker"];
+    const STORED_FILE_PREFIXES = ["/static/media/", "/static/uploads/"];
+    // Files this large use the resumable upload endpoints.
+    const RESUMABLE_UPLOAD_MIN_BYTES = 8 * 1024 * 1024;
+    const UPLOAD_RETRIES = 5;
+    // Longest side of an image bubble, matching the server's THUMBNAIL_MAX_SIZE.
+    const THUMBNAIL_DISPLAY_SIZE = 320;
+    const SEARCH_PAGE_SIZE = 30;
     const FALLBACK_IMAGE = "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' width='400' height='240' viewBox='0 0 400 240'%3E%3Crect fill='%23e5e7eb' width='400' height='240'/%3E%3Ctext x='50%25' y='50%25' dominant-baseline='middle' text-anchor='middle' fill='%239ca3af' font-size='20' font-family='Inter,Segoe UI,sans-serif'%3ENo preview%3C/text%3E%3C/svg%3E";
 
     const state = {
         users: [],
         filteredUsers: [],
+        inboxCursor: null,
+        hasMoreConversations: false,
+        loadingConversations: false,
+        inboxRefreshTimer: null,
+        searchQuery: "",
+        searchResults: [],
+        searchCursor: null,
+        loadingSearch: false,
+        searchTimer: null,
         activeUserId: null,
         lastMessageId: null,
+        oldestMessageId: null,
+        hasOlderMessages: false,
+        loadingOlderMessages: false,
         pollHandle: null,
+        eventSource: null,
+        refreshTimer: null,
+        activeChatHasUnread: false,
         baseTitle: document.title,
         lastRefreshed: null,
     };
@@ -14,6 +39,8 @@ document.addEventListener("DOMContentLoaded", () => {
     const elements = {
         userList: document.getElementById("user-list"),
         userSearch: document.getElementById("user-search"),
+        messageSearch: document.getElementById("message-search"),
+        userListTitle: document.getElementById("user-list-title"),
         refreshUsers: document.getElementById("refresh-users"),
         userListCount: document.getElementById("user-list-count"),
         chatWelcome: document.getElementById("chat-welcome"),
@@ -36,13 +63,28 @@ document.addEventListener("DOMContentLoaded", () => {
     const notificationAudio = new Audio(notificationSoundUrl);
     notificationAudio.preload = "auto";
 
+    function toConversation(summary) {
+        return Object.assign({ id: summary.user_id }, summary);
+    }
+
     async function fetchUsers() {
+        // Reload the most recent inbox page, keeping older pages already loaded.
         try {
-            const response = await fetch("/dashboard/users");
+            const response = await fetch("/dashboard/inbox?limit=" + INBOX_PAGE_SIZE);
             if (!response.ok) {
                 throw new Error("Failed to fetch users");
             }
-            state.users = await response.json();
+            const page = (await response.json()).map(toConversation);
+            const pageIds = new Set(page.map((conversation) => conversation.id));
+            const cutoff = page.length ? page[page.length - 1].last_message_id : Infinity;
+            const older = state.users.filter((conversation) =>
+                !pageIds.has(conversation.id) && conversation.last_message_id < cutoff
+            );
+            state.users = page.concat(older);
+            if (!older.length) {
+                state.hasMoreConversations = page.length === INBOX_PAGE_SIZE;
+            }
+            state.inboxCursor = state.users.length ? state.users[state.users.length - 1].last_message_id : null;
             updateUserStats();
             applyUserFilter(elements.userSearch.value.trim());
         } catch (error) {
@@ -51,6 +93,159 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    async function loadMoreConversations() {
+        if (!state.hasMoreConversations || state.loadingConversations || state.inboxCursor === null) {
+            return;
+        }
+        state.loadingConversations = true;
+        try {
+            const response = await fetch("/dashboard/inbox?limit=" + INBOX_PAGE_SIZE + "&before_id=" + state.inboxCursor);
+            if (!response.ok) {
+                throw new Error("Failed to fetch conversations");
+            }
+            const page = (await response.json()).map(toConversation);
+            const loadedIds = new Set(state.users.map((conversation) => conversation.id));
+            state.users = state.users.concat(page.filter((conversation) => !loadedIds.has(conversation.id)));
+            state.hasMoreConversations = page.length === INBOX_PAGE_SIZE;
+            if (page.length) {
+                state.inboxCursor = page[page.length - 1].last_message_id;
+            }
+            updateUserStats();
+            applyUserFilter(elements.userSearch.value.trim());
+        } catch (error) {
+            console.error(error);
+        } finally {
+            state.loadingConversations = false;
+        }
+    }
+
+    function scheduleInboxRefresh() {
+        if (state.inboxRefreshTimer) {
+            return;
+        }
+        state.inboxRefreshTimer = setTimeout(() => {
+            state.inboxRefreshTimer = null;
+            fetchUsers();
+        }, 300);
+    }
+
+    async function markConversationRead(userId) {
+        const conversation = state.users.find((user) => user.id === userId);
+        if (conversation) {
+            conversation.unread_count = 0;
+        }
+        try {
+            await fetch("/dashboard/users/" + userId + "/read", { method: "POST" });
+        } catch (error) {
+            console.error(error);
+        }
+    }
+
+    async function searchMessages(more) {
+        // A new query replaces the results; ``more`` appends the next page.
+        const query = state.searchQuery;
+        if (!query || state.loadingSearch || (more && !state.searchCursor)) {
+            return;
+        }
+        state.loadingSearch = true;
+        try {
+            let url = "/dashboard/search?limit=" + SEARCH_PAGE_SIZE + "&q=" + encodeURIComponent(query);
+            if (more) {
+                url += "&cursor=" + encodeURIComponent(state.searchCursor);
+            }
+            const response = await fetch(url);
+            if (!response.ok) {
+                throw new Error("Failed to search messages");
+            }
+            const results = await response.json();
+            if (query !== state.searchQuery) {
+                return;
+            }
+            state.searchResults = more ? state.searchResults.concat(results.hits) : results.hits;
+            state.searchCursor = results.next_cursor;
+            renderUserList();
+        } catch (error) {
+            console.error(error);
+            elements.userList.innerHTML = '<li class="error">Search failed.</li>';
+        } finally {
+            state.loadingSearch = false;
+            if (query !== state.searchQuery) {
+                searchMessages(false);
+            }
+        }
+    }
+
+    function scheduleSearch(value) {
+        clearTimeout(state.searchTimer);
+        state.searchTimer = setTimeout(() => {
+            state.searchQuery = value.trim();
+            state.searchResults = [];
+            state.searchCursor = null;
+            if (elements.userListTitle) {
+                elements.userListTitle.textContent = state.searchQuery ? "Search results" : "Conversations";
+            }
+            if (state.searchQuery) {
+                elements.userList.innerHTML = '<li class="loading">Searching...</li>';
+                searchMessages(false);
+            } else {
+                renderUserList();
+            }
+        }, 300);
+    }
+
+    function appendSnippet(container, snippet) {
+        // Matches come wrapped in <mark>; everything else is inserted as text.
+        snippet.split("<mark>").forEach((part, index) => {
+            const end = index > 0 ? part.indexOf("</mark>") : -1;
+            if (end >= 0) {
+                const mark = document.createElement("mark");
+                mark.textContent = part.slice(0, end);
+                container.appendChild(mark);
+                part = part.slice(end + "</mark>".length);
+            }
+            container.appendChild(document.createTextNode(part));
+        });
+    }
+
+    function renderSearchResults() {
+        elements.userList.innerHTML = "";
+        if (elements.userListCount) {
+            elements.userListCount.textContent = state.searchResults.length.toString() + (state.searchCursor ? "+" : "");
+        }
+        if (!state.searchResults.length) {
+            elements.userList.innerHTML = '<li class="empty">No messages found.</li>';
+            return;
+        }
+        state.searchResults.forEach((hit) => {
+            const item = document.createElement("li");
+            item.className = "user-list-item search-hit";
+            item.dataset.userId = hit.user_id;
+
+            const header = document.createElement("div");
+            header.className = "user-id";
+            header.textContent = hit.whatsapp_id;
+            const time = document.createElement("span");
+            time.className = "user-time";
+            time.textContent = formatTimestamp(hit.timestamp);
+            header.appendChild(time);
+
+            const snippet = document.createElement("div");
+            snippet.className = "search-snippet";
+            if (hit.direction === "outgoing") {
+                snippet.appendChild(document.createTextNode("You: "));
+            }
+            appendSnippet(snippet, hit.snippet);
+
+            item.appendChild(header);
+            item.appendChild(snippet);
+            item.addEventListener("click", () => selectUser(hit.user_id, hit.whatsapp_id));
+            if (state.activeUserId === hit.user_id) {
+                item.classList.add("active");
+            }
+            elements.userList.appendChild(item);
+        });
+    }
+
     function updateUserStats() {
         if (elements.statsTotalUsers) {
             elements.statsTotalUsers.textContent = state.users.length.toString();
@@ -72,6 +267,10 @@ document.addEventListener("DOMContentLoaded", () => {
     }
 
     function renderUserList() {
+        if (state.searchQuery) {
+            renderSearchResults();
+            return;
+        }
         elements.userList.innerHTML = "";
         if (elements.userListCount) {
             elements.userListCount.textContent = state.filteredUsers.length.toString();
@@ -84,10 +283,28 @@ document.addEventListener("DOMContentLoaded", () => {
             const item = document.createElement("li");
             item.className = "user-list-item";
             item.dataset.userId = user.id;
-            item.innerHTML = [
-                '<div class="user-id">' + user.whatsapp_id + '</div>',
-                '<div class="user-meta">#' + user.id + '</div>'
-            ].join("");
+
+            const header = document.createElement("div");
+            header.className = "user-id";
+            header.textContent = user.whatsapp_id;
+            const time = document.createElement("span");
+            time.className = "user-time";
+            time.textContent = formatTimestamp(user.last_message_at);
+            header.appendChild(time);
+
+            const meta = document.createElement("div");
+            meta.className = "user-meta";
+            meta.textContent = (user.last_direction === "outgoing" ? "You: " : "") + (user.last_preview || "");
+            if (user.unread_count > 0 && state.activeUserId !== user.id) {
+                item.classList.add("unread");
+                const badge = document.createElement("span");
+                badge.className = "unread-badge";
+                badge.textContent = user.unread_count.toString();
+                meta.appendChild(badge);
+            }
+
+            item.appendChild(header);
+            item.appendChild(meta);
             item.addEventListener("click", () => selectUser(user.id, user.whatsapp_id));
             if (state.activeUserId === user.id) {
                 item.classList.add("active");
@@ -98,7 +315,10 @@ document.addEventListener("DOMContentLoaded", () => {
 
     function selectUser(userId, whatsappId) {
         state.activeUserId = userId;
+        state.activeChatHasUnread = false;
         state.lastMessageId = null;
+        state.oldestMessageId = null;
+        state.hasOlderMessages = false;
         state.lastRefreshed = null;
         updateUserStats();
         updateChatSubtitle("Loading conversation...");
@@ -108,31 +328,52 @@ document.addEventListener("DOMContentLoaded", () => {
         elements.chatHeader.textContent = "Chat with " + whatsappId;
         elements.messageList.innerHTML = '<li class="loading">Loading conversation...</li>';
 
-        Array.prototype.forEach.call(document.querySelectorAll(".user-list-item"), (item) => {
-            item.classList.toggle("active", item.dataset.userId === String(userId));
-        });
-
+        markConversationRead(userId);
+        renderUserList();
         fetchMessages(userId, false);
     }
 
+    function messagesUrl(userId, cursor) {
+        let url = "/dashboard/users/" + userId + "/messages?limit=" + MESSAGE_PAGE_SIZE;
+        if (cursor) {
+            url += "&" + cursor;
+        }
+        return url;
+    }
+
     async function fetchMessages(userId, notifyNew) {
+        // The first load renders the latest page; after that only messages
+        // newer than the last one shown are requested.
+        const incremental = state.lastMessageId !== null;
         try {
-            const response = await fetch("/dashboard/users/" + userId + "/messages");
+            const response = await fetch(messagesUrl(userId, incremental ? "after_id=" + state.lastMessageId : null));
             if (!response.ok) {
                 throw new Error("Failed to fetch messages");
             }
             const messages = await response.json();
-            renderMessages(messages, notifyNew);
+            if (userId !== state.activeUserId) {
+                return;
+            }
+            if (incremental) {
+                appendMessages(messages, notifyNew);
+                if (messages.length === MESSAGE_PAGE_SIZE) {
+                    fetchMessages(userId, notifyNew);
+                }
+            } else {
+                renderMessages(messages);
+            }
             state.lastRefreshed = new Date();
             updateChatSubtitle("Updated " + state.lastRefreshed.toLocaleTimeString());
         } catch (error) {
             console.error(error);
-            elements.messageList.innerHTML = '<li class="error">Failed to load messages.</li>';
+            if (!incremental) {
+                elements.messageList.innerHTML = '<li class="error">Failed to load messages.</li>';
+            }
             updateChatSubtitle("Failed to refresh messages");
         }
     }
 
-    function renderMessages(messages, notifyNew) {
+    function renderMessages(messages) {
         elements.messageList.innerHTML = "";
         messages.forEach((message) => {
             const node = createMessageNode(message);
@@ -140,16 +381,67 @@ document.addEventListener("DOMContentLoaded", () => {
         });
         elements.messageList.scrollTop = elements.messageList.scrollHeight;
 
+        state.hasOlderMessages = messages.length === MESSAGE_PAGE_SIZE;
         if (!messages.length) {
             state.lastMessageId = null;
+            state.oldestMessageId = null;
+            return;
+        }
+        state.oldestMessageId = messages[0].id;
+        state.lastMessageId = messages[messages.length - 1].id;
+    }
+
+    function appendMessages(messages, notifyNew) {
+        // Overlapping polls can return the same rows; keep only unseen ones.
+        const fresh = messages.filter((message) => message.id > state.lastMessageId);
+        if (!fresh.length) {
+            return;
+        }
+        fresh.forEach((message) => {
+            elements.messageList.appendChild(createMessageNode(message));
+        });
+        elements.messageList.scrollTop = elements.messageList.scrollHeight;
+
+        const incoming = fresh.filter((message) => message.direction === "incoming");
+        if (notifyNew && incoming.length) {
+            triggerNotifications(incoming[incoming.length - 1]);
+        }
+        state.lastMessageId = fresh[fresh.length - 1].id;
+    }
+
+    async function loadOlderMessages() {
+        const userId = state.activeUserId;
+        if (!userId || !state.hasOlderMessages || state.loadingOlderMessages) {
             return;
         }
+        state.loadingOlderMessages = true;
+        try {
+            const response = await fetch(messagesUrl(userId, "before_id=" + state.oldestMessageId));
+            if (!response.ok) {
+                throw new Error("Failed to fetch older messages");
+            }
+            const messages = await response.json();
+            if (userId !== state.activeUserId) {
+                return;
+            }
+            const previousHeight = elements.messageList.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            messages.forEach((message) => {
+                fragment.appendChild(createMessageNode(message));
+            });
+            elements.messageList.insertBefore(fragment, elements.messageList.firstChild);
+            // Keep the messages the user was reading in place.
+            elements.messageList.scrollTop += elements.messageList.scrollHeight - previousHeight;
 
-        const latest = messages[messages.length - 1];
-        if (notifyNew && state.lastMessageId && latest.id !== state.lastMessageId && latest.direction === "incoming") {
-            triggerNotifications(latest);
+            if (messages.length) {
+                state.oldestMessageId = messages[0].id;
+            }
+            state.hasOlderMessages = messages.length === MESSAGE_PAGE_SIZE;
+        } catch (error) {
+            console.error(error);
+        } finally {
+            state.loadingOlderMessages = false;
         }
-        state.lastMessageId = latest.id;
     }
 
     function createMessageNode(message) {
@@ -166,12 +458,44 @@ document.addEventListener("DOMContentLoaded", () => {
             figure.classList.add("image-wrapper");
             const img = document.createElement("img");
             img.classList.add("chat-image");
-            img.src = (message.content && message.content.indexOf("/static/uploads/") === 0)
-                ? message.content
-                : FALLBACK_IMAGE;
             img.alt = "Image message";
-            figure.appendChild(img);
+            img.loading = "lazy";
+            if (message.width && message.height) {
+                // Reserve the space up front so the list does not jump as images load.
+                const scale = Math.min(1, THUMBNAIL_DISPLAY_SIZE / Math.max(message.width, message.height));
+                img.width = Math.round(message.width * scale);
+                img.height = Math.round(message.height * scale);
+            }
+            if (message.thumbnail_url) {
+                // Show the preview; the full image loads only when clicked.
+                img.src = message.thumbnail_url;
+                const link = document.createElement("a");
+                link.href = message.content;
+                link.target = "_blank";
+                link.rel = "noopener noreferrer";
+                link.appendChild(img);
+                figure.appendChild(link);
+            } else {
+                img.src = isStoredFile(message.content) ? message.content : FALLBACK_IMAGE;
+                figure.appendChild(img);
+            }
             body.appendChild(figure);
+        } else if (!isStoredFile(message.content) && MEDIA_TYPES.includes(message.message_type)) {
+            // Still downloading (or failed): the content is a placeholder.
+            body.textContent = message.content || "";
+        } else if (message.message_type === "sticker") {
+            const img = document.createElement("img");
+            img.classList.add("chat-sticker");
+            img.src = message.content;
+            img.alt = "Sticker";
+            body.appendChild(img);
+        } else if (message.message_type === "audio" || message.message_type === "video") {
+            const player = document.createElement(message.message_type);
+            player.classList.add("chat-" + message.message_type);
+            player.controls = true;
+            player.preload = "metadata";
+            player.src = message.content;
+            body.appendChild(player);
         } else if (message.message_type === "document") {
             const link = document.createElement("a");
             link.href = message.content;
@@ -198,9 +522,36 @@ document.addEventListener("DOMContentLoaded", () => {
 
         bubble.appendChild(meta);
         row.appendChild(bubble);
+        row.dataset.messageId = message.id;
         return row;
     }
 
+    function isStoredFile(content) {
+        // Media store blobs, or files saved before the store existed.
+        return Boolean(content) && STORED_FILE_PREFIXES.some((prefix) => content.indexOf(prefix) === 0);
+    }
+
+    async function refreshMessage(messageId) {
+        // Re-render one message in place (e.g. once its media has downloaded).
+        const userId = state.activeUserId;
+        try {
+            const response = await fetch(
+                "/dashboard/users/" + userId + "/messages?limit=1&after_id=" + (messageId - 1)
+            );
+            if (!response.ok) {
+                throw new Error("Failed to fetch message");
+            }
+            const messages = await response.json();
+            const current = elements.messageList.querySelector('[data-message-id="' + messageId + '"]');
+            if (userId !== state.activeUserId || !current || !messages.length || messages[0].id !== messageId) {
+                return;
+            }
+            current.replaceWith(createMessageNode(messages[0]));
+        } catch (error) {
+            console.error(error);
+        }
+    }
+
     function formatTimestamp(isoString) {
         if (!isoString) {
             return "";
@@ -215,6 +566,12 @@ document.addEventListener("DOMContentLoaded", () => {
                 return "Image";
             case "document":
                 return "Document";
+            case "audio":
+                return "Audio";
+            case "video":
+                return "Video";
+            case "sticker":
+                return "Sticker";
             case "interactive":
                 return "Interactive";
             default:
@@ -269,6 +626,67 @@ document.addEventListener("DOMContentLoaded", () => {
         }, 5000);
     }
 
+    function handleMessageCreated(event) {
+        scheduleInboxRefresh();
+        if (event.user_id === state.activeUserId) {
+            if (event.direction === "incoming") {
+                state.activeChatHasUnread = true;
+            }
+            scheduleActiveRefresh();
+            return;
+        }
+        if (event.direction === "incoming") {
+            showDashboardNotification("New message in another chat");
+        }
+    }
+
+    function scheduleActiveRefresh() {
+        // A reply arrives as a burst of events; fetch once for the whole burst.
+        if (state.refreshTimer) {
+            return;
+        }
+        state.refreshTimer = setTimeout(() => {
+            state.refreshTimer = null;
+            if (state.activeUserId) {
+                fetchMessages(state.activeUserId, true);
+                if (state.activeChatHasUnread) {
+                    state.activeChatHasUnread = false;
+                    markConversationRead(state.activeUserId);
+                }
+            }
+        }, 100);
+    }
+
+    function connectEvents() {
+        // Server push replaces polling; fall back to polling without EventSource.
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        const source = new EventSource("/dashboard/events");
+        source.addEventListener("message.created", (event) => {
+            handleMessageCreated(JSON.parse(event.data));
+        });
+        source.addEventListener("message.updated", (event) => {
+            const data = JSON.parse(event.data);
+            if (data.user_id === state.activeUserId) {
+                refreshMessage(data.id);
+            }
+        });
+        // Sent when this connection fell too far behind; the browser reconnects
+        // by itself and the open handler below catches up.
+        source.addEventListener("resync", () => {
+            fetchUsers();
+        });
+        source.addEventListener("open", () => {
+            scheduleInboxRefresh();
+            if (state.activeUserId) {
+                fetchMessages(state.activeUserId, false);
+            }
+        });
+        state.eventSource = source;
+    }
+
     function resetTitle() {
         document.title = state.baseTitle;
     }
@@ -279,6 +697,62 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    async function sendFile(userId, file, caption) {
+        if (file.size < RESUMABLE_UPLOAD_MIN_BYTES) {
+            const formData = new FormData();
+            formData.append("file", file);
+            formData.append("caption", caption || "");
+            await uploadRequest("/dashboard/users/" + userId + "/files", { method: "POST", body: formData });
+            return;
+        }
+        // Large files go up in chunks; after a failed chunk the upload resumes
+        // from the offset the server reports instead of starting over.
+        let upload = await uploadRequest("/dashboard/uploads", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ filename: file.name, content_type: file.type || null, size: file.size }),
+        });
+        const uploadUrl = "/dashboard/uploads/" + upload.upload_id;
+        let failures = 0;
+        let resync = false;
+        while (resync || upload.offset < upload.size) {
+            try {
+                if (resync) {
+                    upload = await uploadRequest(uploadUrl, {});
+                    resync = false;
+                    continue;
+                }
+                upload = await uploadRequest(uploadUrl, {
+                    method: "PATCH",
+                    headers: { "Content-Type": "application/octet-stream", "Upload-Offset": String(upload.offset) },
+                    body: file.slice(upload.offset, upload.offset + upload.chunk_size),
+                });
+                failures = 0;
+            } catch (error) {
+                failures += 1;
+                if (failures > UPLOAD_RETRIES) {
+                    throw error;
+                }
+                resync = true;
+                await new Promise((resolve) => setTimeout(resolve, 1000 * failures));
+            }
+        }
+        const formData = new FormData();
+        formData.append("caption", caption || "");
+        await uploadRequest("/dashboard/users/" + userId + "/uploads/" + upload.upload_id, {
+            method: "POST",
+            body: formData,
+        });
+    }
+
+    async function uploadRequest(url, options) {
+        const response = await fetch(url, options);
+        if (!response.ok) {
+            throw new Error("Upload request failed: " + response.status);
+        }
+        return response.json();
+    }
+
     elements.replyForm.addEventListener("submit", async (event) => {
         event.preventDefault();
         if (!state.activeUserId) {
@@ -289,17 +763,8 @@ document.addEventListener("DOMContentLoaded", () => {
         const file = elements.fileUpload.files[0];
 
         if (file) {
-            const formData = new FormData();
-            formData.append("file", file);
-            formData.append("caption", text || "");
             try {
-                const response = await fetch("/dashboard/users/" + state.activeUserId + "/files", {
-                    method: "POST",
-                    body: formData,
-                });
-                if (!response.ok) {
-                    throw new Error("Failed to send file");
-                }
+                await sendFile(state.activeUserId, file, text);
                 elements.replyMessageInput.value = "";
                 elements.fileUpload.value = "";
                 fetchMessages(state.activeUserId, false);
@@ -330,10 +795,33 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     });
 
+    elements.messageList.addEventListener("scroll", () => {
+        if (elements.messageList.scrollTop < 40) {
+            loadOlderMessages();
+        }
+    });
+
+    elements.userList.addEventListener("scroll", () => {
+        const list = elements.userList;
+        if (list.scrollTop + list.clientHeight >= list.scrollHeight - 40) {
+            if (state.searchQuery) {
+                searchMessages(true);
+            } else {
+                loadMoreConversations();
+            }
+        }
+    });
+
     elements.userSearch.addEventListener("input", (event) => {
         applyUserFilter(event.target.value);
     });
 
+    if (elements.messageSearch) {
+        elements.messageSearch.addEventListener("input", (event) => {
+            scheduleSearch(event.target.value);
+        });
+    }
+
     elements.refreshUsers.addEventListener("click", () => {
         fetchUsers();
     });
@@ -354,5 +842,5 @@ document.addEventListener("DOMContentLoaded", () => {
     }
 
     fetchUsers();
-    startPolling();
+    connectEvents();
 });
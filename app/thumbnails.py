@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from . import crud
+from .config import settings
+from .database import ReadSessionLocal, SessionLocal
+from .events import EventHub, dashboard_events
+from .media_store import MediaStore, media_store
+
+logger = logging.getLogger(__name__)
+
+_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg"}
+# EXIF orientations that turn the image by 90 degrees.
+_ROTATED = {5, 6, 7, 8}
+# Messages re-rendered when a popular blob gets its thumbnail.
+_ANNOUNCE_LIMIT = 100
+
+
+class PendingThumbnail(NamedTuple):
+    blob_id: int
+    sha256: str
+    path: str
+
+
+def render_thumbnail(source: str, destination: str, max_size: int, image_format: str, quality: int) -> Tuple[int, int]:
+    """Write a thumbnail of ``source`` to ``destination`` and return the image's (width, height).
+
+    Runs in a worker process.
+    """
+    with Image.open(source) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112) in _ROTATED:
+            width, height = height, width
+        image.draft("RGB", (max_size, max_size))  # JPEG: decode at a reduced scale
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((max_size, max_size))
+        if image_format == "JPEG":
+            thumbnail = thumbnail.convert("RGB")
+        elif thumbnail.mode not in ("RGB", "RGBA"):
+            thumbnail = thumbnail.convert("RGBA")
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        partial = destination + ".part"
+        thumbnail.save(partial, format=image_format, quality=quality)
+        os.replace(partial, destination)
+    return width, height
+
+
+class ThumbnailPipeline:
+    """Background thumbnails for stored images, so the dashboard need not load full files.
+
+    Image blobs are registered with a pending thumbnail. This worker decodes
+    them in a process pool (keeping Pillow off the event loop and the GIL),
+    writes a preview of at most ``max_size`` pixels next to the blobs and
+    records the image's dimensions. Messages carrying the image are then
+    announced on ``events`` as ``message.updated``.
+    """
+
+    def __init__(
+        self,
+        store: MediaStore,
+        workers: int,
+        max_size: int,
+        image_format: str,
+        quality: int,
+        batch_size: int,
+        poll_interval: float,
+        events: Optional[EventHub] = None,
+    ):
+        self._store = store
+        self._workers = max(1, workers)
+        self._max_size = max_size
+        self._format = image_format.upper()
+        self._quality = quality
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._events = events
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._isolated = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def notify(self):
+        """Wake the worker after image blobs were stored. Thread-safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        if self.running:
+            return
+        if self._format not in _EXTENSIONS:
+            raise ValueError(f"Thumbnail format must be one of {', '.join(_EXTENSIONS)}")
+        self._executor = self._create_executor()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._runner = asyncio.create_task(self._run(), name="thumbnails")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._runner.cancel()
+        await asyncio.gather(self._runner, return_exceptions=True)
+        await asyncio.to_thread(self._executor.shutdown, cancel_futures=True)
+        self._runner = None
+        self._executor = None
+        self._loop = None
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # Spawned, not forked: the app process already runs threads.
+        return ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        """Swap in a new pool for one whose worker died (once, however many renders saw it)."""
+        if self._executor is not broken:
+            return
+        logger.warning("Thumbnail worker pool broke; starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._create_executor()
+
+    async def _run(self):
+        while True:
+            try:
+                while await self._process_batch() == self._batch_size:
+                    pass
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("Thumbnail batch failed: %s", exc)
+            # wait_for may lose stop()'s cancel if a wakeup lands at the same moment.
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({wakeup}, timeout=self._poll_interval)
+            finally:
+                wakeup.cancel()
+            self._wakeup.clear()
+
+    async def _process_batch(self) -> int:
+        pending = await asyncio.to_thread(self._load_pending)
+        await asyncio.gather(*(self._render(thumbnail) for thumbnail in pending))
+        return len(pending)
+
+    async def _render(self, pending: PendingThumbnail, retry: bool = True):
+        path = self._store.thumbnail_path(pending.sha256, _EXTENSIONS[self._format])
+        executor = self._executor
+        try:
+            width, height = await self._loop.run_in_executor(
+                executor,
+                render_thumbnail,
+                str(self._store.file(pending.path)),
+                str(self._store.file(path)),
+                self._max_size,
+                self._format,
+                self._quality,
+            )
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            # UnidentifiedImageError is an OSError.
+            logger.warning("No thumbnail for %s: %r", pending.path, exc)
+            await asyncio.to_thread(self._finish, pending.blob_id, None, None, None)
+            return
+        except BrokenProcessPool as exc:
+            # A worker died and took every render in flight with it. Each is
+            # retried once, one at a time, so only the image that crashes it
+            # again is given up on.
+            self._replace_executor(executor)
+            if retry:
+                async with self._isolated:
+                    await self._render(pending, retry=False)
+                return
+            logger.error("Thumbnail for %s crashed its worker: %r", pending.path, exc)
+            await asyncio.to_thread(self._finish, pending.blob_id, None, None, None)
+            return
+        except Exception as exc:  # pylint: disable=broad-except
+            # Anything else (e.g. a Pillow bug) still fails just this blob, or
+            # it would head every batch from now on.
+            logger.exception("Thumbnail for %s failed: %r", pending.path, exc)
+            await asyncio.to_thread(self._finish, pending.blob_id, None, None, None)
+            return
+        await asyncio.to_thread(self._finish, pending.blob_id, path, width, height)
+        await self._announce(pending.blob_id)
+
+    async def _announce(self, blob_id: int):
+        if self._events is None:
+            return
+        for message_id, user_id, message_type in await asyncio.to_thread(self._blob_messages, blob_id):
+            self._events.publish("message.updated", {"id": message_id, "user_id": user_id, "message_type": message_type})
+
+    def _load_pending(self) -> List[PendingThumbnail]:
+        db = ReadSessionLocal()
+        try:
+            return [
+                PendingThumbnail(blob_id=blob.id, sha256=blob.sha256, path=blob.path)
+                for blob in crud.get_pending_thumbnails(db, limit=self._batch_size)
+            ]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _blob_messages(blob_id: int):
+        db = ReadSessionLocal()
+        try:
+            return crud.get_blob_messages(db, blob_id, limit=_ANNOUNCE_LIMIT)
+        finally:
+            db.close()
+
+    @staticmethod
+    def _finish(blob_id: int, path: Optional[str], width: Optional[int], height: Optional[int]):
+        db = SessionLocal()
+        try:
+            crud.finish_thumbnail(db, blob_id, path, width, height)
+        finally:
+            db.close()
+
+
+thumbnail_pipeline = ThumbnailPipeline(
+    store=media_store,
+    workers=settings.THUMBNAIL_WORKERS,
+    max_size=settings.THUMBNAIL_MAX_SIZE,
+    image_format=settings.THUMBNAIL_FORMAT,
+    quality=settings.THUMBNAIL_QUALITY,
+    batch_size=settings.THUMBNAIL_BATCH_SIZE,
+    poll_interval=settings.THUMBNAIL_POLL_INTERVAL,
+    events=dashboard_events,
+)
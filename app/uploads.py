@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import secrets
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+import aiofiles
+
+from .config import settings
+from .media_store import BlobWriter, MediaStore, media_store
+
+logger = logging.getLogger(__name__)
+
+
+class UploadTooLarge(Exception):
+    """More bytes than the upload declared (or than the configured limit)."""
+
+
+class UploadConflict(Exception):
+    """A chunk for the wrong offset, or while another chunk is being written."""
+
+
+class ResumableUpload(BlobWriter):
+    """A file arriving in pieces; bytes are appended to its temporary file and hashed as they land."""
+
+    def __init__(self, upload_id: str, filename: str, content_type: Optional[str], length: int, temp_path: Path):
+        super().__init__(None, temp_path)
+        self.upload_id = upload_id
+        self.filename = filename
+        self.content_type = content_type
+        self.length = length
+        self.lock = asyncio.Lock()
+        self.touched = time.monotonic()
+
+    @property
+    def complete(self) -> bool:
+        return self.size == self.length
+
+    async def append(self, chunks: AsyncIterator[bytes]):
+        # Whatever arrived before an error is kept: the client resumes at ``size``.
+        self.touched = time.monotonic()
+        async with aiofiles.open(self.temp_path, "ab") as self._file:
+            async for chunk in chunks:
+                if self.size + len(chunk) > self.length:
+                    raise UploadTooLarge(f"Upload {self.upload_id} is only {self.length} bytes")
+                await self.write(chunk)
+        self._file = None
+        self.touched = time.monotonic()
+
+
+class ResumableUploads:
+    """Dashboard uploads sent in chunks, so a dropped connection resumes instead of restarting.
+
+    A session is opened with the file's name, type and size. Chunks are then
+    appended at the current offset (which the client asks for after a
+    failure) and the finished file is committed to the media store like any
+    other upload. Sessions live in this process and are discarded after
+    ``ttl`` seconds without a chunk.
+    """
+
+    def __init__(self, store: MediaStore, max_bytes: int, chunk_size: int, ttl: float):
+        self._store = store
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._ttl = ttl
+        self._uploads: Dict[str, ResumableUpload] = {}
+
+    def create(self, filename: str, content_type: Optional[str], size: int) -> ResumableUpload:
+        if size > self.max_bytes:
+            raise UploadTooLarge(f"Uploads are limited to {self.max_bytes} bytes")
+        self._expire()
+        upload = ResumableUpload(secrets.token_urlsafe(16), filename, content_type, size, self._store.temp_file())
+        self._uploads[upload.upload_id] = upload
+        return upload
+
+    def get(self, upload_id: str) -> Optional[ResumableUpload]:
+        self._expire()
+        return self._uploads.get(upload_id)
+
+    async def append(self, upload: ResumableUpload, offset: int, chunks: AsyncIterator[bytes]):
+        """Append a chunk that starts at ``offset``."""
+        if upload.lock.locked():
+            raise UploadConflict(f"Upload {upload.upload_id} is already receiving a chunk")
+        async with upload.lock:
+            if offset != upload.size:
+                raise UploadConflict(f"Upload {upload.upload_id} is at offset {upload.size}, not {offset}")
+            await upload.append(chunks)
+
+    def discard(self, upload: ResumableUpload):
+        self._uploads.pop(upload.upload_id, None)
+        upload.temp_path.unlink(missing_ok=True)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self._ttl
+        for upload in [upload for upload in self._uploads.values() if upload.touched < cutoff]:
+            if not upload.lock.locked():
+                logger.info("Discarding idle upload %s (%s)", upload.upload_id, upload.filename)
+                self.discard(upload)
+
+
+resumable_uploads = ResumableUploads(
+    store=media_store,
+    max_bytes=settings.UPLOAD_MAX_BYTES,
+    chunk_size=settings.UPLOAD_CHUNK_SIZE,
+    ttl=settings.UPLOAD_SESSION_TTL,
+)
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookQueue:
+    """Bounded in-process queue of webhook work items drained by worker tasks.
+
+    The webhook endpoint only enqueues; the handler coroutine runs on worker
+    tasks so Graph API and database latency never delay the ack. ``workers``
+    bounds how many items are in flight at once.
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], maxsize: int, workers: int):
+        self._handler = handler
+        self._maxsize = maxsize
+        self._worker_count = max(1, workers)
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def enqueue(self, item: Any) -> bool:
+        """Queue an item for processing. Returns False when the queue is full."""
+        if self._queue is None:
+            raise RuntimeError("WebhookQueue has not been started")
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, item: Any):
+        """Queue an item, waiting for room instead of rejecting it."""
+        if self._queue is None:
+            raise RuntimeError("WebhookQueue has not been started")
+        await self._queue.put(item)
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._workers = [
+            asyncio.create_task(self._worker(index), name=f"webhook-worker-{index}")
+            for index in range(self._worker_count)
+        ]
+        logger.info("Started %d webhook workers (queue size %d)", self._worker_count, self._maxsize)
+
+    async def stop(self, timeout: float = 10.0):
+        """Drain queued items (up to ``timeout`` seconds) and stop the workers."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping webhook workers with %d items still queued", self._queue.qsize())
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self, index: int):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._handler(item)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("Webhook worker %d failed to process item: %s", index, exc)
+            finally:
+                self._queue.task_done()
@@ -1,38 +1,164 @@
+import asyncio
 import logging
-from typing import Optional
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Coroutine, Optional
 
-import requests
+import httpx
 
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, RetryPolicy
 from .config import settings
+from .rate_limiter import SendRateLimiter
 
 logger = logging.getLogger(__name__)
 
+# Graph errors meaning a media id it does not (or no longer) know: media
+# upload errors and the invalid-attachment subcode.
+MEDIA_ID_ERROR_CODES = {131053}
+MEDIA_ID_ERROR_SUBCODES = {2494102}
+# "Invalid parameter" codes, a media id error when the details name the id.
+INVALID_PARAMETER_CODES = {100, 131009}
 
-class WhatsAppClient:
-    """Thin wrapper around the Meta WhatsApp Cloud API."""
+
+class GraphConnectionPool:
+    """Shared keep-alive (optionally HTTP/2) connection pool for the Graph API.
+
+    The underlying ``httpx.AsyncClient`` lives on a private event-loop thread
+    so that sync callers and coroutines on any loop can share one pool.
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        http2: bool,
+        timeout: float,
+    ):
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2
+        self._timeout = httpx.Timeout(timeout)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule ``coro`` on the pool's loop and return a thread-safe future."""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def post(self, url: str, payload: dict, headers: dict) -> httpx.Response:
+        return await self._client.post(url, json=payload, headers=headers)
+
+    async def post_form(self, url: str, data: dict, files: dict, headers: dict) -> httpx.Response:
+        return await self._client.post(url, data=data, files=files, headers=headers)
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+            self._client = None
+
+    def _ensure_started(self):
+        if self._loop is not None:
+            return
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="graph-http-pool", daemon=True)
+            thread.start()
+            self._client = asyncio.run_coroutine_threadsafe(self._create_client(), loop).result()
+            self._thread = thread
+            self._loop = loop
+
+    async def _create_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(limits=self._limits, timeout=self._timeout, http2=self._http2)
+
+
+class _WhatsAppClientBase:
+    """Thin wrapper around the Meta WhatsApp Cloud API.
+
+    Builds message payloads; subclasses implement ``_send_request`` either as
+    a blocking call or as a coroutine over the shared connection pool.
+    """
 
     API_VERSION = "v18.0"
     REQUEST_TIMEOUT = 10
 
-    def __init__(self):
-        self.api_url = f"https://graph.facebook.com/{self.API_VERSION}/{settings.WHATSAPP_PHONE_NUMBER_ID}/messages"
+    def __init__(
+        self,
+        pool: GraphConnectionPool,
+        rate_limiter: SendRateLimiter,
+        retry_policy: RetryPolicy,
+        circuit_breaker: CircuitBreaker,
+    ):
+        self._pool = pool
+        self._rate_limiter = rate_limiter
+        self._retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.phone_number_id = settings.WHATSAPP_PHONE_NUMBER_ID
+        self.api_url = f"https://graph.facebook.com/{self.API_VERSION}/{self.phone_number_id}/messages"
+        self.media_url = f"https://graph.facebook.com/{self.API_VERSION}/{self.phone_number_id}/media"
         self.headers = {
             "Authorization": f"Bearer {settings.WHATSAPP_TOKEN}",
             "Content-Type": "application/json",
         }
 
     def send_text_message(self, to: str, text: str):
-        payload = {
+        return self._send_request(self.text_message_payload(to, text))
+
+    def send_interactive_reply_buttons(self, to: str, body_text: str, buttons: list):
+        """Send a message with interactive reply buttons."""
+        return self._send_request(self.reply_buttons_payload(to, body_text, buttons))
+
+    def send_interactive_list_menu(self, to: str, header_text: str, body_text: str, sections: list):
+        """Send a message with an interactive list menu."""
+        return self._send_request(self.list_menu_payload(to, header_text, body_text, sections))
+
+    def send_url_button(self, to: str, body_text: str, button_title: str, url: str):
+        """Send a single URL button that opens an external website."""
+        return self._send_request(self.url_button_payload(to, body_text, button_title, url))
+
+    def send_media_message(
+        self,
+        to: str,
+        media_type: str,
+        media_url: str,
+        caption: Optional[str] = None,
+        filename: Optional[str] = None,
+    ):
+        """Send an image or document message using a publicly accessible link."""
+        return self._send_request(self.media_message_payload(to, media_type, media_url, caption, filename))
+
+    def send_payload(self, payload: dict):
+        """Send a pre-built message payload."""
+        return self._send_request(payload)
+
+    @staticmethod
+    def text_message_payload(to: str, text: str) -> dict:
+        return {
             "messaging_product": "whatsapp",
             "to": to,
             "type": "text",
             "text": {"body": text},
         }
-        return self._send_request(payload)
 
-    def send_interactive_reply_buttons(self, to: str, body_text: str, buttons: list):
-        """Send a message with interactive reply buttons."""
-        payload = {
+    @staticmethod
+    def reply_buttons_payload(to: str, body_text: str, buttons: list) -> dict:
+        return {
             "messaging_product": "whatsapp",
             "to": to,
             "type": "interactive",
@@ -50,11 +176,10 @@ class WhatsAppClient:
                 },
             },
         }
-        return self._send_request(payload)
 
-    def send_interactive_list_menu(self, to: str, header_text: str, body_text: str, sections: list):
-        """Send a message with an interactive list menu."""
-        payload = {
+    @staticmethod
+    def list_menu_payload(to: str, header_text: str, body_text: str, sections: list) -> dict:
+        return {
             "messaging_product": "whatsapp",
             "to": to,
             "type": "interactive",
@@ -68,11 +193,10 @@ class WhatsAppClient:
                 },
             },
         }
-        return self._send_request(payload)
 
-    def send_url_button(self, to: str, body_text: str, button_title: str, url: str):
-        """Send a single URL button that opens an external website."""
-        payload = {
+    @staticmethod
+    def url_button_payload(to: str, body_text: str, button_title: str, url: str) -> dict:
+        return {
             "messaging_product": "whatsapp",
             "to": to,
             "type": "interactive",
@@ -92,16 +216,15 @@ class WhatsAppClient:
                 },
             },
         }
-        return self._send_request(payload)
-    def send_media_message(
-        self,
+
+    @staticmethod
+    def media_message_payload(
         to: str,
         media_type: str,
         media_url: str,
         caption: Optional[str] = None,
         filename: Optional[str] = None,
-    ):
-        """Send an image or document message using a publicly accessible link."""
+    ) -> dict:
         if media_type not in {"image", "document"}:
             raise ValueError("media_type must be either 'image' or 'document'")
 
@@ -117,31 +240,117 @@ class WhatsAppClient:
         if media_type == "document" and filename:
             payload[media_type]["filename"] = filename
 
-        return self._send_request(payload)
+        return payload
 
     def _send_request(self, payload: dict):
+        raise NotImplementedError
+
+    async def _deliver(self, payload: dict, recipient_reserved: bool = False) -> httpx.Response:
+        """Post a payload with rate limiting, retries and the circuit breaker.
+
+        Timeouts, connection errors, 429 and 5xx responses are retried with
+        backoff (honouring Retry-After); other 4xx responses are returned
+        immediately. With ``recipient_reserved`` the first attempt skips the
+        recipient's token, which the caller already took. Always runs on the
+        pool's loop.
+        """
+        attempt = 0
+        while True:
+            recipient = None if recipient_reserved and attempt == 0 else payload.get("to")
+            await self._rate_limiter.acquire(self.phone_number_id, recipient)
+            # Admitted only once the request can go out, so a half-open trial
+            # slot is never held through a rate-limit wait.
+            trial = self.circuit_breaker.before_call()
+            try:
+                response = await self._pool.post(self.api_url, payload, self.headers)
+            except httpx.TransportError as exc:
+                self.circuit_breaker.record_failure()
+                if attempt >= self._retry_policy.max_retries:
+                    raise
+                delay = self._retry_policy.backoff(attempt)
+                logger.warning("Graph request failed (%s); retry %d in %.2fs", exc, attempt + 1, delay)
+            except BaseException:
+                # Cancelled (or broke) before Graph answered: no verdict.
+                self.circuit_breaker.record_abandoned(trial)
+                raise
+            else:
+                # 429 means we are throttled, not that Graph is degraded.
+                if response.status_code >= 500:
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                if not self._retry_policy.is_retryable_status(response.status_code):
+                    return response
+                if attempt >= self._retry_policy.max_retries:
+                    return response
+                delay = self._retry_policy.backoff(attempt, response.headers.get("Retry-After"))
+                logger.warning(
+                    "Graph responded %d; retry %d in %.2fs", response.status_code, attempt + 1, delay
+                )
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _upload(self, path: Path, mime_type: str) -> str:
+        """Upload a file to the media endpoint and return its media id. Runs on the pool's loop."""
+        trial = self.circuit_breaker.before_call()
+        try:
+            with open(path, "rb") as file:  # httpx streams it in chunks
+                response = await self._pool.post_form(
+                    self.media_url,
+                    data={"messaging_product": "whatsapp", "type": mime_type},
+                    files={"file": (path.name, file, mime_type)},
+                    headers={"Authorization": self.headers["Authorization"]},
+                )
+        except httpx.TransportError:
+            self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            self.circuit_breaker.record_abandoned(trial)
+            raise
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        response.raise_for_status()
+        return response.json()["id"]
+
+    @staticmethod
+    def _handle_response(payload: dict, response: httpx.Response) -> Optional[dict]:
         try:
-            response = requests.post(
-                self.api_url,
-                json=payload,
-                headers=self.headers,
-                timeout=self.REQUEST_TIMEOUT,
-            )
             response.raise_for_status()
-            logger.info(
-                "Message sent successfully to %s. Response: %s",
-                payload.get("to"),
-                response.json(),
-            )
-            return response.json()
-        except requests.exceptions.RequestException as exc:
+        except httpx.HTTPStatusError as exc:
             logger.error("Error sending message: %s", exc)
-            if exc.response is not None:
-                try:
-                    logger.error("Response body: %s", exc.response.json())
-                except ValueError:
-                    logger.error("Response body: %s", exc.response.text)
+            try:
+                logger.error("Response body: %s", response.json())
+            except ValueError:
+                logger.error("Response body: %s", response.text)
             return None
+        response_json = response.json()
+        logger.info(
+            "Message sent successfully to %s. Response: %s",
+            payload.get("to"),
+            response_json,
+        )
+        return response_json
+
+    @staticmethod
+    def _handle_transport_error(exc: Exception) -> None:
+        logger.error("Error sending message: %s", exc)
+        return None
+
+    @staticmethod
+    def is_media_id_error(response: httpx.Response) -> bool:
+        """Whether Graph refused a send because of its media id (as opposed to the recipient, template, ...)."""
+        try:
+            error = response.json().get("error") or {}
+        except (ValueError, AttributeError):
+            return False
+        if error.get("code") in MEDIA_ID_ERROR_CODES or error.get("error_subcode") in MEDIA_ID_ERROR_SUBCODES:
+            return True
+        if error.get("code") not in INVALID_PARAMETER_CODES:
+            return False
+        details = str((error.get("error_data") or {}).get("details") or error.get("message") or "").lower()
+        return "media" in details and "id" in details
 
     @staticmethod
     def extract_message_id(response_json: Optional[dict]) -> Optional[str]:
@@ -157,7 +366,76 @@ class WhatsAppClient:
         return first_message.get("id")
 
 
-whatsapp_client = WhatsAppClient()
+class WhatsAppClient(_WhatsAppClientBase):
+    """Blocking facade for sync callers (dashboard routes, worker lanes)."""
+
+    def _send_request(self, payload: dict):
+        try:
+            response = self._pool.submit(self._deliver(payload)).result()
+        except (httpx.HTTPError, CircuitOpenError) as exc:
+            return self._handle_transport_error(exc)
+        return self._handle_response(payload, response)
+
+
+class AsyncWhatsAppClient(_WhatsAppClientBase):
+    """Non-blocking client; every ``send_*`` method returns an awaitable."""
+
+    async def post_payload(self, payload: dict, recipient_reserved: bool = False) -> httpx.Response:
+        """Post a payload and return the raw response after retries.
+
+        Unlike ``send_*`` this does not swallow errors: transport failures and
+        ``CircuitOpenError`` propagate so callers can classify them. Pass
+        ``recipient_reserved`` after ``reserve_recipient`` for this send.
+        """
+        return await asyncio.wrap_future(self._pool.submit(self._deliver(payload, recipient_reserved)))
+
+    async def reserve_recipient(self, recipient: str):
+        """Wait for the recipient's rate-limit token ahead of ``post_payload``."""
+        await asyncio.wrap_future(self._pool.submit(self._rate_limiter.acquire_recipient(recipient)))
+
+    async def upload_media(self, path: Path, mime_type: str) -> str:
+        """Upload a file to Graph and return the media id to send it by.
+
+        Errors propagate (``httpx.HTTPError``, ``CircuitOpenError``).
+        """
+        return await asyncio.wrap_future(self._pool.submit(self._upload(path, mime_type)))
+
+    async def _send_request(self, payload: dict):
+        try:
+            response = await asyncio.wrap_future(
+                self._pool.submit(self._deliver(payload))
+            )
+        except (httpx.HTTPError, CircuitOpenError) as exc:
+            return self._handle_transport_error(exc)
+        return self._handle_response(payload, response)
+
+
+graph_pool = GraphConnectionPool(
+    max_connections=settings.WHATSAPP_HTTP_POOL_SIZE,
+    max_keepalive_connections=settings.WHATSAPP_HTTP_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.WHATSAPP_HTTP_KEEPALIVE_EXPIRY,
+    http2=settings.WHATSAPP_HTTP2,
+    timeout=_WhatsAppClientBase.REQUEST_TIMEOUT,
+)
+send_rate_limiter = SendRateLimiter(
+    sender_rate=settings.WHATSAPP_SEND_RATE_PER_SECOND,
+    sender_burst=settings.WHATSAPP_SEND_BURST,
+    recipient_rate=settings.WHATSAPP_RECIPIENT_RATE_PER_MINUTE / 60,
+    recipient_burst=settings.WHATSAPP_RECIPIENT_BURST,
+    max_tracked_recipients=settings.RATE_LIMIT_MAX_TRACKED_RECIPIENTS,
+)
+graph_retry_policy = RetryPolicy(
+    max_retries=settings.WHATSAPP_MAX_RETRIES,
+    base_delay=settings.WHATSAPP_RETRY_BASE_DELAY,
+    max_delay=settings.WHATSAPP_RETRY_MAX_DELAY,
+)
+graph_circuit_breaker = CircuitBreaker(
+    name="graph-api",
+    failure_threshold=settings.WHATSAPP_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=settings.WHATSAPP_BREAKER_RESET_TIMEOUT,
+)
+whatsapp_client = WhatsAppClient(graph_pool, send_rate_limiter, graph_retry_policy, graph_circuit_breaker)
+async_whatsapp_client = AsyncWhatsAppClient(graph_pool, send_rate_limiter, graph_retry_policy, graph_circuit_breaker)
 
 
 
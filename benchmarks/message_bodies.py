@@ -0,0 +1,95 @@
+"""Measure database size and insert cost with and without interned bot replies.
+
+Run from the repository root:
+
+    python -m benchmarks.message_bodies --messages 1000000
+
+Each synthetic webhook turn stores one short incoming message and three bot
+replies drawn from the real FAQ texts, through ``MessageWriter`` on a fresh
+database with the full schema (migrations included, so the search triggers
+run too). ``plain`` stores every reply's text in its row; ``interned`` stores
+it once in message_bodies and references it.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Dict
+
+from sqlalchemy import insert, text
+
+from app import faq_service, models, schemas
+from app.config import settings
+from app.database import Base, build_engine
+from app.message_writer import MessageWrite, MessageWriter
+from app.migrations import run_migrations
+
+REPLIES = [
+    faq_service.WELCOME_MESSAGE,
+    faq_service.OFFER_MESSAGE,
+    faq_service.BUY_MESSAGE,
+    faq_service.DESIRED_EMAIL_PROMPT,
+    faq_service.RANDOM_EMAIL_MESSAGE,
+    faq_service.PAYMENT_PROMPT,
+    *faq_service.PAYMENT_DETAILS.values(),
+]
+INCOMING = ["hi", "hello", "menu", "price?", "buy", "ok thanks", "payment done", "/help"]
+
+
+def run_profile(name: str, messages: int, users: int) -> Dict:
+    directory = tempfile.mkdtemp(prefix=f"bodies-{name}-")
+    path = os.path.join(directory, "bench.db")
+    bind = build_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=bind)
+    run_migrations(bind)
+    with bind.begin() as connection:
+        connection.execute(insert(models.User), [{"whatsapp_id": f"9200{i:07d}"} for i in range(users)])
+
+    rng = random.Random(7)
+    writer = MessageWriter(bind, settings.MESSAGE_WRITER_MAX_BATCH, settings.MESSAGE_WRITER_MAX_DELAY_MS / 1000)
+    writer.start()
+    futures = []
+    started = time.perf_counter()
+    for _ in range(messages // 4):
+        write = MessageWrite(user_id=rng.randint(1, users))
+        write.add(schemas.MessageCreate(content=rng.choice(INCOMING), direction="incoming"))
+        for reply in rng.sample(REPLIES, 3):
+            write.add(schemas.MessageCreate(content=reply, direction="outgoing"), intern=name == "interned")
+        futures.append(writer.submit(write))
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+    writer.stop()
+
+    with bind.connect() as connection:
+        stored = connection.execute(text("SELECT count(*) FROM messages")).scalar()
+        connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+    bind.dispose()
+    return {
+        "profile": name,
+        "messages": stored,
+        "seconds": elapsed,
+        "us_per_message": elapsed / stored * 1e6,
+        "db_mb": os.path.getsize(path) / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, {args.users} users")
+    print(f"{'profile':<10}{'messages':>10}{'seconds':>10}{'us/msg':>10}{'db MB':>10}")
+    for name in ("plain", "interned"):
+        result = run_profile(name, args.messages, args.users)
+        print(
+            f"{result['profile']:<10}{result['messages']:>10}{result['seconds']:>10.1f}"
+            f"{result['us_per_message']:>10.1f}{result['db_mb']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
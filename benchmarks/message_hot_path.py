@@ -0,0 +1,97 @@
+"""Per-message CPU cost of the ORM and Core paths for storing and listing messages.
+
+Run from the repository root:
+
+    python -m benchmarks.message_hot_path --page 100 --rounds 200
+
+``write``: the old ``crud.create_message`` flow (MessageCreate -> ORM object,
+commit, refresh, one message at a time) against the message writer's Core
+bulk insert of the same rows. ``read``: one conversation page loaded as ORM
+objects and validated through ``schemas.Message`` the way FastAPI serializes
+a ``response_model``, against ``crud.message_rows_statement`` tuples encoded
+by ``crud.encode_message_rows``. Both read paths produce identical JSON.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Callable, List
+
+from pydantic import TypeAdapter
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app import crud, models, schemas
+from app.database import Base, build_engine
+from app.message_writer import MessageWrite, MessageWriter
+
+MESSAGES = TypeAdapter(List[schemas.Message])
+
+
+def _cpu_us_per_message(operation: Callable[[], None], rounds: int, messages: int) -> float:
+    started = time.process_time()
+    for _ in range(rounds):
+        operation()
+    return (time.process_time() - started) / (rounds * messages) * 1e6
+
+
+def _orm_page_json(db: Session, user_id: int, page: int) -> bytes:
+    messages = crud.get_messages_by_user(db, user_id, limit=page)
+    validated = MESSAGES.validate_python(messages, from_attributes=True)
+    content = MESSAGES.dump_python(validated, mode="json")
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _core_page_json(db: Session, user_id: int, page: int) -> bytes:
+    statement, newest_first = crud.message_rows_statement(user_id, limit=page)
+    rows = db.execute(statement).all()
+    return crud.encode_message_rows(reversed(rows) if newest_first else rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="hot-path-")
+    bind = build_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as connection:
+        connection.execute(insert(models.User), [{"whatsapp_id": "920000000001"}])
+    writer = MessageWriter(bind, max_batch=1, max_delay=0)
+    messages = [
+        schemas.MessageCreate(content=f"message number {n} with some ordinary text", direction="outgoing")
+        for n in range(args.page)
+    ]
+
+    def orm_write():
+        with Session(bind) as db:
+            for message in messages:
+                crud.create_message(db, message, user_id=1)
+
+    def core_write():
+        write = MessageWrite(user_id=1)
+        for message in messages:
+            write.add(message)
+        writer.write(write)
+
+    write_rounds = max(1, args.rounds // 10)
+    orm_write_cost = _cpu_us_per_message(orm_write, write_rounds, args.page)
+    core_write_cost = _cpu_us_per_message(core_write, write_rounds, args.page)
+
+    with Session(bind) as db:
+        assert _orm_page_json(db, 1, args.page) == _core_page_json(db, 1, args.page)
+        orm_read_cost = _cpu_us_per_message(lambda: _orm_page_json(db, 1, args.page), args.rounds, args.page)
+        core_read_cost = _cpu_us_per_message(lambda: _core_page_json(db, 1, args.page), args.rounds, args.page)
+    bind.dispose()
+
+    print(f"page of {args.page} messages, CPU microseconds per message")
+    print(f"{'path':<8}{'ORM':>10}{'Core':>10}{'speedup':>10}")
+    print(f"{'write':<8}{orm_write_cost:>10.1f}{core_write_cost:>10.1f}{orm_write_cost / core_write_cost:>9.1f}x")
+    print(f"{'read':<8}{orm_read_cost:>10.1f}{core_read_cost:>10.1f}{orm_read_cost / core_read_cost:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Compare SQLite storage profiles under concurrent webhook and dashboard load.
+
+Run from the repository root:
+
+    python -m benchmarks.sqlite_storage_profile --seconds 10 --writers 8 --readers 8
+
+``baseline`` is the previous setup: one default engine, rollback journal, no
+pragmas. ``tuned`` is ``app.database.build_engine``: WAL and the configured
+pragmas, a single writer connection and a pool of query-only readers. Writer
+threads simulate webhook turns (one incoming and two outgoing rows per
+transaction); reader threads simulate dashboard polls (the latest page of a
+conversation).
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+from sqlalchemy import bindparam, create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+
+from app import models
+from app.database import Base, build_engine
+
+
+def _seed(bind, users: int, messages_per_user: int):
+    with bind.begin() as connection:
+        connection.execute(insert(models.User), [{"whatsapp_id": f"9200{i:07d}"} for i in range(users)])
+        rows = [
+            {"user_id": user_id, "content": f"seed message {n}", "direction": "incoming" if n % 2 else "outgoing"}
+            for user_id in range(1, users + 1)
+            for n in range(messages_per_user)
+        ]
+        connection.execute(insert(models.Message), rows)
+
+
+def _percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_profile(name: str, seconds: float, writers: int, readers: int, users: int) -> Dict:
+    directory = tempfile.mkdtemp(prefix=f"sqlite-{name}-")
+    url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    if name == "baseline":
+        write_engine = read_engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        write_engine = build_engine(url)
+        read_engine = build_engine(url, read_only=True)
+    Base.metadata.create_all(bind=write_engine)
+    _seed(write_engine, users, messages_per_user=20)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    write_latencies: List[float] = []
+    read_latencies: List[float] = []
+    errors = {"write": 0, "read": 0}
+
+    def writer():
+        rng = random.Random()
+        while not stop.is_set():
+            user_id = rng.randint(1, users)
+            started = time.perf_counter()
+            try:
+                with write_engine.begin() as connection:
+                    connection.execute(
+                        insert(models.Message),
+                        [
+                            {"user_id": user_id, "content": "hi", "direction": "incoming"},
+                            {"user_id": user_id, "content": "reply one", "direction": "outgoing"},
+                            {"user_id": user_id, "content": "reply two", "direction": "outgoing"},
+                        ],
+                    )
+            except OperationalError:
+                with lock:
+                    errors["write"] += 1
+                continue
+            with lock:
+                write_latencies.append(time.perf_counter() - started)
+
+    def reader():
+        rng = random.Random()
+        page = (
+            select(models.Message)
+            .where(models.Message.user_id == bindparam("user_id"))
+            .order_by(models.Message.id.desc())
+            .limit(100)
+        )
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                with read_engine.connect() as connection:
+                    connection.execute(page, {"user_id": rng.randint(1, users)}).all()
+            except OperationalError:
+                with lock:
+                    errors["read"] += 1
+                continue
+            with lock:
+                read_latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    write_engine.dispose()
+    read_engine.dispose()
+
+    return {
+        "profile": name,
+        "writes_per_s": len(write_latencies) / seconds,
+        "write_p50_ms": statistics.median(write_latencies) * 1000 if write_latencies else 0.0,
+        "write_p99_ms": _percentile(write_latencies, 0.99) * 1000,
+        "reads_per_s": len(read_latencies) / seconds,
+        "read_p99_ms": _percentile(read_latencies, 0.99) * 1000,
+        "write_errors": errors["write"],
+        "read_errors": errors["read"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.readers} readers, {args.seconds:.0f}s per profile")
+    header = f"{'profile':<10}{'writes/s':>10}{'w p50 ms':>10}{'w p99 ms':>10}{'reads/s':>10}{'r p99 ms':>10}{'errors':>8}"
+    print(header)
+    for name in ("baseline", "tuned"):
+        result = run_profile(name, args.seconds, args.writers, args.readers, args.users)
+        print(
+            f"{result['profile']:<10}{result['writes_per_s']:>10.0f}{result['write_p50_ms']:>10.2f}"
+            f"{result['write_p99_ms']:>10.2f}{result['reads_per_s']:>10.0f}{result['read_p99_ms']:>10.2f}"
+            f"{result['write_errors'] + result['read_errors']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+import pytest
+
+# app.database builds its engines at import time, so point it at a scratch
+# database before any test module imports the app.
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='whatsapp-faq-tests-'), 'app.db')}"
+
+
+@pytest.fixture(scope="session")
+def database():
+    """The app's scratch database with every table and migration in place."""
+    from app.database import create_db_and_tables, engine
+    from app.migrations import run_migrations
+
+    create_db_and_tables()
+    run_migrations(engine)
+    return engine
@@ -0,0 +1,9 @@
+import pytest
+
+from app.database import build_async_read_engine, build_engine
+
+
+@pytest.mark.parametrize("build", [build_engine, build_async_read_engine])
+def test_other_databases_are_rejected(build):
+    with pytest.raises(ValueError, match="Only SQLite"):
+        build("postgresql://faq@localhost/faq")
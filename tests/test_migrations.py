@@ -0,0 +1,135 @@
+import pytest
+from sqlalchemy import text
+
+from app import crud, faq_service
+from app.database import Base, build_engine
+from app.migrations import MIGRATIONS, run_migrations
+
+USERS = 20
+
+# The users and messages tables as the first release created them.
+BASELINE_SCHEMA = [
+    """CREATE TABLE users (
+        id INTEGER NOT NULL PRIMARY KEY,
+        whatsapp_id VARCHAR NOT NULL,
+        created_at DATETIME DEFAULT (CURRENT_TIMESTAMP)
+    )""",
+    "CREATE UNIQUE INDEX ix_users_whatsapp_id ON users (whatsapp_id)",
+    "CREATE INDEX ix_users_id ON users (id)",
+    """CREATE TABLE messages (
+        id INTEGER NOT NULL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        content TEXT NOT NULL,
+        message_type VARCHAR,
+        direction VARCHAR NOT NULL,
+        timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+        whatsapp_message_id VARCHAR
+    )""",
+    "CREATE INDEX ix_messages_id ON messages (id)",
+    "CREATE UNIQUE INDEX ix_messages_whatsapp_message_id ON messages (whatsapp_message_id)",
+]
+
+
+def build_baseline(bind, users: int):
+    """A conversation per user; the bot's welcome reply repeats, so it gets interned."""
+    with bind.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(
+            text("INSERT INTO users (id, whatsapp_id) VALUES (:id, :whatsapp_id)"),
+            [{"id": user_id, "whatsapp_id": f"9200{user_id:07d}"} for user_id in range(1, users + 1)],
+        )
+        rows = []
+        for user_id in range(1, users + 1):
+            rows.append({"user_id": user_id, "content": "hi", "direction": "incoming"})
+            rows.append({"user_id": user_id, "content": faq_service.WELCOME_MESSAGE, "direction": "outgoing"})
+            if user_id % 2:
+                rows.append({"user_id": user_id, "content": "price?", "direction": "incoming"})
+        connection.execute(
+            text(
+                "INSERT INTO messages (user_id, content, message_type, direction) "
+                "VALUES (:user_id, :content, 'text', :direction)"
+            ),
+            rows,
+        )
+
+
+def upgrade(bind) -> int:
+    """Bring a database up to date the way startup does."""
+    Base.metadata.create_all(bind=bind)
+    return run_migrations(bind)
+
+
+def snapshot(bind):
+    with bind.connect() as connection:
+        counts = {
+            table: connection.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+            for table in ("users", "messages", "conversations", "message_bodies", "schema_version")
+        }
+        counts["interned"] = connection.execute(text("SELECT count(*) FROM messages WHERE body_id IS NOT NULL")).scalar()
+        counts["indexed"] = connection.execute(
+            text("SELECT count(*) FROM messages_fts WHERE messages_fts MATCH :query"), {"query": '"welcome"'}
+        ).scalar()
+    return counts
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    bind = build_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    build_baseline(bind, USERS)
+    yield bind
+    bind.dispose()
+
+
+def test_baseline_database_upgrades_to_latest_schema(baseline):
+    assert upgrade(baseline) == MIGRATIONS[-1].version
+
+    with baseline.connect() as connection:
+        conversations = connection.execute(
+            text(
+                "SELECT count(*) FROM conversations AS c "
+                "JOIN messages AS m ON m.id = c.last_message_id AND m.user_id = c.user_id "
+                "WHERE c.last_inbound_at IS NOT NULL"
+            )
+        ).scalar()
+    state = snapshot(baseline)
+    assert conversations == USERS
+    assert state["interned"] == USERS
+    assert state["indexed"] == USERS
+
+
+def test_baseline_conversations_are_backfilled_from_the_last_message(baseline):
+    upgrade(baseline)
+
+    with baseline.connect() as connection:
+        rows = connection.execute(
+            text(
+                "SELECT c.user_id, c.last_message_id, c.last_direction, c.last_preview, c.unread_count, "
+                "c.last_inbound_at, (SELECT MAX(id) FROM messages WHERE user_id = c.user_id) AS newest "
+                "FROM conversations AS c ORDER BY c.user_id"
+            )
+        ).all()
+    assert [row.user_id for row in rows] == list(range(1, USERS + 1))
+    for row in rows:
+        assert row.last_message_id == row.newest
+        assert row.unread_count == 0
+        assert row.last_inbound_at is not None
+        if row.user_id % 2:
+            assert (row.last_direction, row.last_preview) == ("incoming", "price?")
+        else:
+            preview = crud.conversation_preview(faq_service.WELCOME_MESSAGE, "text")
+            assert (row.last_direction, row.last_preview) == ("outgoing", preview)
+
+
+def test_migrations_are_idempotent(baseline):
+    version = upgrade(baseline)
+    before = snapshot(baseline)
+
+    assert upgrade(baseline) == version
+    # A step may run again on a schema that already has its change, e.g. when
+    # create_all built the tables; it must leave the data as it was.
+    for step in MIGRATIONS:
+        with baseline.begin() as connection:
+            step.apply(connection)
+
+    assert snapshot(baseline) == before
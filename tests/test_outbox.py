@@ -0,0 +1,170 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+from sqlalchemy import bindparam, text
+
+from app import crud, schemas
+from app.circuit_breaker import RetryPolicy
+from app.events import EventHub
+from app.message_writer import MessageWrite, message_writer
+from app.outbox import OutboxDelivery
+
+
+class FakeGraphClient:
+    """Stands in for AsyncWhatsAppClient: records each post and answers from a script."""
+
+    def __init__(self, failures: Optional[Set[str]] = None, latency: float = 0.005):
+        # Bodies answered with a 503 the first time they are posted.
+        self._failures = set(failures or ())
+        self._latency = latency
+        self.posts: List[Tuple[str, str, int]] = []
+
+    async def reserve_recipient(self, recipient: str):
+        await asyncio.sleep(0)
+
+    async def post_payload(self, payload: Dict, recipient_reserved: bool = False) -> httpx.Response:
+        await asyncio.sleep(self._latency)
+        body = payload["text"]["body"]
+        if body in self._failures:
+            self._failures.discard(body)
+            status_code = 503
+        else:
+            status_code = 200
+        self.posts.append((payload["to"], body, status_code))
+        return httpx.Response(status_code, json={"messages": [{"id": f"wamid.{body}"}]})
+
+    @staticmethod
+    def extract_message_id(data: Dict) -> Optional[str]:
+        return data["messages"][0]["id"]
+
+    @staticmethod
+    def is_media_id_error(response: httpx.Response) -> bool:
+        return False
+
+    def delivered(self, recipient: str) -> List[str]:
+        return [body for to, body, status_code in self.posts if to == recipient and status_code == 200]
+
+
+class FixedRetryPolicy(RetryPolicy):
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        return self.base_delay
+
+
+def queue_replies(recipient: str, count: int) -> List[str]:
+    """Write ``count`` bot replies to ``recipient`` with their outbox rows, as one reply does."""
+    user_id = crud.create_user_id(recipient)
+    bodies = [f"{recipient}-{index}" for index in range(count)]
+    write = MessageWrite(user_id=user_id)
+    for body in bodies:
+        payload = {"messaging_product": "whatsapp", "to": recipient, "type": "text", "text": {"body": body}}
+        write.add(schemas.MessageCreate(content=body, direction="outgoing"), recipient=recipient, payload=payload)
+    message_writer.write(write)
+    return bodies
+
+
+def unsent(database, recipients: List[str]) -> int:
+    statement = text(
+        "SELECT count(*) FROM outbox WHERE status IN ('pending', 'sending') AND recipient IN :recipients"
+    ).bindparams(bindparam("recipients", expanding=True))
+    with database.connect() as connection:
+        return connection.execute(statement, {"recipients": recipients}).scalar()
+
+
+async def wait_until_sent(database, recipients: List[str], timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while await asyncio.to_thread(unsent, database, recipients):
+        assert time.monotonic() < deadline, "outbox did not drain"
+        await asyncio.sleep(0.02)
+
+
+def build_delivery(client: FakeGraphClient, base_delay: float = 0.05, events: Optional[EventHub] = None):
+    return OutboxDelivery(
+        client=client,
+        workers=4,
+        batch_size=100,
+        poll_interval=0.05,
+        max_attempts=5,
+        retry_policy=FixedRetryPolicy(max_retries=5, base_delay=base_delay, max_delay=base_delay),
+        events=events,
+    )
+
+
+def test_each_row_is_sent_once_under_concurrent_passes(database):
+    recipients = [f"92300000{index:04d}" for index in range(8)]
+    expected = {recipient: queue_replies(recipient, 5) for recipient in recipients}
+    client = FakeGraphClient()
+    delivery = build_delivery(client)
+
+    async def run():
+        await delivery.start()
+        try:
+            # Extra passes race the delivery loop, loading rows that are
+            # already claimed or about to be.
+            for _ in range(10):
+                await asyncio.gather(*(delivery._dispatch_due() for _ in range(3)))
+            await wait_until_sent(database, recipients)
+        finally:
+            await delivery.stop()
+
+    asyncio.run(run())
+
+    posted = [body for to, body, _ in client.posts if to in expected]
+    assert sorted(posted) == sorted(body for bodies in expected.values() for body in bodies)
+    for recipient, bodies in expected.items():
+        assert client.delivered(recipient) == bodies
+
+
+def test_backing_off_head_holds_its_recipient_but_not_others(database):
+    held, other = "923100000001", "923100000002"
+    held_bodies = queue_replies(held, 3)
+    other_bodies = queue_replies(other, 3)
+    client = FakeGraphClient(failures={held_bodies[0]})
+    delivery = build_delivery(client, base_delay=0.5)
+
+    async def run():
+        await delivery.start()
+        try:
+            deadline = time.monotonic() + 5
+            while client.delivered(other) != other_bodies:
+                assert time.monotonic() < deadline, "other recipient was not delivered"
+                await asyncio.sleep(0.02)
+            # The failed head is still backing off: nothing behind it went out.
+            assert client.delivered(held) == []
+            await wait_until_sent(database, [held, other])
+        finally:
+            await delivery.stop()
+
+    asyncio.run(run())
+
+    assert [body for to, body, _ in client.posts if to == held] == [held_bodies[0]] + held_bodies
+    assert client.delivered(held) == held_bodies
+
+
+def test_sent_message_is_announced_with_its_whatsapp_id(database):
+    recipient = "923200000001"
+    (body,) = queue_replies(recipient, 1)
+    client = FakeGraphClient()
+    events = EventHub(queue_size=16)
+    delivery = build_delivery(client, events=events)
+
+    async def run():
+        await events.start()
+        with events.subscription() as subscription:
+            await delivery.start()
+            try:
+                return await asyncio.wait_for(subscription.get(), timeout=5)
+            finally:
+                await delivery.stop()
+                await events.stop()
+
+    event, data = asyncio.run(run())
+
+    assert event == "message.updated"
+    with database.connect() as connection:
+        stored = connection.execute(
+            text("SELECT user_id, whatsapp_message_id FROM messages WHERE id = :id"), {"id": data["id"]}
+        ).one()
+    assert stored.whatsapp_message_id == f"wamid.{body}"
+    assert data["user_id"] == stored.user_id
@@ -0,0 +1,39 @@
+import asyncio
+
+from app.rate_limiter import SendRateLimiter
+
+
+def recipient_limiter(rate: float, burst: float, max_tracked_recipients: int) -> SendRateLimiter:
+    return SendRateLimiter(
+        sender_rate=0,
+        sender_burst=1,
+        recipient_rate=rate,
+        recipient_burst=burst,
+        max_tracked_recipients=max_tracked_recipients,
+    )
+
+
+def test_refilled_recipient_buckets_are_evicted_first():
+    limiter = recipient_limiter(rate=1000.0, burst=2, max_tracked_recipients=2)
+
+    async def run():
+        await limiter.acquire_recipient("a")
+        await limiter.acquire_recipient("b")
+        await asyncio.sleep(0.01)  # both refill
+        await limiter.acquire_recipient("c")
+
+    asyncio.run(run())
+    assert list(limiter._recipients) == ["b", "c"]
+
+
+def test_recipient_bucket_in_deficit_is_not_reset_by_eviction():
+    limiter = recipient_limiter(rate=1 / 60, burst=1, max_tracked_recipients=1)
+
+    async def run():
+        await limiter.acquire_recipient("a")  # spends a's only token
+        await limiter.acquire_recipient("b")
+
+    asyncio.run(run())
+    # a would get a fresh burst if its bucket were dropped for b.
+    assert list(limiter._recipients) == ["a", "b"]
+    assert limiter._recipients["a"].reserve() > 0
@@ -0,0 +1,30 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from app import crud, schemas
+from app.database import engine
+from app.main import app
+from app.message_writer import MessageWrite, message_writer
+
+REPLY = "Our support desk answers within one business day; ask about the quetzal plan for pricing details."
+
+
+def test_search_finds_interned_bot_reply():
+    with TestClient(app) as client:
+        user_id = crud.create_user_id("920000000019")
+        write = MessageWrite(user_id=user_id)
+        write.add(schemas.MessageCreate(content=REPLY, direction="outgoing"), intern=True)
+        (message_id,) = message_writer.write(write).message_ids
+
+        with engine.connect() as connection:
+            stored = connection.execute(
+                text("SELECT content, body_id FROM messages WHERE id = :id"), {"id": message_id}
+            ).one()
+        assert stored.content == "" and stored.body_id is not None
+
+        response = client.get("/dashboard/search", params={"q": "quetzal"}, auth=("admin", "password"))
+
+    assert response.status_code == 200
+    hits = response.json()["hits"]
+    assert [hit["message_id"] for hit in hits] == [message_id]
+    assert "<mark>quetzal</mark>" in hits[0]["snippet"]